@@ -1,8 +1,9 @@
-from google import genai
 from google.genai import types
 import os
 import json
-from utils import load_llm_settings, print_llm_usage_and_cost
+from utils import get_genai_client, load_llm_settings, print_llm_usage_and_cost
+from retry_policy import create_retry_policy
+from hedging import create_hedger
 
 llm_settings = load_llm_settings()
 func_settings = llm_settings["func_settings"]["create_assembly_steps"]
@@ -11,6 +12,12 @@ temperature = func_settings["temperature"]
 top_p = func_settings["top_p"]
 seed = func_settings["seed"]
 max_output_tokens = func_settings["max_output_tokens"]
+# 1回の呼び出しの期限（秒）。応答が無いまま接続を保持し続けないようHTTPのタイムアウトとする
+timeout_sec = func_settings.get("timeout_sec")
+# 一時的なエラー（429・503等）の場合の再試行
+retry_policy = create_retry_policy("create_assembly_steps", func_settings.get("retry"))
+# 応答が遅い場合に同一のリクエストを追加で送る（seed固定・temperature 0のため応答は同等）
+hedger = create_hedger("create_assembly_steps", func_settings.get("hedge"))
 
 with open("sys_prompt/create_assembly_steps.txt", "r", encoding="utf-8") as f:
     sys_prompt = f.read()
@@ -25,23 +32,21 @@ def repair_json(text: str) -> str:
     return repair_text
 
 
-def generate_assembly_manual(
-    image_bytes: bytes, mime_type: str, parts_list: list[dict]
-) -> dict:
+def _http_options(timeout: float = None):
     """
-    画像・部品リストから組み立て手順書を生成するAIエージェント
-    Args:
-        image_bytes (bytes): 画像データ
-        mime_type (str): 画像のMIMEタイプ
-        parts_list (list[dict]): 部品リスト
-    Returns:
-        dict: 組み立て手順書情報
+    呼び出しの期限をHTTPのタイムアウト（ミリ秒）として設定する
+    timeoutにはステージの期限までの残り時間を指定し、設定値の期限より短い場合はそちらを用いる
     """
-    client = genai.Client(
-        vertexai=True,
-        project="plan-craft",
-        location="global",
-    )
+    limits = [t for t in (timeout_sec, timeout) if t is not None]
+    if not limits:
+        return None
+    return types.HttpOptions(timeout=max(1, int(min(limits) * 1000)))
+
+
+def _build_request(
+    image_bytes: bytes, mime_type: str, parts_list: list[dict], timeout: float = None
+):
+    """LLMへのリクエスト（contents, config）を組み立てる"""
     msg_prompt = types.Part.from_text(text=user_prompt)
     msg_image = types.Part.from_bytes(
         data=image_bytes,
@@ -58,6 +63,7 @@ def generate_assembly_manual(
         top_p=top_p,
         seed=seed,
         max_output_tokens=max_output_tokens,
+        http_options=_http_options(timeout),
         system_instruction=[types.Part.from_text(text=sys_prompt)],
         response_mime_type="application/json",
         response_schema={
@@ -65,11 +71,11 @@ def generate_assembly_manual(
             "properties": {"response": {"type": "STRING"}},
         },
     )
-    response = client.models.generate_content(
-        model=model,
-        contents=contents,
-        config=config,
-    )
+    return contents, config
+
+
+def _parse_response(response) -> dict:
+    """LLMのレスポンスから組み立て手順書情報を取り出す"""
     # トークン数・費用の出力
     if hasattr(response, "usage_metadata") and response.usage_metadata:
         prompt_tokens = getattr(response.usage_metadata, "prompt_token_count", None)
@@ -92,6 +98,52 @@ def generate_assembly_manual(
         )
 
 
+def generate_assembly_manual(
+    image_bytes: bytes, mime_type: str, parts_list: list[dict], timeout: float = None
+) -> dict:
+    """
+    画像・部品リストから組み立て手順書を生成するAIエージェント
+    Args:
+        image_bytes (bytes): 画像データ
+        mime_type (str): 画像のMIMEタイプ
+        parts_list (list[dict]): 部品リスト
+        timeout (float, optional): 呼び出しの期限までの残り時間（秒）
+    Returns:
+        dict: 組み立て手順書情報
+    """
+    client = get_genai_client()
+    contents, config = _build_request(
+        image_bytes, mime_type, parts_list, timeout=timeout
+    )
+    response = retry_policy.call(
+        client.models.generate_content,
+        model=model,
+        contents=contents,
+        config=config,
+    )
+    return _parse_response(response)
+
+
+async def generate_assembly_manual_async(
+    image_bytes: bytes, mime_type: str, parts_list: list[dict], timeout: float = None
+) -> dict:
+    """generate_assembly_manualの非同期版（応答待ちの間スレッドを占有しない）"""
+    client = get_genai_client()
+    contents, config = _build_request(
+        image_bytes, mime_type, parts_list, timeout=timeout
+    )
+    response = await retry_policy.call_async(
+        lambda: hedger.run(
+            lambda: client.aio.models.generate_content(
+                model=model,
+                contents=contents,
+                config=config,
+            )
+        )
+    )
+    return _parse_response(response)
+
+
 def generate(image_path: str, parts_list: list) -> None:
     """
     画像ファイルと部品リストから手順書を生成する
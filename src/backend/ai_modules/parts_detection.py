@@ -1,8 +1,8 @@
-from google import genai
 from google.genai import types
 import json
 import os
-from utils import load_llm_settings, print_llm_usage_and_cost
+from utils import get_genai_client, load_llm_settings, print_llm_usage_and_cost
+from retry_policy import create_retry_policy
 
 llm_settings = load_llm_settings()
 func_settings = llm_settings["func_settings"]["parts_detection"]
@@ -11,6 +11,10 @@ temperature = func_settings["temperature"]
 top_p = func_settings["top_p"]
 seed = func_settings["seed"]
 max_output_tokens = func_settings["max_output_tokens"]
+# 1回の呼び出しの期限（秒）。応答が無いまま接続を保持し続けないようHTTPのタイムアウトとする
+timeout_sec = func_settings.get("timeout_sec")
+# 一時的なエラー（429・503等）の場合の再試行
+retry_policy = create_retry_policy("parts_detection", func_settings.get("retry"))
 
 with open("sys_prompt/parts_detection.txt", "r", encoding="utf-8") as f:
     sys_prompt = f.read()
@@ -18,22 +22,19 @@ with open("user_prompt/parts_detection.txt", "r", encoding="utf-8") as f:
     user_prompt = f.read()
 
 
-def detect_parts_from_bytes(image_bytes: bytes, mime_type: str) -> list[dict]:
-    """画像から部品を検出するAIエージェント
-
-    Args:
-        image_bytes (bytes): 画像データ
-        mime_type (str): 画像のMIMEタイプ
-
-    Returns:
-        list[dict]: 検出された部品の情報リスト
+def _http_options(timeout: float = None):
     """
+    呼び出しの期限をHTTPのタイムアウト（ミリ秒）として設定する
+    timeoutにはステージの期限までの残り時間を指定し、設定値の期限より短い場合はそちらを用いる
+    """
+    limits = [t for t in (timeout_sec, timeout) if t is not None]
+    if not limits:
+        return None
+    return types.HttpOptions(timeout=max(1, int(min(limits) * 1000)))
 
-    client = genai.Client(
-        vertexai=True,
-        project="plan-craft",
-        location="global",
-    )
+
+def _build_request(image_bytes: bytes, mime_type: str, timeout: float = None):
+    """LLMへのリクエスト（contents, config）を組み立てる"""
     msg1_image1 = types.Part.from_bytes(
         data=image_bytes,
         mime_type=mime_type,
@@ -52,6 +53,7 @@ def detect_parts_from_bytes(image_bytes: bytes, mime_type: str) -> list[dict]:
         top_p=top_p,
         seed=seed,
         max_output_tokens=max_output_tokens,
+        http_options=_http_options(timeout),
         response_mime_type="application/json",
         response_schema={
             "type": "OBJECT",
@@ -59,11 +61,11 @@ def detect_parts_from_bytes(image_bytes: bytes, mime_type: str) -> list[dict]:
         },
         system_instruction=[types.Part.from_text(text=sys_prompt)],
     )
-    response = client.models.generate_content(
-        model=model,
-        contents=contents,
-        config=generate_content_config,
-    )
+    return contents, generate_content_config
+
+
+def _parse_response(response) -> list[dict]:
+    """LLMのレスポンスから部品の情報リストを取り出す"""
     # トークン数・費用の出力
     if hasattr(response, "usage_metadata") and response.usage_metadata:
         prompt_tokens = getattr(response.usage_metadata, "prompt_token_count", None)
@@ -85,6 +87,51 @@ def detect_parts_from_bytes(image_bytes: bytes, mime_type: str) -> list[dict]:
         )
 
 
+def detect_parts_from_bytes(
+    image_bytes: bytes, mime_type: str, timeout: float = None
+) -> list[dict]:
+    """画像から部品を検出するAIエージェント
+
+    Args:
+        image_bytes (bytes): 画像データ
+        mime_type (str): 画像のMIMEタイプ
+        timeout (float, optional): 呼び出しの期限までの残り時間（秒）
+
+    Returns:
+        list[dict]: 検出された部品の情報リスト
+    """
+
+    client = get_genai_client()
+    contents, generate_content_config = _build_request(
+        image_bytes, mime_type, timeout=timeout
+    )
+    response = retry_policy.call(
+        client.models.generate_content,
+        model=model,
+        contents=contents,
+        config=generate_content_config,
+    )
+    return _parse_response(response)
+
+
+async def detect_parts_from_bytes_async(
+    image_bytes: bytes, mime_type: str, timeout: float = None
+) -> list[dict]:
+    """detect_parts_from_bytesの非同期版（応答待ちの間スレッドを占有しない）"""
+    client = get_genai_client()
+    contents, generate_content_config = _build_request(
+        image_bytes, mime_type, timeout=timeout
+    )
+    response = await retry_policy.call_async(
+        lambda: client.aio.models.generate_content(
+            model=model,
+            contents=contents,
+            config=generate_content_config,
+        )
+    )
+    return _parse_response(response)
+
+
 def generate(image_path: str) -> None:
     """画像ファイルから部品を検出する
     Args:
@@ -1,8 +1,9 @@
-from google import genai
 from google.genai import types
 import os
 import json
-from utils import load_llm_settings, print_llm_usage_and_cost
+from utils import get_genai_client, load_llm_settings, print_llm_usage_and_cost
+from retry_policy import create_retry_policy
+from hedging import create_hedger
 
 llm_settings = load_llm_settings()
 func_settings = llm_settings["func_settings"]["parts_loc_estimate"]
@@ -11,31 +12,35 @@ temperature = func_settings["temperature"]
 top_p = func_settings["top_p"]
 seed = func_settings["seed"]
 max_output_tokens = func_settings["max_output_tokens"]
+# 1回の呼び出しの期限（秒）。応答が無いまま接続を保持し続けないようHTTPのタイムアウトとする
+timeout_sec = func_settings.get("timeout_sec")
+# 一時的なエラー（429・503等）の場合の再試行
+retry_policy = create_retry_policy("parts_loc_estimate", func_settings.get("retry"))
+# 応答が遅い場合に同一のリクエストを追加で送る（seed固定・temperature 0のため応答は同等）
+hedger = create_hedger("parts_loc_estimate", func_settings.get("hedge"))
 
 with open("sys_prompt/parts_loc_estimate.txt", "r", encoding="utf-8") as f:
     sys_prompt = f.read()
 
 
-def detect_parts_location_from_bytes(
-    image_bytes: bytes, mime_type: str, parts_list: list
-) -> list[dict]:
+def _http_options(timeout: float = None):
     """
-    画像バイト列・MIMEタイプ・部品リストから3D情報を推定するAIエージェント
-    Args:
-        image_bytes (bytes): 画像データ
-        mime_type (str): 画像のMIMEタイプ
-        parts_list (list): 部品リスト（Pythonリスト）
-    Returns:
-        list[dict]: 検出された部品の情報リスト
+    呼び出しの期限をHTTPのタイムアウト（ミリ秒）として設定する
+    timeoutにはステージの期限までの残り時間を指定し、設定値の期限より短い場合はそちらを用いる
     """
+    limits = [t for t in (timeout_sec, timeout) if t is not None]
+    if not limits:
+        return None
+    return types.HttpOptions(timeout=max(1, int(min(limits) * 1000)))
+
+
+def _build_request(
+    image_bytes: bytes, mime_type: str, parts_list: list, timeout: float = None
+):
+    """LLMへのリクエスト（contents, config）を組み立てる"""
     filtered_parts_list = [
         {k: v for k, v in part.items() if k not in ("material")} for part in parts_list
     ]
-    client = genai.Client(
-        vertexai=True,
-        project="plan-craft",
-        location="global",
-    )
     msg1_image1 = types.Part.from_bytes(
         data=image_bytes,
         mime_type=mime_type,
@@ -51,6 +56,7 @@ def detect_parts_location_from_bytes(
         top_p=top_p,
         seed=seed,
         max_output_tokens=max_output_tokens,
+        http_options=_http_options(timeout),
         system_instruction=[types.Part.from_text(text=sys_prompt)],
         response_mime_type="application/json",
         response_schema={
@@ -58,11 +64,11 @@ def detect_parts_location_from_bytes(
             "properties": {"response": {"type": "STRING"}},
         },
     )
-    response = client.models.generate_content(
-        model=model,
-        contents=contents,
-        config=generate_content_config,
-    )
+    return contents, generate_content_config
+
+
+def _parse_response(response) -> list[dict]:
+    """LLMのレスポンスから部品の3D情報リストを取り出す"""
     # トークン数・費用の出力
     if hasattr(response, "usage_metadata") and response.usage_metadata:
         prompt_tokens = getattr(response.usage_metadata, "prompt_token_count", None)
@@ -85,6 +91,52 @@ def detect_parts_location_from_bytes(
         )
 
 
+def detect_parts_location_from_bytes(
+    image_bytes: bytes, mime_type: str, parts_list: list, timeout: float = None
+) -> list[dict]:
+    """
+    画像バイト列・MIMEタイプ・部品リストから3D情報を推定するAIエージェント
+    Args:
+        image_bytes (bytes): 画像データ
+        mime_type (str): 画像のMIMEタイプ
+        parts_list (list): 部品リスト（Pythonリスト）
+        timeout (float, optional): 呼び出しの期限までの残り時間（秒）
+    Returns:
+        list[dict]: 検出された部品の情報リスト
+    """
+    client = get_genai_client()
+    contents, generate_content_config = _build_request(
+        image_bytes, mime_type, parts_list, timeout=timeout
+    )
+    response = retry_policy.call(
+        client.models.generate_content,
+        model=model,
+        contents=contents,
+        config=generate_content_config,
+    )
+    return _parse_response(response)
+
+
+async def detect_parts_location_from_bytes_async(
+    image_bytes: bytes, mime_type: str, parts_list: list, timeout: float = None
+) -> list[dict]:
+    """detect_parts_location_from_bytesの非同期版（応答待ちの間スレッドを占有しない）"""
+    client = get_genai_client()
+    contents, generate_content_config = _build_request(
+        image_bytes, mime_type, parts_list, timeout=timeout
+    )
+    response = await retry_policy.call_async(
+        lambda: hedger.run(
+            lambda: client.aio.models.generate_content(
+                model=model,
+                contents=contents,
+                config=generate_content_config,
+            )
+        )
+    )
+    return _parse_response(response)
+
+
 def generate(image_path, parts_list):
     ext = os.path.splitext(image_path)[1].lower()
     if ext in [".jpg", ".jpeg"]:
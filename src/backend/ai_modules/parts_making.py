@@ -1,7 +1,7 @@
-from google import genai
 from google.genai import types
 import json
-from utils import load_llm_settings, print_llm_usage_and_cost
+from utils import get_genai_client, load_llm_settings, print_llm_usage_and_cost
+from retry_policy import create_retry_policy
 
 llm_settings = load_llm_settings()
 func_settings = llm_settings["func_settings"]["parts_making"]
@@ -10,6 +10,10 @@ temperature = func_settings["temperature"]
 top_p = func_settings["top_p"]
 seed = func_settings["seed"]
 max_output_tokens = func_settings["max_output_tokens"]
+# 1回の呼び出しの期限（秒）。応答が無いまま接続を保持し続けないようHTTPのタイムアウトとする
+timeout_sec = func_settings.get("timeout_sec")
+# 一時的なエラー（429・503等）の場合の再試行
+retry_policy = create_retry_policy("parts_making", func_settings.get("retry"))
 
 with open("sys_prompt/parts_making.txt", "r", encoding="utf-8") as f:
     sys_prompt = f.read()
@@ -18,26 +22,28 @@ with open("user_prompt/parts_making.txt", "r", encoding="utf-8") as f:
     user_prompt = f.read()
 
 
-def generate_parts_making(parts_list: list[dict], parts3d: list[dict]) -> list[dict]:
-    """部品情報のdictから作成手順を生成するAIエージェント
-    Args:
-        parts_list(list): 部品情報のリスト
-        parts3d (list[dict]): 部品3D情報リスト
-    Returns:
-        list[dict]: 部品作成手順情報リスト
+def _http_options(timeout: float = None):
+    """
+    呼び出しの期限をHTTPのタイムアウト（ミリ秒）として設定する
+    timeoutにはステージの期限までの残り時間を指定し、設定値の期限より短い場合はそちらを用いる
     """
+    limits = [t for t in (timeout_sec, timeout) if t is not None]
+    if not limits:
+        return None
+    return types.HttpOptions(timeout=max(1, int(min(limits) * 1000)))
+
+
+def _build_request(parts_list: list[dict], parts3d: list[dict], timeout: float = None):
+    """LLMへのリクエスト（contents, config）を組み立てる"""
     # parts_listのmaterialとshape_noteをparts3dに追加
+    # （parts3dは組立手順生成と共有されるため、コピーに対して追加する）
     parts_info_map = {part["name"]: part for part in parts_list}
+    parts3d = [dict(part) for part in parts3d]
     for part in parts3d:
         info = parts_info_map.get(part["name"])
         if info:
             part["material"] = info.get("material")
             part["shape_note"] = info.get("shape_note")
-    client = genai.Client(
-        vertexai=True,
-        project="plan-craft",
-        location="global",
-    )
     msg_prompt = types.Part.from_text(text=user_prompt)
 
     msg_parts_json = types.Part.from_text(text=json.dumps(parts3d, ensure_ascii=False))
@@ -54,6 +60,7 @@ def generate_parts_making(parts_list: list[dict], parts3d: list[dict]) -> list[d
         top_p=top_p,
         seed=seed,
         max_output_tokens=max_output_tokens,
+        http_options=_http_options(timeout),
         response_mime_type="application/json",
         response_schema={
             "type": "OBJECT",
@@ -61,13 +68,11 @@ def generate_parts_making(parts_list: list[dict], parts3d: list[dict]) -> list[d
         },
         system_instruction=system_instruction,
     )
+    return contents, generate_content_config
 
-    response = client.models.generate_content(
-        model=model,
-        contents=contents,
-        config=generate_content_config,
-    )
 
+def _parse_response(response) -> list[dict]:
+    """LLMのレスポンスから部品作成手順情報リストを取り出す"""
     # トークン数・費用の出力
     if hasattr(response, "usage_metadata") and response.usage_metadata:
         prompt_tokens = getattr(response.usage_metadata, "prompt_token_count", None)
@@ -92,6 +97,48 @@ def generate_parts_making(parts_list: list[dict], parts3d: list[dict]) -> list[d
         )
 
 
+def generate_parts_making(
+    parts_list: list[dict], parts3d: list[dict], timeout: float = None
+) -> list[dict]:
+    """部品情報のdictから作成手順を生成するAIエージェント
+    Args:
+        parts_list(list): 部品情報のリスト
+        parts3d (list[dict]): 部品3D情報リスト
+        timeout (float, optional): 呼び出しの期限までの残り時間（秒）
+    Returns:
+        list[dict]: 部品作成手順情報リスト
+    """
+    client = get_genai_client()
+    contents, generate_content_config = _build_request(
+        parts_list, parts3d, timeout=timeout
+    )
+    response = retry_policy.call(
+        client.models.generate_content,
+        model=model,
+        contents=contents,
+        config=generate_content_config,
+    )
+    return _parse_response(response)
+
+
+async def generate_parts_making_async(
+    parts_list: list[dict], parts3d: list[dict], timeout: float = None
+) -> list[dict]:
+    """generate_parts_makingの非同期版（応答待ちの間スレッドを占有しない）"""
+    client = get_genai_client()
+    contents, generate_content_config = _build_request(
+        parts_list, parts3d, timeout=timeout
+    )
+    response = await retry_policy.call_async(
+        lambda: client.aio.models.generate_content(
+            model=model,
+            contents=contents,
+            config=generate_content_config,
+        )
+    )
+    return _parse_response(response)
+
+
 def generate_from_json(json_path: str) -> None:
     """JSONファイルから部品作成手順を生成し、標準出力に出力する
     Args:
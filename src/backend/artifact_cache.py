@@ -0,0 +1,150 @@
+import threading
+import time
+from collections import OrderedDict
+
+# 成果物（JSON）・アップロードされた画像のプロセス内キャッシュ
+# 成果物は書き込み後に変更されず、再生成された場合は世代番号が変わるため、
+# 保存先・パス・世代番号が一致する場合のみキャッシュした内容を返す
+
+
+class ArtifactCache:
+    """
+    成果物の内容を合計サイズの上限付きで保持するLRUキャッシュ
+    パスごとに最新の世代の内容のみを保持し、上限を超えた場合は最も長く参照されていないものから破棄する
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        """
+        Args:
+            max_bytes (int): 保持する内容の合計サイズの上限（バイト）
+        """
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # (保存先, パス) -> (世代番号, 内容)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def lookup(self, store, path: str):
+        """
+        Returns:
+            tuple[int, bytes] | None: キャッシュした世代番号と内容（無い場合None）
+        """
+        key = (store, path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def mark_hit(self):
+        """
+        キャッシュした内容が最新であった（再ダウンロードしなかった）ことを記録する
+        """
+        with self._lock:
+            self._stats["hits"] += 1
+
+    def put(self, store, path: str, generation: int, data: bytes):
+        """
+        ダウンロードした内容をキャッシュする（キャッシュミスとして記録する）
+        上限を超えるサイズの内容はキャッシュしない
+        """
+        with self._lock:
+            self._stats["misses"] += 1
+        if len(data) > self._max_bytes:
+            return
+        key = (store, path)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[1])
+            self._entries[key] = (generation, data)
+            self._bytes += len(data)
+            while self._bytes > self._max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self._stats["evictions"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+        stats["max_bytes"] = self._max_bytes
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+class ImageCache:
+    """
+    アップロードされた画像をplan_idごとに保持するキャッシュ（合計サイズ・保持期間の上限付き）
+    画像はplanごとに一度だけアップロードされ変更されないため、世代番号は確認しない
+    アップロードを受け付けたインスタンスでは、後続のステージが画像を再ダウンロードせずに利用できる
+    """
+
+    def __init__(self, max_bytes: int = 128 * 1024 * 1024, ttl_sec: float = 1800):
+        """
+        Args:
+            max_bytes (int): 保持する画像の合計サイズの上限（バイト）
+            ttl_sec (float): 画像を保持する期間（秒、後続のステージが完了するまでの目安）
+        """
+        self._max_bytes = max_bytes
+        self._ttl_sec = ttl_sec
+        self._lock = threading.Lock()
+        # plan_id -> (期限の時刻, 画像データ, MIMEタイプ)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+
+    def get(self, plan_id: str):
+        """
+        Returns:
+            tuple[bytes, str] | None: 画像データとMIMEタイプ（無い・期限切れの場合None）
+        """
+        with self._lock:
+            entry = self._entries.get(plan_id)
+            if entry is not None and entry[0] <= time.monotonic():
+                self._remove(plan_id)
+                self._stats["expired"] += 1
+                entry = None
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(plan_id)
+            self._stats["hits"] += 1
+            return entry[1], entry[2]
+
+    def put(self, plan_id: str, data: bytes, mime_type: str):
+        """
+        画像をキャッシュする（上限を超えるサイズの画像はキャッシュしない）
+        """
+        if len(data) > self._max_bytes:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._remove(plan_id)
+            for key in [k for k, entry in self._entries.items() if entry[0] <= now]:
+                self._remove(key)
+                self._stats["expired"] += 1
+            self._entries[plan_id] = (now + self._ttl_sec, data, mime_type)
+            self._bytes += len(data)
+            while self._bytes > self._max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def _remove(self, plan_id: str):
+        entry = self._entries.pop(plan_id, None)
+        if entry is not None:
+            self._bytes -= len(entry[1])
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+        stats["max_bytes"] = self._max_bytes
+        stats["ttl_sec"] = self._ttl_sec
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,74 @@
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud import storage
+from storage_backend import get_gcs_client
+from utils import GCS_BUCKET_NAME
+
+# GCSクライアントの生成方法による1リクエストあたりの処理時間の比較
+# per_call: 呼び出しごとにstorage.Client()を生成する（共有クライアント導入前の方式）
+# shared: プロセス内で共有するクライアント（storage_backend.get_gcs_client）
+# 実行（src/backendで）: python -m benchmarks.gcs_client --blob {plan_id}/status.json
+# （環境変数STORAGE_EMULATOR_HOSTを指定した場合はGCSのエミュレータを計測する）
+#
+# 計測結果（--requests 300、GCSのJSON APIに応答するローカルのエミュレータ（HTTP・認証なし）に対して計測）
+#   --threads 1: per_call mean=5.6ms p50=4.8ms p95=9.1ms / shared mean=1.8ms p50=1.8ms p95=1.9ms
+#   --threads 8: per_call mean=50.0ms p50=29.9ms p95=68.6ms / shared mean=17.7ms p50=17.2ms p95=28.0ms
+# エミュレータではTLS接続の確立・アクセストークンの取得が発生しないため、
+# 実際のGCSではper_callの差はこれより大きくなる（実際のGCSに対する計測値は未取得）
+
+
+def per_call_exists(bucket_name: str, blob_path: str) -> bool:
+    client = storage.Client()
+    return client.bucket(bucket_name).blob(blob_path).exists()
+
+
+def shared_exists(bucket_name: str, blob_path: str) -> bool:
+    return get_gcs_client().bucket(bucket_name).blob(blob_path).exists()
+
+
+def measure(fn, bucket_name: str, blob_path: str, requests: int, threads: int):
+    """
+    fnをrequests回呼び出し、1回ごとの処理時間（秒）のリストを返す
+    """
+
+    def timed(_):
+        started_at = time.perf_counter()
+        fn(bucket_name, blob_path)
+        return time.perf_counter() - started_at
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return list(pool.map(timed, range(requests)))
+
+
+def summarize(name: str, latencies: list[float]):
+    latencies = sorted(latencies)
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(
+        f"{name:>8}: mean={statistics.mean(latencies) * 1000:.1f}ms "
+        f"p50={statistics.median(latencies) * 1000:.1f}ms "
+        f"p95={p95 * 1000:.1f}ms n={len(latencies)}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="GCSクライアントの共有による効果の計測"
+    )
+    parser.add_argument("--bucket", default=GCS_BUCKET_NAME)
+    parser.add_argument("--blob", required=True, help="存在確認するオブジェクトのパス")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    # 初回の認証情報の取得・接続の確立は共有クライアントでは1回のみのため、計測から除く
+    shared_exists(args.bucket, args.blob)
+    for name, fn in (("per_call", per_call_exists), ("shared", shared_exists)):
+        summarize(
+            name, measure(fn, args.bucket, args.blob, args.requests, args.threads)
+        )
+
+
+if __name__ == "__main__":
+    main()
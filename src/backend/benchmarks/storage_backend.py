@@ -0,0 +1,47 @@
+import argparse
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.gcs_client import summarize
+from utils import get_storage, GCS_BUCKET_NAME
+
+# 保存先（StorageBackend）の操作ごとの1リクエストあたりの処理時間
+# 環境変数STORAGE_DIRを指定した場合はローカルディレクトリ、それ以外はGCSを計測する
+# 実行（src/backendで）: STORAGE_DIR=/tmp/craftmate python -m benchmarks.storage_backend
+
+
+def main():
+    parser = argparse.ArgumentParser(description="保存先の操作ごとの処理時間の計測")
+    parser.add_argument("--bucket", default=GCS_BUCKET_NAME)
+    parser.add_argument(
+        "--size", type=int, default=16 * 1024, help="オブジェクトのサイズ（バイト）"
+    )
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    store = get_storage(args.bucket)
+    prefix = f"_benchmark/{uuid.uuid4()}"
+    data = b"x" * args.size
+    paths = [f"{prefix}/{i}.json" for i in range(args.requests)]
+    operations = (
+        ("put", lambda path: store.put(path, data, content_type="application/json")),
+        ("stat", store.stat),
+        ("get", store.get),
+        ("exists", store.exists),
+        ("delete", store.delete),
+    )
+
+    def timed(fn, path):
+        started_at = time.perf_counter()
+        fn(path)
+        return time.perf_counter() - started_at
+
+    print(f"backend: {type(store).__name__}")
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        for name, fn in operations:
+            summarize(name, list(pool.map(lambda path: timed(fn, path), paths)))
+
+
+if __name__ == "__main__":
+    main()
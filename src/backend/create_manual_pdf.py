@@ -1,10 +1,15 @@
+import json
 import os
+import shutil
+import tempfile
 import plotly.graph_objects as go
 import plotly.io as pio
 import markdown
 from weasyprint import HTML
 import codecs
-from utils import get_gcs_client_and_bucket, load_json_from_gcs, GCS_BUCKET_NAME
+from utils import get_storage, load_artifact_bytes, GCS_BUCKET_NAME
+from pipeline import unlimited_process_memory
+from retry_policy import storage_retry
 import logging
 
 # fontToolsのログをWARNING以上に制限
@@ -23,26 +28,63 @@ if not logger.hasHandlers():
     logger.addHandler(handler)
     logger.setLevel(logging.INFO)
 
+# PDF生成の入力となるファイル
+MANUAL_PDF_INPUTS = ["parts3d.json", "parts_manual.json", "assembly_manual.json"]
+MANUAL_PDF_FILENAME = "design_document.pdf"
 
-def read_files(plan_id: str) -> dict:
+
+def get_manual_pdf_state(store, plan_id: str) -> str:
     """
-    plan_idに基づいてGCSから必要なファイルを読み込む
+    PDFの生成状況を判定する
     Args:
+        store (StorageBackend): 保存先
+        plan_id (str): プランID
+    Returns:
+        str: "missing_inputs"（入力未生成）, "up_to_date"（PDFが入力より新しい）,
+            "stale"（PDF未生成または入力より古い）のいずれか
+    """
+    input_updated = []
+    for filename in MANUAL_PDF_INPUTS:
+        info = store.stat(f"{plan_id}/{filename}")
+        if info is None:
+            logger.info(f"[manual_pdf] {filename} not found for {plan_id}")
+            return "missing_inputs"
+        input_updated.append(info.updated)
+    pdf_info = store.stat(f"{plan_id}/{MANUAL_PDF_FILENAME}")
+    if pdf_info is not None and pdf_info.updated >= max(input_updated):
+        return "up_to_date"
+    return "stale"
+
+
+def download_input_files(store, plan_id: str, output_folder: str):
+    """
+    PDF生成の入力となるJSONファイルを保存先から作業ディレクトリにダウンロードする
+    Args:
+        store (StorageBackend): 保存先
         plan_id (str): UUID形式のplan_id
+        output_folder (str): 作業ディレクトリ
+    """
+    for filename in MANUAL_PDF_INPUTS:
+        data = load_artifact_bytes(store, f"{plan_id}/{filename}")
+        if data is None:
+            raise FileNotFoundError(f"{plan_id}/{filename} not found")
+        with open(os.path.join(output_folder, filename), "wb") as f:
+            f.write(data)
+
+
+def read_input_files(output_folder: str) -> dict:
+    """
+    作業ディレクトリから入力のJSONファイルを読み込む
+    Args:
+        output_folder (str): 作業ディレクトリ
     Returns:
         dict: 読み込んだファイルの内容を含む辞書
     """
-    _, bucket = get_gcs_client_and_bucket(GCS_BUCKET_NAME)
-
-    parts3d = load_json_from_gcs(bucket, f"{plan_id}/parts3d.json")
-    parts_manual = load_json_from_gcs(bucket, f"{plan_id}/parts_manual.json")
-    assembly_manual = load_json_from_gcs(bucket, f"{plan_id}/assembly_manual.json")
-    return {
-        "plan_id": plan_id,
-        "parts3d": parts3d,
-        "parts_manual": parts_manual,
-        "assembly_manual": assembly_manual,
-    }
+    input_data = {}
+    for filename in MANUAL_PDF_INPUTS:
+        with open(os.path.join(output_folder, filename), "r", encoding="utf-8") as f:
+            input_data[os.path.splitext(filename)[0]] = json.load(f)
+    return input_data
 
 
 def save_parts3d_as_png(parts3d: list[dict], filename="/tmp/output.png"):
@@ -97,7 +139,9 @@ def save_parts3d_as_png(parts3d: list[dict], filename="/tmp/output.png"):
         margin=dict(r=10, l=10, b=10, t=10),
         showlegend=False,
     )
-    pio.write_image(fig, filename, format="png")
+    # kaleidoは初回（・異常終了後）にChromiumを起動するため、プロセスのメモリ上限を引き継がせない
+    with unlimited_process_memory():
+        pio.write_image(fig, filename, format="png")
 
 
 def save_each_part3d_as_png_grouped(
@@ -202,59 +246,27 @@ def convert_markdown_to_pdf(output_md_path, output_folder):
     return pdf_path
 
 
-def upload_pdf_to_gcs(pdf_path, bucket, plan_id):
+def upload_pdf_to_gcs(pdf_path, store, plan_id):
     """
-    PDFファイルをGCSにアップロード
+    PDFファイルを保存先にアップロード
     """
-    blob = bucket.blob(f"{plan_id}/design_document.pdf")
     with open(pdf_path, "rb") as f:
-        blob.upload_from_file(f, content_type="application/pdf")
-
-
-def cleanup_temp_files(
-    pdf_path,
-    output_md_path,
-    step_img_paths,
-    complete_img_path,
-    desc_to_img,
-    output_folder,
-):
-    """
-    一時ファイル・ディレクトリを削除
-    """
-    if os.path.exists(pdf_path):
-        os.remove(pdf_path)
-    if os.path.exists(output_md_path):
-        os.remove(output_md_path)
-    for _, img_path in step_img_paths:
-        if os.path.exists(img_path):
-            os.remove(img_path)
-    if os.path.exists(complete_img_path):
-        os.remove(complete_img_path)
-    for rel_img in desc_to_img.values():
-        img_path = os.path.join(output_folder, rel_img)
-        if os.path.exists(img_path):
-            os.remove(img_path)
-    try:
-        os.rmdir(output_folder)
-    except OSError:
-        pass
+        store.put(
+            f"{plan_id}/{MANUAL_PDF_FILENAME}", f.read(), content_type="application/pdf"
+        )
 
 
-def make_manual_pdf(plan_id: str, bucket_name: str):
+def render_manual_pdf(output_folder: str) -> str:
     """
-    GCSから3つのJSONファイルを取得し、Markdown整形→PDF保存まで行う
-    PDFはGCSの {plan_id}/design_document.pdf に保存される
+    作業ディレクトリの入力JSONから画像生成→Markdown整形→PDF変換を行う
+    CPU負荷が高いため、別プロセス（RenderProcessPool）から呼び出すことを想定する
     Args:
-        plan_id (str): プランID
-        bucket_name (str): GCSバケット名
+        output_folder (str): 入力JSONを配置した作業ディレクトリ
+    Returns:
+        str: 生成したPDFファイルのパス
     """
-    logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger("manual_pdf")
-    output_folder = f"/tmp/{plan_id}"
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-    input_data = read_files(plan_id)
+    input_data = read_input_files(output_folder)
     parts3d = input_data.get("parts3d", [])
     parts_manual = input_data.get("parts_manual", [])
     assembly_manual = input_data.get("assembly_manual", [])
@@ -276,20 +288,36 @@ def make_manual_pdf(plan_id: str, bucket_name: str):
     # PDF生成
     pdf_path = convert_markdown_to_pdf(output_md_path, output_folder)
     logger.info(f"PDFファイルを作成しました: {pdf_path}")
-    # GCSへアップロード
-    _, bucket = get_gcs_client_and_bucket(bucket_name)
-    upload_pdf_to_gcs(pdf_path, bucket, plan_id)
-    logger.info(f"PDFファイルをGCSに保存しました: {plan_id}/design_document.pdf")
-    # 一時ファイル削除
-    cleanup_temp_files(
-        pdf_path,
-        output_md_path,
-        step_img_paths,
-        complete_img_path,
-        desc_to_img,
-        output_folder,
-    )
-    # logger.info(f"一時ファイルを削除しました")
+    return pdf_path
+
+
+def make_manual_pdf(plan_id: str, bucket_name: str, render_pool=None):
+    """
+    GCSから3つのJSONファイルを取得し、Markdown整形→PDF保存まで行う
+    PDFはGCSの {plan_id}/design_document.pdf に保存される
+    Args:
+        plan_id (str): プランID
+        bucket_name (str): GCSバケット名
+        render_pool (RenderProcessPool, optional): PDFの生成を実行するプロセスプール
+            （省略時は呼び出し元のスレッドで生成する）
+    """
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger("manual_pdf")
+    # プロセス間では作業ディレクトリのパスのみを受け渡す
+    output_folder = tempfile.mkdtemp(prefix=f"{plan_id}-")
+    try:
+        store = get_storage(bucket_name)
+        download_input_files(store, plan_id, output_folder)
+        if render_pool is not None:
+            pdf_path = render_pool.run(render_manual_pdf, output_folder)
+        else:
+            pdf_path = render_manual_pdf(output_folder)
+        # GCSへアップロード
+        storage_retry.call(upload_pdf_to_gcs, pdf_path, store, plan_id)
+        logger.info(f"PDFファイルをGCSに保存しました: {plan_id}/design_document.pdf")
+    finally:
+        # 一時ファイル削除
+        shutil.rmtree(output_folder, ignore_errors=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,20 @@
+import os
+
+# gunicorn設定
+# inlineモードではパイプラインの状態（ワーカープール・ステータス）をプロセス内に保持するため、ワーカーは1プロセスとする
+# queueモードではステージをworker.pyが実行するため、GUNICORN_WORKERSでプロセス数を増やせる
+# SSE・long-pollの接続が他のリクエストを塞がないよう、スレッドワーカーで同時接続を受け付ける
+# SSEの同時接続数（pipeline_settings.jsonのevents.max_streams）はスレッド数より十分小さくし、
+# 残りのスレッドを通常のAPIとlong-poll（最大events.max_wait_sec）に残す
+bind = f":{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get("GUNICORN_WORKERS", "1"))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "32"))
+timeout = 120
+
+
+def post_worker_init(worker):
+    # アプリケーションを読み込んだワーカープロセスで、前回完了しなかったステージを再投入する
+    from main import resume_pipeline
+
+    resume_pipeline()
@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from request_budget import RequestBudget
+from retry_policy import retry_budget
+
+# LLM呼び出しのヘッジ（応答が遅い場合に同一のリクエストを追加で送り、先に返った応答を採用する）
+# 応答時間の分布の裾（p99）が長いステージで、遅い1回の呼び出しがplan全体の完了を遅らせないようにする
+
+
+class LatencyTracker:
+    """
+    直近の呼び出しの応答時間を保持し、パーセンタイルを返す
+    """
+
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency_sec: float):
+        with self._lock:
+            self._samples.append(latency_sec)
+
+    def count(self) -> int:
+        with self._lock:
+            return len(self._samples)
+
+    def percentile(self, p: float) -> float:
+        """
+        直近の応答時間のpパーセンタイル（秒）を返す（サンプルが無い場合None）
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * p / 100))
+        return samples[index]
+
+
+class Hedger:
+    """
+    非同期の呼び出しをヘッジ付きで実行する
+    直近の応答時間のpercentileパーセンタイルを過ぎても応答が無い場合に同一のリクエストを追加で送り、
+    先に成功した応答を採用してもう一方は取り消す
+    """
+
+    def __init__(
+        self,
+        name: str,
+        enabled: bool = False,
+        percentile: float = 95,
+        min_samples: int = 20,
+        window: int = 200,
+        max_extra_ratio: float = 0.1,
+        burst: float = 5,
+        budget: RequestBudget = None,
+    ):
+        """
+        Args:
+            name (str): 呼び出しの名前（統計の出力に用いる）
+            enabled (bool): ヘッジを行うか（Falseの場合も応答時間・統計は記録する）
+            percentile (float): ヘッジを送るまでの待ち時間とする応答時間のパーセンタイル
+            min_samples (int): ヘッジを行うのに必要な応答時間のサンプル数
+            window (int): 保持する応答時間のサンプル数
+            max_extra_ratio (float): 通常のリクエスト数に対する追加リクエスト数の上限の比率
+            burst (float): 一時的に許容する追加リクエスト数
+            budget (RequestBudget, optional): 再試行と共有する追加リクエストの上限
+                （指定した場合、トークンは呼び出しを包むRetryPolicyが加えるため、
+                ヘッジの送信時に消費するのみとし、max_extra_ratio・burstは用いない）
+        """
+        self.name = name
+        self._enabled = enabled
+        self._percentile = percentile
+        self._min_samples = min_samples
+        self._latency = LatencyTracker(window)
+        # 追加の費用を通常のリクエスト数に比例した数までに抑える
+        self._owns_budget = budget is None
+        self._budget = (
+            budget if budget is not None else RequestBudget(max_extra_ratio, burst)
+        )
+        self._lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "hedged": 0,
+            "hedge_won": 0,
+            "primary_won": 0,
+            "budget_exhausted": 0,
+        }
+
+    def hedge_delay(self):
+        """
+        ヘッジを送るまでの待ち時間（秒）を返す（ヘッジを行わない場合None）
+        """
+        if not self._enabled or self._latency.count() < self._min_samples:
+            return None
+        return self._latency.percentile(self._percentile)
+
+    async def run(self, make_request):
+        """
+        リクエストを実行する
+        Args:
+            make_request: 呼び出すたびに同一のリクエストを送るコルーチンを返す関数
+        Returns:
+            先に成功したリクエストの応答
+        """
+        self._count("requests")
+        if self._owns_budget:
+            self._budget.on_request()
+        started_at = time.monotonic()
+        primary = asyncio.ensure_future(make_request())
+        tasks = {primary}
+        try:
+            delay = self.hedge_delay()
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    if self._budget.try_acquire():
+                        self._count("hedged")
+                        logging.info(
+                            f"[hedging] {self.name}: no response in {delay:.1f}s, "
+                            "sent a hedged request"
+                        )
+                        tasks.add(asyncio.ensure_future(make_request()))
+                    else:
+                        self._count("budget_exhausted")
+            winner = await self._first_success(tasks)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+        if winner.exception() is None:
+            self._latency.record(time.monotonic() - started_at)
+        if len(tasks) > 1:
+            self._count("hedge_won" if winner is not primary else "primary_won")
+        return winner.result()
+
+    @staticmethod
+    async def _first_success(tasks: set):
+        """
+        最初に成功したタスクを返す（全て失敗した場合は最初に失敗したタスクを返す）
+        """
+        pending = set(tasks)
+        failed = None
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task
+                failed = failed or task
+        return failed
+
+    def _count(self, key: str):
+        with self._lock:
+            self._stats[key] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["enabled"] = self._enabled
+        stats["samples"] = self._latency.count()
+        stats["hedge_delay_sec"] = self.hedge_delay()
+        stats["hedge_win_rate"] = (
+            stats["hedge_won"] / stats["hedged"] if stats["hedged"] else 0.0
+        )
+        return stats
+
+
+_hedgers = {}
+
+
+def create_hedger(name: str, hedge_settings: dict = None) -> Hedger:
+    """
+    呼び出しの名前ごとのHedgerを生成する（llm_settings.jsonのfunc_settingsのhedgeを渡す）
+    ヘッジは再試行と同じ上限（retry_policy.retry_budget）を消費し、追加のリクエストの合計を抑える
+    """
+    hedger = Hedger(name, budget=retry_budget, **(hedge_settings or {}))
+    _hedgers[name] = hedger
+    return hedger
+
+
+def hedge_stats() -> dict:
+    """
+    呼び出しの名前ごとのヘッジの統計（ヘッジの送信数・ヘッジが先に返った回数等）を返す
+    """
+    return {name: hedger.stats() for name, hedger in _hedgers.items()}
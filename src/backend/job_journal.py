@@ -0,0 +1,109 @@
+import json
+import logging
+import threading
+from datetime import datetime, timezone
+from utils import get_storage, upload_json_to_gcs, GCS_BUCKET_NAME
+
+# ジャーナルの保存先（GCSのプレフィックス）
+JOURNAL_PREFIX = "_journal"
+
+
+class JobJournal:
+    """
+    ステージの投入・開始・完了を永続化するジャーナル
+    保存先（GCS、またはSTORAGE_DIR指定時はローカルディレクトリ）の _journal/{plan_id}/{stage}.json にエントリを保存する
+    完了したジョブのエントリは削除し、未完了のジョブのみを保持する
+    SingleFlightRegistryの通知先として利用する
+    """
+
+    def __init__(self, bucket_name: str = None):
+        self._bucket_name = bucket_name or GCS_BUCKET_NAME
+        self._lock = threading.Lock()
+        self._attempts = {}
+
+    def _store(self):
+        return get_storage(self._bucket_name)
+
+    # SingleFlightRegistryからの通知
+    def stage_queued(self, plan_id: str, stage: str):
+        self._write(plan_id, stage, self._entry(plan_id, stage, "enqueued"))
+
+    def stage_started(self, plan_id: str, stage: str):
+        self._write(plan_id, stage, self._entry(plan_id, stage, "started"))
+
+    def stage_finished(
+        self,
+        plan_id: str,
+        stage: str,
+        error: str = None,
+        produced: bool = True,
+        cancelled: bool = False,
+        timed_out: bool = False,
+    ):
+        self.discard(plan_id, stage)
+
+    def unfinished(self) -> list[dict]:
+        """
+        未完了のジョブのエントリ一覧を返す
+        """
+        return self._list()
+
+    def mark_resumed(self, entry: dict) -> int:
+        """
+        再投入するジョブの試行回数を加算して返す
+        """
+        attempts = entry.get("attempts", 0) + 1
+        with self._lock:
+            self._attempts[(entry["plan_id"], entry["stage"])] = attempts
+        return attempts
+
+    def discard(self, plan_id: str, stage: str):
+        """
+        ジョブのエントリを削除する
+        """
+        with self._lock:
+            self._attempts.pop((plan_id, stage), None)
+        self._delete(plan_id, stage)
+
+    def _entry(self, plan_id: str, stage: str, state: str) -> dict:
+        with self._lock:
+            attempts = self._attempts.get((plan_id, stage), 0)
+        return {
+            "plan_id": plan_id,
+            "stage": stage,
+            "state": state,
+            "attempts": attempts,
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+        }
+
+    def _write(self, plan_id: str, stage: str, entry: dict):
+        upload_json_to_gcs(
+            self._store(), f"{JOURNAL_PREFIX}/{plan_id}/{stage}.json", entry
+        )
+
+    def _delete(self, plan_id: str, stage: str):
+        path = f"{JOURNAL_PREFIX}/{plan_id}/{stage}.json"
+        try:
+            self._store().delete(path)
+        except Exception as e:
+            # ジャーナルの削除失敗はステージの結果に影響させない
+            logging.info(f"[job_journal] Skip deleting {path}: {e}")
+
+    def _list(self) -> list[dict]:
+        store = self._store()
+        entries = []
+        for info in store.list(f"{JOURNAL_PREFIX}/"):
+            try:
+                data = store.get(info.name)
+                if data is not None:
+                    entries.append(json.loads(data))
+            except Exception as e:
+                logging.warning(f"[job_journal] Broken entry {info.name}: {e}")
+        return entries
+
+
+def create_job_journal(bucket_name: str = None) -> JobJournal:
+    """
+    バケットの保存先（utils.get_storage）に保存するジャーナルを返す
+    """
+    return JobJournal(bucket_name)
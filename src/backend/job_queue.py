@@ -0,0 +1,121 @@
+import json
+import logging
+from datetime import datetime, timezone
+from utils import (
+    get_storage,
+    upload_json_if_generation_match,
+    delete_blob_if_generation_match,
+    GCS_BUCKET_NAME,
+)
+
+# ジョブキューの保存先（GCSのプレフィックス）
+QUEUE_PREFIX = "_queue"
+
+
+class JobQueue:
+    """
+    Webサーバからワーカーへステージの実行を依頼するジョブキュー
+    保存先（GCS、またはSTORAGE_DIR指定時はローカルディレクトリ）の _queue/{stage}/{plan_id}.json をジョブとする
+    ジョブはplan_id・ステージのみを持ち、入力はワーカーが保存先から読み込む
+    同一plan_id・ステージのジョブは待機中に1件のみ保持する
+    投入は存在しない場合のみ作成（if_generation_match=0）、取り出しは世代を指定した削除で行う
+    """
+
+    def __init__(self, bucket_name: str = None):
+        self._bucket_name = bucket_name or GCS_BUCKET_NAME
+
+    def _store(self):
+        return get_storage(self._bucket_name)
+
+    def enqueue(self, plan_id: str, stage: str) -> bool:
+        """
+        ジョブを投入する
+        Returns:
+            bool: 投入した場合True（同一のジョブが待機中の場合False）
+        """
+        entry = {
+            "plan_id": plan_id,
+            "stage": stage,
+            "enqueued_at": datetime.now(timezone.utc).isoformat(),
+        }
+        generation = upload_json_if_generation_match(
+            self._store(), f"{QUEUE_PREFIX}/{stage}/{plan_id}.json", entry, 0
+        )
+        return generation is not None
+
+    def claim(self, stages) -> dict:
+        """
+        指定ステージのジョブのうち最も古いものを取り出す
+        複数のワーカーが同時に取り出した場合も、1件のジョブは1つのワーカーにのみ渡る
+        Args:
+            stages (list[str]): 取り出すステージ名
+        Returns:
+            dict | None: ジョブのエントリ（ジョブが無い場合None）
+        """
+        store = self._store()
+        infos = []
+        for stage in stages:
+            infos.extend(store.list(f"{QUEUE_PREFIX}/{stage}/"))
+        # ジョブは作成のみで更新しないため、更新日時を投入順とする
+        for info in sorted(infos, key=lambda i: i.updated):
+            data = store.get(info.name, if_generation_match=info.generation)
+            if data is None:
+                continue
+            try:
+                entry = json.loads(data)
+            except ValueError as e:
+                logging.warning(f"[job_queue] Broken entry {info.name}: {e}")
+                delete_blob_if_generation_match(store, info.name, info.generation)
+                continue
+            if not delete_blob_if_generation_match(store, info.name, info.generation):
+                # 他のワーカーが先に取り出した
+                continue
+            return entry
+        return None
+
+    def pending_count(self, stage: str) -> int:
+        """
+        待機中のジョブ数を返す
+        """
+        return len(self._store().list(f"{QUEUE_PREFIX}/{stage}/"))
+
+    def remove(self, plan_id: str, stage: str) -> bool:
+        """
+        待機中のジョブを取り除く（planの取り消し時に利用する）
+        Returns:
+            bool: 取り除いた場合True（待機中のジョブが無い場合False）
+        """
+        return self._store().delete(f"{QUEUE_PREFIX}/{stage}/{plan_id}.json")
+
+
+class QueueWaitEstimator:
+    """
+    ジョブキューの待機中のジョブ数から、ステージの待ち時間を見積もる（queueモードのWebサーバ用）
+    Webサーバのエグゼキュータはステージを実行しないため、待ち状況はジョブキューから求める
+    """
+
+    def __init__(self, queue: JobQueue, stage_settings: dict):
+        """
+        Args:
+            queue (JobQueue): ワーカーが取り出すジョブキュー
+            stage_settings (dict): ステージ名をキーとした設定
+                （max_workers: ワーカー1インスタンスあたりの同時実行数, expected_run_sec: 実行時間の見込み）
+        """
+        self._queue = queue
+        self._stage_settings = stage_settings
+
+    def estimated_wait(self, stage: str) -> float:
+        """
+        新たに投入したジョブが取り出されるまでの待ち時間（秒）を見積もる
+        （待機中のジョブを同時実行数ずつ順に実行するものとする）
+        """
+        conf = self._stage_settings[stage]
+        pending = self._queue.pending_count(stage)
+        return pending / conf.get("max_workers", 1) * conf.get("expected_run_sec", 60)
+
+
+def create_job_queue(bucket_name: str = None) -> JobQueue:
+    """
+    バケットの保存先（utils.get_storage）をジョブキューとして返す
+    """
+    return JobQueue(bucket_name)
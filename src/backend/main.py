@@ -6,35 +6,64 @@ from flask import (
     send_file,
     send_from_directory,
     make_response,
+    redirect,
+    stream_with_context,
 )
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 import uuid
-from google.cloud import storage
-from ai_modules.parts_detection import detect_parts_from_bytes
-from ai_modules.parts_loc_estimate import detect_parts_location_from_bytes
-from ai_modules.parts_making import generate_parts_making
-from ai_modules.create_assembly_steps import generate_assembly_manual
-import threading
 import io
 import json
 import logging
 import base64
+import functools
+import math
 import os
+import threading
+import time
 from utils import (
-    get_gcs_client_and_bucket,
-    gcs_blob_exists,
+    get_storage,
     load_json_from_gcs,
+    load_plan_image,
+    build_image_metadata,
+    upload_json_to_gcs,
     error_response,
     require_valid_uuid,
     parts3d_to_obj,
     allowed_file,
     upload_to_gcs,
+    artifact_cache,
+    image_cache,
     GCS_BUCKET_NAME,
+    IMAGE_METADATA_FILENAME,
     require_bearer_token,
 )
-from create_manual_pdf import make_manual_pdf
+from job_queue import create_job_queue, QueueWaitEstimator
+from hedging import hedge_stats
+from retry_policy import retry_stats, storage_retry
+from plan_status import (
+    PlanStatusStore,
+    STAGE_ARTIFACTS,
+    TERMINAL_STATES,
+    with_ready_flags,
+    is_pipeline_finished,
+)
+from pipeline import AdmissionController, StageCancelledError, StageQueueFullError
+import pipeline_stages
+from pipeline_stages import (
+    pipeline_settings,
+    stage_executor,
+    trigger_parts_list,
+    trigger_parts3d,
+    trigger_parts_manual,
+    trigger_assembly_manual,
+    submit_manual_pdf,
+    resume_unfinished_jobs,
+    cancel_plan,
+    EAGER_PIPELINE,
+    PIPELINE_MODE,
+)
 import google.cloud.logging
 from google.cloud.logging.handlers import CloudLoggingHandler
 
@@ -48,9 +77,25 @@ limiter = Limiter(
 )
 
 
+BUSY_MESSAGE = "サーバが混雑しています。時間をおいて再度お試しください"
+CANCELLED_MESSAGE = "指定plan_idは取り消されています"
+STREAMS_BUSY_MESSAGE = (
+    "ステータス通知の同時接続数が上限に達しています。"
+    "/api/<plan_id>/status?wait=<秒>による取得をご利用ください"
+)
+
 MAX_CONTENT_LENGTH = 10 * 1024 * 1024  # 10MB
 app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
 
+# PDFの返却方法
+#   stream: サーバ経由で逐次返却する
+#   redirect: 署名付きURLへリダイレクトする（302）
+#   url: 署名付きURLをJSONで返す
+# 署名付きURLに対応しない保存先（ローカルディレクトリ）では、いずれの場合もstreamとする
+PDF_DOWNLOAD_MODE = os.environ.get("PDF_DOWNLOAD_MODE", "stream")
+# 署名付きURLの有効期間（秒）
+SIGNED_URL_TTL_SEC = int(os.environ.get("SIGNED_URL_TTL_SEC", "300"))
+
 # Cloud Loggingのセットアップ
 client = google.cloud.logging.Client()
 handler = CloudLoggingHandler(client)
@@ -59,6 +104,29 @@ logging.getLogger().setLevel(logging.INFO)
 app.logger.addHandler(handler)
 app.logger.setLevel(logging.INFO)
 
+# long-poll・Server-Sent Eventsの待機時間設定
+EVENTS_SETTINGS = pipeline_settings["events"]
+if PIPELINE_MODE == "queue":
+    # ステージはワーカーが実行するため、ジョブキューへの投入とGCS上の状態の参照のみ行う
+    job_queue = create_job_queue(GCS_BUCKET_NAME)
+    status_store = PlanStatusStore(
+        GCS_BUCKET_NAME,
+        shared=True,
+        poll_interval_sec=EVENTS_SETTINGS["poll_interval_sec"],
+    )
+    # 待ち時間はジョブキューの待機中のジョブ数から見積もる
+    wait_estimator = QueueWaitEstimator(job_queue, pipeline_settings["stages"])
+else:
+    job_queue = None
+    status_store = pipeline_stages.status_store
+    wait_estimator = stage_executor
+# SSEの接続は終了までgunicornのスレッドを1つ占有するため、同時接続数をスレッド数より小さく制限する
+stream_slots = threading.BoundedSemaphore(EVENTS_SETTINGS["max_streams"])
+# 待ち時間の見積もりが上限を超える場合、パイプラインを起動するAPIは429を返す
+admission_controller = AdmissionController(
+    wait_estimator, pipeline_settings["admission"]["max_estimated_wait_sec"]
+)
+
 
 @app.route("/", methods=["GET"])
 def root():
@@ -73,115 +141,100 @@ def manifest():
     return response
 
 
-# 21_部品検出
-def detect_and_save_parts_list(image_bytes, mime_type, plan_id, bucket_name):
-    try:
-        logging.info(f"[parts_list] Detection start for plan_id={plan_id}")
-        parts_list = detect_parts_from_bytes(image_bytes, mime_type)
-        # GCSに保存
-        _, bucket = get_gcs_client_and_bucket(bucket_name)
-        blob = bucket.blob(f"{plan_id}/parts_list.json")
-        blob.upload_from_string(
-            data=json.dumps(parts_list, ensure_ascii=False, indent=2),
-            content_type="application/json",
-        )
-        logging.info(
-            f"[parts_list] Uploaded to gs://{bucket_name}/{plan_id}/parts_list.json"
-        )
-    except Exception as e:
-        logging.error(f"[parts_list detection error] {e}")
-
-
-# 22_部品3Dモデル作成
-def estimate_and_save_parts3d(image_bytes, mime_type, parts_list, plan_id, bucket_name):
-    try:
-        logging.info(f"[parts3d] Estimation start for plan_id={plan_id}")
-        parts3d = detect_parts_location_from_bytes(image_bytes, mime_type, parts_list)
-        # GCSに保存（3D情報）
-        _, bucket = get_gcs_client_and_bucket(bucket_name)
-        blob = bucket.blob(f"{plan_id}/parts3d.json")
-        blob.upload_from_string(
-            data=json.dumps(parts3d, ensure_ascii=False, indent=2),
-            content_type="application/json",
-        )
-        logging.info(f"[parts3d] Uploaded to gs://{bucket_name}/{plan_id}/parts3d.json")
-        create_and_save_assembly_manual(
-            parts3d, image_bytes, mime_type, plan_id, bucket_name
-        )
-    except Exception as e:
-        logging.error(f"[parts3d estimation error] {e}")
-
-
-# 23_部品作成手順生成
-def create_and_save_parts_manual(parts_list, parts3d, plan_id, bucket_name):
-    """parts3dから部品作成手順を生成し、Cloud Storageに保存する"""
-    try:
-        logging.info(f"[parts_manual] Generating for plan_id={plan_id}")
-        parts_manual = generate_parts_making(parts_list, parts3d)
-        client = storage.Client()
-        bucket = client.bucket(bucket_name)
-        blob = bucket.blob(f"{plan_id}/parts_manual.json")
-        blob.upload_from_string(
-            data=json.dumps(parts_manual, ensure_ascii=False, indent=2),
-            content_type="application/json",
-        )
-        logging.info(
-            f"[parts_manual] Uploaded to gs://{bucket_name}/{plan_id}/parts_manual.json"
-        )
-    except Exception as e:
-        logging.error(f"[parts_manual error] {e}")
+def busy_response(code, *stages):
+    """
+    混雑時のエラーレスポンスを返す（Retry-Afterにステージの見積もり待ち時間を設定する）
+    """
+    retry_after = max(
+        1, math.ceil(max(wait_estimator.estimated_wait(stage) for stage in stages))
+    )
+    body, code = error_response(BUSY_MESSAGE, code)
+    return body, code, {"Retry-After": str(retry_after)}
 
 
-# 24_組立手順生成
-def create_and_save_assembly_manual(
-    parts3d, image_bytes, mime_type, plan_id, bucket_name
-):
+def require_pipeline_capacity(*stages):
     """
-    parts3d, 画像データ, mime_typeから組立手順を生成し、Cloud Storageに保存する
+    パイプラインの待ち時間が上限を超えている場合に429を返すデコレータ
+    対象ステージが投入済み・完了済み・取り消し済みのplanと、eagerモードで参照のみ行うAPIは判定しない
     """
 
-    try:
-        logging.info(f"[assembly_manual] Generating for plan_id={plan_id}")
-        assembly_manual = generate_assembly_manual(image_bytes, mime_type, parts3d)
-        _, bucket = get_gcs_client_and_bucket(bucket_name)
-        blob = bucket.blob(f"{plan_id}/assembly_manual.json")
-        blob.upload_from_string(
-            data=json.dumps(assembly_manual, ensure_ascii=False, indent=2),
-            content_type="application/json",
-        )
-        logging.info(
-            f"[assembly_manual] Uploaded to gs://{bucket_name}/{plan_id}/assembly_manual.json"
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            plan_id = kwargs.get("plan_id", args[0] if args else None)
+            if plan_id is not None:
+                if EAGER_PIPELINE:
+                    return func(*args, **kwargs)
+                record = status_store.get(plan_id) or {"stages": {}}
+                states = [
+                    record["stages"].get(stage, {}).get("state") for stage in stages
+                ]
+                if all(
+                    state in ("queued", "running", "done", "cancelled")
+                    for state in states
+                ):
+                    return func(*args, **kwargs)
+            retry_after = admission_controller.retry_after(stages)
+            if retry_after:
+                logging.warning(
+                    f"[admission] Rejected {func.__name__}: retry after {retry_after}s"
+                )
+                body, code = error_response(BUSY_MESSAGE, 429)
+                return body, code, {"Retry-After": str(retry_after)}
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def enqueue_stage(plan_id, stage, check_status=True):
+    """
+    ステージのジョブをジョブキューに投入する（queueモード）
+    ステージの状態が無い・失敗した場合のみ投入する（投入済み・実行中・完了済みの場合は投入しない）
+    同一plan_id・ステージのジョブが待機中であれば投入しない
+    Args:
+        check_status (bool): 状態を確認するか（アップロード直後の新規planはFalse）
+    Raises:
+        StageQueueFullError: 待機中のジョブ数が上限に達している場合
+        StageCancelledError: planが取り消されている場合
+    """
+    if check_status:
+        record = status_store.get(plan_id) or {"stages": {}}
+        if "cancelled_at" in record:
+            raise StageCancelledError(f"plan_id={plan_id}は取り消されています")
+        state = record["stages"].get(stage, {}).get("state")
+        if state in ("queued", "running", "done"):
+            return
+    max_queue = pipeline_settings["stages"][stage].get("max_queue", 10)
+    if job_queue.pending_count(stage) >= max_queue:
+        raise StageQueueFullError(
+            f"ステージ{stage}のジョブキューが上限({max_queue})に達しています"
         )
-        return assembly_manual
-    except Exception as e:
-        logging.error(f"[assembly_manual error] {e}")
-        return None
+    if job_queue.enqueue(plan_id, stage):
+        logging.info(f"[job_queue] Enqueued {stage} for {plan_id}")
 
 
-def try_create_manual_pdf(plan_id):
+def start_manual_pdf(plan_id):
     """
-    parts_manual.jsonとassembly_manual.jsonが両方存在する場合のみPDF生成
+    PDF生成を起動する（PDFは任意のため、混雑時はログのみ出力して諦める）
     """
-    _, bucket = get_gcs_client_and_bucket()
-    parts_manual_exists = gcs_blob_exists(bucket, f"{plan_id}/parts_manual.json")
-    if not parts_manual_exists:
-        logging.info(f"[manual_pdf] parts_manual.json not found for {plan_id}")
-        return None
-    assembly_manual_exists = gcs_blob_exists(bucket, f"{plan_id}/assembly_manual.json")
-    if not assembly_manual_exists:
-        logging.info(f"[manual_pdf] assembly_manual.json not found for {plan_id}")
-        return None
+    if PIPELINE_MODE != "queue":
+        submit_manual_pdf(plan_id)
+        return
     try:
-        make_manual_pdf(plan_id, GCS_BUCKET_NAME)
-        logging.info(f"[manual_pdf] PDF生成処理を実行しました: {plan_id}")
-    except Exception as e:
-        logging.error(f"[manual_pdf] PDF生成処理でエラー: {e}")
+        enqueue_stage(plan_id, "manual_pdf")
+    except StageQueueFullError as e:
+        logging.warning(f"[manual_pdf] {e}")
+    except StageCancelledError as e:
+        logging.info(f"[manual_pdf] {e}")
 
 
 # 01_画像アップロード
 @app.route("/api/upload", methods=["POST"])
 @require_bearer_token
 @limiter.limit("20 per day")
+@require_pipeline_capacity("parts_list")
 def upload_file():
     if "file" not in request.files:
         return jsonify({"error": "ファイルが添付されていません"}), 400
@@ -196,21 +249,39 @@ def upload_file():
     plan_id = str(uuid.uuid4())
     ext = filename.rsplit(".", 1)[1].lower()
     gcs_filename = f"{plan_id}/image.{ext}"
+    file_bytes = file.read()
+    try:
+        image_metadata = build_image_metadata(file_bytes, gcs_filename)
+    except ValueError as e:
+        logging.warning(f"[upload] {e}")
+        return jsonify({"error": "画像ファイルを読み込めません"}), 400
+    mime_type = image_metadata["mime_type"]
     try:
         # ファイルをGCSに保存
-        file_bytes = file.read()
-        file_stream = io.BytesIO(file_bytes)
-        upload_to_gcs(file_stream, gcs_filename, file.content_type)
+        # 再試行のたびに先頭から読み込むよう、ストリームは呼び出しごとに作成する
+        storage_retry.call(
+            lambda: upload_to_gcs(io.BytesIO(file_bytes), gcs_filename, mime_type)
+        )
+        # 後続のステージは画像の保存先・MIMEタイプをメタデータから解決する
+        storage_retry.call(
+            upload_json_to_gcs,
+            get_storage(),
+            f"{plan_id}/{IMAGE_METADATA_FILENAME}",
+            image_metadata,
+        )
         logging.info(f"[upload] Image uploaded: {gcs_filename}")
+        # 後続のステージ（部品3Dモデル作成・組立手順生成）は再ダウンロードせずに利用する
+        image_cache.put(plan_id, file_bytes, mime_type)
         # 部品検出（2D）はバックグラウンドで実行
-        threading.Thread(
-            target=detect_and_save_parts_list,
-            args=(file_bytes, file.content_type, plan_id, GCS_BUCKET_NAME),
-            daemon=True,
-        ).start()
-        logging.info(
-            f"[upload] Started parts_list detection thread for plan_id={plan_id}"
-        )
+        if PIPELINE_MODE == "queue":
+            enqueue_stage(plan_id, "parts_list", check_status=False)
+        else:
+            status_store.create(plan_id)
+            trigger_parts_list(file_bytes, mime_type, plan_id, GCS_BUCKET_NAME)
+        logging.info(f"[upload] Queued parts_list detection for plan_id={plan_id}")
+    except StageQueueFullError as e:
+        logging.warning(f"[upload] {e}")
+        return busy_response(503, "parts_list")
     except Exception as e:
         logging.error(f"[upload error] {e}")
         return jsonify({"error": "GCS保存中にエラーが発生しました"}), 500
@@ -222,8 +293,7 @@ def upload_file():
 @require_bearer_token
 @require_valid_uuid
 def parts_ready(plan_id):
-    _, bucket = get_gcs_client_and_bucket()
-    ready = gcs_blob_exists(bucket, f"{plan_id}/parts_list.json")
+    ready = status_store.is_done(plan_id, "parts_list")
     logging.info(f"[parts_ready] Checking parts_list for {plan_id}: {ready}")
     return jsonify({"ready": ready}), 200
 
@@ -233,34 +303,40 @@ def parts_ready(plan_id):
 @require_bearer_token
 @require_valid_uuid
 @limiter.limit("15 per day")
+@require_pipeline_capacity("parts3d")
 def get_parts_list(plan_id):
-    _, bucket = get_gcs_client_and_bucket()
-    parts_list = load_json_from_gcs(bucket, f"{plan_id}/parts_list.json")
+    store = get_storage()
+    parts_list = load_json_from_gcs(store, f"{plan_id}/parts_list.json")
     if parts_list is None:
         logging.warning(f"[get_parts_list] parts_list.json not found for {plan_id}")
         return error_response("部品リストがまだ生成されていません", 404)
-    # 画像ファイルもGCSから取得
-    image_blob = None
-    ext_found = None
-    for ext in ["jpg", "jpeg", "png"]:
-        img_blob = bucket.blob(f"{plan_id}/image.{ext}")
-        if img_blob.exists():
-            image_blob = img_blob
-            ext_found = ext
-            break
-    if image_blob is None:
-        logging.warning(f"[get_parts_list] image file not found for {plan_id}")
-        return error_response("画像ファイルが見つかりません", 404)
-    image_bytes = image_blob.download_as_bytes()
-    mime_type = f"image/{ext_found}"
-    threading.Thread(
-        target=estimate_and_save_parts3d,
-        args=(image_bytes, mime_type, parts_list, plan_id, GCS_BUCKET_NAME),
-        daemon=True,
-    ).start()
-    logging.info(
-        f"[get_parts_list] Started parts3d estimation thread for plan_id={plan_id}"
-    )
+    # eagerモードでは部品検出完了時に起動済みのため、結果の返却のみ行う
+    if not EAGER_PIPELINE:
+        try:
+            if PIPELINE_MODE == "queue":
+                # 入力はワーカーがGCSから読み込む
+                enqueue_stage(plan_id, "parts3d")
+            else:
+                # 画像ファイルもGCSから取得
+                image = load_plan_image(store, plan_id)
+                if image is None:
+                    logging.warning(
+                        f"[get_parts_list] image file not found for {plan_id}"
+                    )
+                    return error_response("画像ファイルが見つかりません", 404)
+                image_bytes, mime_type = image
+                trigger_parts3d(
+                    image_bytes, mime_type, parts_list, plan_id, GCS_BUCKET_NAME
+                )
+        except StageQueueFullError as e:
+            logging.warning(f"[get_parts_list] {e}")
+            return busy_response(503, "parts3d")
+        except StageCancelledError as e:
+            logging.info(f"[get_parts_list] {e}")
+            return error_response(CANCELLED_MESSAGE, 409)
+        logging.info(
+            f"[get_parts_list] Triggered parts3d estimation for plan_id={plan_id}"
+        )
     parts_list_simple = [
         {"part_id": i + 1, "part_name": parts["name"], "size": parts["size"]}
         for i, parts in enumerate(parts_list)
@@ -273,8 +349,7 @@ def get_parts_list(plan_id):
 @require_bearer_token
 @require_valid_uuid
 def model_ready(plan_id):
-    _, bucket = get_gcs_client_and_bucket()
-    ready = gcs_blob_exists(bucket, f"{plan_id}/parts3d.json")
+    ready = status_store.is_done(plan_id, "parts3d")
     logging.info(f"[model_ready] Checking parts3d for {plan_id}: {ready}")
     return jsonify({"ready": ready}), 200
 
@@ -284,41 +359,44 @@ def model_ready(plan_id):
 @require_bearer_token
 @require_valid_uuid
 @limiter.limit("20 per day")
+@require_pipeline_capacity("parts_manual", "assembly_manual")
 def get_model_obj(plan_id):
-    _, bucket = get_gcs_client_and_bucket()
-    parts_list = load_json_from_gcs(bucket, f"{plan_id}/parts_list.json")
+    store = get_storage()
+    parts_list = load_json_from_gcs(store, f"{plan_id}/parts_list.json")
     if parts_list is None:
         logging.warning(f"[get_model_obj] parts_list.json not found for {plan_id}")
         return error_response("部品リストがまだ生成されていません", 404)
-    parts3d = load_json_from_gcs(bucket, f"{plan_id}/parts3d.json")
+    parts3d = load_json_from_gcs(store, f"{plan_id}/parts3d.json")
     if parts3d is None:
         logging.warning(f"[get_model_obj] parts3d.json not found for {plan_id}")
         return error_response("3D部品位置がまだ生成されていません", 404)
     obj_text = parts3d_to_obj(parts3d)
-    # 画像ファイルもGCSから取得
-    image_blob = None
-    ext_found = None
-    for ext in ["jpg", "jpeg", "png"]:
-        img_blob = bucket.blob(f"{plan_id}/image.{ext}")
-        if img_blob.exists():
-            image_blob = img_blob
-            ext_found = ext
-            break
-    if image_blob is None:
-        logging.warning(f"[get_model_obj] image file not found for {plan_id}")
-        return error_response("画像ファイルが見つかりません", 404)
-    image_bytes = image_blob.download_as_bytes()
-    mime_type = f"image/{ext_found}"
-    threading.Thread(
-        target=create_and_save_parts_manual,
-        args=(parts_list, parts3d, plan_id, GCS_BUCKET_NAME),
-        daemon=True,
-    ).start()
-    threading.Thread(
-        target=create_and_save_assembly_manual,
-        args=(parts3d, image_bytes, mime_type, plan_id, GCS_BUCKET_NAME),
-        daemon=True,
-    ).start()
+    # eagerモードでは部品3Dモデル作成完了時に起動済みのため、結果の返却のみ行う
+    if not EAGER_PIPELINE:
+        try:
+            if PIPELINE_MODE == "queue":
+                enqueue_stage(plan_id, "parts_manual")
+                enqueue_stage(plan_id, "assembly_manual")
+            else:
+                # 画像ファイルもGCSから取得
+                image = load_plan_image(store, plan_id)
+                if image is None:
+                    logging.warning(
+                        f"[get_model_obj] image file not found for {plan_id}"
+                    )
+                    return error_response("画像ファイルが見つかりません", 404)
+                image_bytes, mime_type = image
+                trigger_parts_manual(parts_list, parts3d, plan_id, GCS_BUCKET_NAME)
+                # parts3d作成時に起動済みの組立手順生成があれば、そのジョブに合流する
+                trigger_assembly_manual(
+                    parts3d, image_bytes, mime_type, plan_id, GCS_BUCKET_NAME
+                )
+        except StageQueueFullError as e:
+            logging.warning(f"[get_model_obj] {e}")
+            return busy_response(503, "parts_manual", "assembly_manual")
+        except StageCancelledError as e:
+            logging.info(f"[get_model_obj] {e}")
+            return error_response(CANCELLED_MESSAGE, 409)
     headers = {
         "Content-Type": "text/plain; charset=utf-8",
         "Content-Disposition": 'inline; filename="model.obj"',
@@ -331,8 +409,7 @@ def get_model_obj(plan_id):
 @require_bearer_token
 @require_valid_uuid
 def parts_creation_ready(plan_id):
-    _, bucket = get_gcs_client_and_bucket()
-    ready = gcs_blob_exists(bucket, f"{plan_id}/parts_manual.json")
+    ready = status_store.is_done(plan_id, "parts_manual")
     logging.info(f"[parts_creation_ready] Checking parts_manual for {plan_id}: {ready}")
     return jsonify({"ready": ready}), 200
 
@@ -343,14 +420,15 @@ def parts_creation_ready(plan_id):
 @require_valid_uuid
 @limiter.limit("20 per day")
 def get_parts_creation(plan_id):
-    _, bucket = get_gcs_client_and_bucket()
-    parts_manual = load_json_from_gcs(bucket, f"{plan_id}/parts_manual.json")
+    store = get_storage()
+    parts_manual = load_json_from_gcs(store, f"{plan_id}/parts_manual.json")
     if parts_manual is None:
         logging.warning(
             f"[get_parts_creation] parts_manual.json not found for {plan_id}"
         )
         return error_response("部品作成手順がまだ生成されていません", 404)
-    threading.Thread(target=try_create_manual_pdf, args=(plan_id,), daemon=True).start()
+    if not EAGER_PIPELINE:
+        start_manual_pdf(plan_id)
     return jsonify(parts_manual), 200
 
 
@@ -359,8 +437,7 @@ def get_parts_creation(plan_id):
 @require_bearer_token
 @require_valid_uuid
 def assembly_parts_ready(plan_id):
-    _, bucket = get_gcs_client_and_bucket()
-    ready = gcs_blob_exists(bucket, f"{plan_id}/assembly_manual.json")
+    ready = status_store.is_done(plan_id, "assembly_manual")
     logging.info(
         f"[assembly_manual_ready] Checking assembly_manual for {plan_id}: {ready}"
     )
@@ -372,8 +449,8 @@ def assembly_parts_ready(plan_id):
 @require_bearer_token
 @require_valid_uuid
 def get_assembly_procedure_num(plan_id):
-    _, bucket = get_gcs_client_and_bucket()
-    assembly_manual = load_json_from_gcs(bucket, f"{plan_id}/assembly_manual.json")
+    store = get_storage()
+    assembly_manual = load_json_from_gcs(store, f"{plan_id}/assembly_manual.json")
     if assembly_manual is None:
         logging.warning(
             f"[get_assembly_procedure_num] assembly_manual not found for {plan_id}"
@@ -393,8 +470,8 @@ def get_assembly_procedure_num(plan_id):
 def get_assembly_procedure(plan_id, procedure_no):
     if not isinstance(procedure_no, int) or procedure_no < 1:
         return error_response("procedure_noは1以上の整数で指定してください", 400)
-    _, bucket = get_gcs_client_and_bucket()
-    manual = load_json_from_gcs(bucket, f"{plan_id}/assembly_manual.json")
+    store = get_storage()
+    manual = load_json_from_gcs(store, f"{plan_id}/assembly_manual.json")
     if manual is None:
         logging.warning(
             f"[get_assembly_procedure] assembly_manual not found for {plan_id}"
@@ -406,7 +483,7 @@ def get_assembly_procedure(plan_id, procedure_no):
     step_info = steps[procedure_no - 1]
     description = step_info.get("description", "")
     part_names = step_info.get("parts_already_used", [])
-    parts3d = load_json_from_gcs(bucket, f"{plan_id}/parts3d.json")
+    parts3d = load_json_from_gcs(store, f"{plan_id}/parts3d.json")
     if parts3d is None:
         logging.warning(
             f"[get_assembly_procedure] parts3d.json not found for {plan_id}"
@@ -416,7 +493,8 @@ def get_assembly_procedure(plan_id, procedure_no):
     if not filtered_parts3d:
         return error_response("該当手順の部品3D情報が見つかりません", 404)
     obj_text = parts3d_to_obj(filtered_parts3d)
-    threading.Thread(target=try_create_manual_pdf, args=(plan_id,), daemon=True).start()
+    if not EAGER_PIPELINE:
+        start_manual_pdf(plan_id)
     return (
         jsonify({"step": procedure_no, "description": description, "model": obj_text}),
         200,
@@ -428,13 +506,8 @@ def get_assembly_procedure(plan_id, procedure_no):
 @require_bearer_token
 @require_valid_uuid
 def manual_pdf_ready(plan_id):
-    _, bucket = get_gcs_client_and_bucket()
-    pdf_path = f"{plan_id}/design_document.pdf"
-    logging.info(
-        f"[manual_pdf_ready] Checking GCS for: bucket={bucket.name}, path={pdf_path}"
-    )
-    ready = gcs_blob_exists(bucket, pdf_path)
-    logging.info(f"[manual_pdf_ready] Exists: {ready}")
+    ready = status_store.is_done(plan_id, "manual_pdf")
+    logging.info(f"[manual_pdf_ready] Checking manual_pdf for {plan_id}: {ready}")
     return jsonify({"ready": ready}), 200
 
 
@@ -444,18 +517,187 @@ def manual_pdf_ready(plan_id):
 @require_valid_uuid
 @limiter.limit("20 per day")
 def get_manual_pdf(plan_id):
-    _, bucket = get_gcs_client_and_bucket(GCS_BUCKET_NAME)
-    blob = bucket.blob(f"{plan_id}/design_document.pdf")
-    if not blob.exists():
+    store = get_storage(GCS_BUCKET_NAME)
+    pdf_path = f"{plan_id}/design_document.pdf"
+    if PDF_DOWNLOAD_MODE in ("redirect", "url"):
+        # 署名付きURLは存在を確認しないため、未生成のPDFのURLを返さないよう確認する
+        if not store.exists(pdf_path):
+            return error_response("指定plan_idが存在しない、またはPDF未生成", 404)
+        try:
+            url = store.signed_url(
+                pdf_path, SIGNED_URL_TTL_SEC, download_name="design_document.pdf"
+            )
+        except Exception as e:
+            # 署名の権限（IAM signBlob）・トークンの更新等で失敗した場合は逐次返却に切り替える
+            logging.error(
+                f"[get_manual_pdf] Failed to sign URL, streaming instead: {e}"
+            )
+            url = None
+        if url is not None:
+            if PDF_DOWNLOAD_MODE == "url":
+                return jsonify({"url": url, "expires_in": SIGNED_URL_TTL_SEC}), 200
+            return redirect(url, 302)
+    # 内容全体をメモリに読み込まず、保存先から逐次返却する
+    pdf_file = store.open(pdf_path)
+    if pdf_file is None:
         return error_response("指定plan_idが存在しない、またはPDF未生成", 404)
-    pdf_bytes = blob.download_as_bytes()
     return send_file(
-        io.BytesIO(pdf_bytes),
+        pdf_file,
         mimetype="application/pdf",
         as_attachment=True,
         download_name="design_document.pdf",
     )
 
 
+# 13_ステータス取得API
+@app.route("/api/<plan_id>/status", methods=["GET"])
+@require_bearer_token
+@require_valid_uuid
+def get_plan_status(plan_id):
+    try:
+        since = int(request.args.get("since", -1))
+        wait = min(float(request.args.get("wait", 0)), EVENTS_SETTINGS["max_wait_sec"])
+    except ValueError:
+        return error_response("since・waitは数値で指定してください", 400)
+    if wait > 0:
+        # long-poll: versionがsinceより新しくなるか、wait秒経過するまで待機する
+        record = status_store.wait_for_change(plan_id, since, wait)
+    else:
+        record = status_store.get(plan_id)
+    if record is None:
+        return error_response("指定plan_idが存在しません", 404)
+    return jsonify(with_ready_flags(record)), 200
+
+
+def format_sse(event, data, event_id=None):
+    """
+    Server-Sent Events形式のメッセージを生成する
+    """
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+
+# 14_ステータス通知API（Server-Sent Events）
+@app.route("/api/<plan_id>/events", methods=["GET"])
+@require_bearer_token
+@require_valid_uuid
+def stream_plan_events(plan_id):
+    if status_store.get(plan_id) is None:
+        return error_response("指定plan_idが存在しません", 404)
+    try:
+        # 再接続時はEventSourceが送るLast-Event-ID（version）以降の変化のみ通知する
+        since = int(request.headers.get("Last-Event-ID", request.args.get("since", -1)))
+    except ValueError:
+        return error_response("sinceは数値で指定してください", 400)
+    if not stream_slots.acquire(blocking=False):
+        # 上限を超える接続はlong-pollでの取得を案内する
+        body, code = error_response(STREAMS_BUSY_MESSAGE, 429)
+        return body, code, {"Retry-After": str(EVENTS_SETTINGS["heartbeat_sec"])}
+
+    def generate():
+        version = since
+        stage_states = {}
+        deadline = time.monotonic() + EVENTS_SETTINGS["max_stream_sec"]
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            record = status_store.wait_for_change(
+                plan_id, version, min(EVENTS_SETTINGS["heartbeat_sec"], remaining)
+            )
+            if record is None:
+                break
+            if record["version"] <= version:
+                # 接続維持のためのコメント行
+                yield ": heartbeat\n\n"
+                continue
+            version = record["version"]
+            for stage, status in record["stages"].items():
+                state = status.get("state")
+                if state in TERMINAL_STATES and stage_states.get(stage) != state:
+                    yield format_sse(
+                        "stage",
+                        {"stage": stage, "state": state, "error": status.get("error")},
+                        version,
+                    )
+                stage_states[stage] = state
+            yield format_sse("status", with_ready_flags(record), version)
+            if is_pipeline_finished(record):
+                yield format_sse("end", {"plan_id": plan_id}, version)
+                break
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    response = Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers=headers,
+    )
+    # 接続の終了時（クライアントの切断を含む）に枠を返す
+    response.call_on_close(stream_slots.release)
+    return response
+
+
+# 15_プラン取り消しAPI
+@app.route("/api/<plan_id>", methods=["DELETE"])
+@require_bearer_token
+@require_valid_uuid
+def delete_plan(plan_id):
+    if status_store.get(plan_id) is None:
+        return error_response("指定plan_idが存在しません", 404)
+    try:
+        if PIPELINE_MODE == "queue":
+            # 取り消しを記録した後にキューから取り除き、実行中のステージはワーカーが中断する
+            status_store.cancel(plan_id)
+            stages = [
+                stage for stage in STAGE_ARTIFACTS if job_queue.remove(plan_id, stage)
+            ]
+        else:
+            stages = cancel_plan(plan_id)
+    except Exception as e:
+        logging.error(f"[delete_plan error] {e}")
+        return error_response("プランの取り消し中にエラーが発生しました", 500)
+    logging.info(f"[delete_plan] Cancelled plan_id={plan_id}, stages={stages}")
+    return jsonify({"plan_id": plan_id, "cancelled_stages": stages}), 200
+
+
+# パイプライン実行状況取得API
+@app.route("/api/pipeline/stats", methods=["GET"])
+@require_bearer_token
+def pipeline_stats():
+    if PIPELINE_MODE == "queue":
+        pending = {stage: job_queue.pending_count(stage) for stage in STAGE_ARTIFACTS}
+        return jsonify({"mode": PIPELINE_MODE, "queue": pending}), 200
+    return (
+        jsonify(
+            {
+                "mode": PIPELINE_MODE,
+                "stages": stage_executor.stats(),
+                "hedging": hedge_stats(),
+                "retry": retry_stats(),
+                "artifact_cache": artifact_cache.stats(),
+                "image_cache": image_cache.stats(),
+            }
+        ),
+        200,
+    )
+
+
+def resume_pipeline():
+    """
+    前回のプロセスで完了しなかったステージを再投入する（queueモードではワーカーが行う）
+    サーバの起動時に1回だけ呼び出す（gunicornではpost_worker_initで呼び出す）
+    import時には行わず、mainをimportしただけのプロセスでジョブを再開しない
+    """
+    if PIPELINE_MODE != "queue":
+        resume_unfinished_jobs()
+
+
 if __name__ == "__main__":
+    # デバッグ時の自動リロードでは、リクエストを処理する子プロセスでのみ再投入する
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        resume_pipeline()
     app.run(host="0.0.0.0", port=8000, debug=True)
@@ -0,0 +1,858 @@
+import asyncio
+import contextlib
+import inspect
+import logging
+import math
+import multiprocessing
+import resource
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+class StageQueueFullError(Exception):
+    """ステージの待ち行列が上限に達している場合の例外"""
+
+
+class StageCancelledError(Exception):
+    """planの取り消しによりステージを中断した（起動しなかった）場合の例外"""
+
+
+class StageTimeoutError(Exception):
+    """ステージが期限までに完了しなかった場合の例外"""
+
+
+class Deadline:
+    """
+    ステージの期限（開始時刻から timeout_sec 秒後）
+    LLMの呼び出し等の後続の処理には残り時間を渡し、期限を超えた場合はStageTimeoutErrorとする
+    """
+
+    # HTTPのタイムアウトは残り時間をミリ秒に切り捨てて設定するため、期限の直前の失敗も期限切れとみなす
+    TOLERANCE_SEC = 1.0
+
+    def __init__(self, stage: str, timeout_sec: float = None):
+        """
+        Args:
+            stage (str): ステージ名
+            timeout_sec (float, optional): 期限（秒）。Noneの場合は期限を設けない
+        """
+        self.stage = stage
+        self.timeout_sec = timeout_sec
+        self._expires_at = (
+            None if timeout_sec is None else time.monotonic() + timeout_sec
+        )
+
+    def remaining(self):
+        """期限までの残り時間（秒）。期限が無い場合None"""
+        if self._expires_at is None:
+            return None
+        return max(0.0, self._expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return (
+            self._expires_at is not None
+            and time.monotonic() >= self._expires_at - self.TOLERANCE_SEC
+        )
+
+    async def run(self, awaitable):
+        """
+        awaitableの完了を期限まで待つ
+        Raises:
+            StageTimeoutError: 期限を超えた場合（HTTPのタイムアウトで失敗した場合を含む）
+        """
+        try:
+            return await asyncio.wait_for(awaitable, self.remaining())
+        except Exception as e:
+            if self.expired():
+                raise StageTimeoutError(
+                    f"ステージ{self.stage}が期限({self.timeout_sec}秒)までに完了しませんでした"
+                ) from e
+            raise
+
+
+class _EventLoopThread:
+    """
+    非同期ステージを実行するイベントループ（専用スレッドで動作する）
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._run, name="stage-event-loop", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+
+class WeightedLanes:
+    """
+    ステージを優先度レーンに振り分け、重みに応じて次に処理するレーンを選ぶ
+    （smooth weighted round-robin: 重み4と1のレーンに待ちがあれば4:1の割合で交互に選ぶ）
+    """
+
+    DEFAULT_LANE = "default"
+
+    def __init__(self, lane_settings: dict = None, stages=()):
+        """
+        Args:
+            lane_settings (dict, optional): レーン名をキーとした設定
+                （weight: 重み, stages: レーンに属するステージ名のリスト）
+                Noneの場合は全ステージを1つのレーンとして扱う
+            stages (optional): 全ステージ名（どのレーンにも属さないステージは最も重みの小さいレーンに入れる）
+        """
+        lane_settings = lane_settings or {self.DEFAULT_LANE: {"weight": 1}}
+        self._weights = {
+            lane: max(1, conf.get("weight", 1)) for lane, conf in lane_settings.items()
+        }
+        self._stage_lane = {
+            stage: lane
+            for lane, conf in lane_settings.items()
+            for stage in conf.get("stages", [])
+        }
+        fallback = min(self._weights, key=self._weights.get)
+        for stage in stages:
+            self._stage_lane.setdefault(stage, fallback)
+        self._current = {lane: 0 for lane in self._weights}
+
+    @property
+    def names(self) -> list[str]:
+        """重みの大きい順のレーン名"""
+        return sorted(self._weights, key=self._weights.get, reverse=True)
+
+    def lane_of(self, stage: str) -> str:
+        return self._stage_lane.get(stage, self.names[-1])
+
+    def weight(self, lane: str) -> int:
+        return self._weights[lane]
+
+    def pick(self, candidates) -> str:
+        """
+        待ちのあるレーンの中から次に処理するレーンを選ぶ（スレッドセーフではないため呼び出し側で排他する）
+        Args:
+            candidates (list[str]): 処理可能なジョブがあるレーン名
+        """
+        total = 0
+        for lane in candidates:
+            self._current[lane] += self._weights[lane]
+            total += self._weights[lane]
+        lane = max(candidates, key=self._current.get)
+        self._current[lane] -= total
+        return lane
+
+    def order(self, candidates) -> list[str]:
+        """
+        pickで選んだレーンを先頭に、残りを重みの大きい順に並べる
+        """
+        candidates = [lane for lane in self.names if lane in candidates]
+        if not candidates:
+            return []
+        first = self.pick(candidates)
+        return [first] + [lane for lane in candidates if lane != first]
+
+
+class StageExecutor:
+    """
+    パイプラインの各ステージをステージごとのワーカープールで実行する
+    ステージごとに同時実行数・待ち行列の上限を持ち、待ち時間と実行時間を分けて計測する
+    runnerが"async"のステージは共有のイベントループ上で実行し、LLMの応答待ちの間スレッドを占有しない
+    待ち行列は優先度レーンごとに持ち、全体の実行枠（max_running）に空きができた時点で
+    重みに応じてレーンを選んで実行を開始する（ユーザーが待っているステージを後回しにできる処理より先に実行する）
+    """
+
+    def __init__(self, stage_settings: dict, scheduler_settings: dict = None):
+        """
+        Args:
+            stage_settings (dict): ステージ名をキーとした設定
+                （max_workers: 同時実行数, max_queue: 待ち行列の上限,
+                expected_run_sec: 実績が無い場合に見積もりに用いる実行時間,
+                runner: "thread"（ワーカープール）または"async"（イベントループ）)
+            scheduler_settings (dict, optional): 全ステージ共通の実行枠の設定
+                （max_running: 全ステージ合計の同時実行数, lanes: 優先度レーンの設定（WeightedLanesを参照））
+                Noneの場合はステージごとの同時実行数のみで制御する
+        """
+        scheduler_settings = scheduler_settings or {}
+        self._lock = threading.Lock()
+        self._pools = {}
+        self._async_stages = set()
+        self._event_loop = None
+        self._max_queue = {}
+        self._expected_run_sec = {}
+        self._stats = {}
+        self._lanes = WeightedLanes(scheduler_settings.get("lanes"), stage_settings)
+        self._max_running = scheduler_settings.get("max_running")
+        # レーンごとの待ち行列: lane -> deque[(stage, enqueued_at, future, fn, args, kwargs)]
+        self._pending = {lane: deque() for lane in self._lanes.names}
+        # 実行を開始した（ワーカープール・イベントループに渡した）ジョブ数
+        self._active = {}
+        # イベントループ上で実行中のジョブのタスク（取り消し用）: Future -> asyncio.Task
+        self._tasks = {}
+        self._active_total = 0
+        for stage, conf in stage_settings.items():
+            runner = conf.get("runner", "thread")
+            if runner == "async":
+                if self._event_loop is None:
+                    self._event_loop = _EventLoopThread()
+                # max_workersは同時に待機できる（実行中の）ジョブ数の上限として扱う
+                self._async_stages.add(stage)
+            else:
+                self._pools[stage] = ThreadPoolExecutor(
+                    max_workers=conf.get("max_workers", 1),
+                    thread_name_prefix=f"stage-{stage}",
+                )
+            self._max_queue[stage] = conf.get("max_queue", 10)
+            self._expected_run_sec[stage] = conf.get("expected_run_sec", 60)
+            self._active[stage] = 0
+            self._stats[stage] = {
+                "runner": runner,
+                "lane": self._lanes.lane_of(stage),
+                "max_workers": conf.get("max_workers", 1),
+                "max_queue": self._max_queue[stage],
+                "queued": 0,
+                "running": 0,
+                "completed": 0,
+                "failed": 0,
+                "rejected": 0,
+                "total_wait_sec": 0.0,
+                "total_run_sec": 0.0,
+            }
+
+    def submit(self, stage: str, fn, *args, **kwargs) -> Future:
+        """
+        ステージのワーカープールに処理を投入する
+        Args:
+            stage (str): ステージ名
+            fn: 実行する関数（コルーチンを返す関数も可）
+        Returns:
+            Future: 実行結果のFuture
+        Raises:
+            StageQueueFullError: 待ち行列が上限に達している場合
+        """
+        if stage not in self._stats:
+            raise KeyError(f"未定義のステージです: {stage}")
+        future = Future()
+        with self._lock:
+            stats = self._stats[stage]
+            if stats["queued"] >= self._max_queue[stage]:
+                stats["rejected"] += 1
+                raise StageQueueFullError(
+                    f"ステージ{stage}の待ち行列が上限({self._max_queue[stage]})に達しています"
+                )
+            stats["queued"] += 1
+            self._pending[self._lanes.lane_of(stage)].append(
+                (stage, time.monotonic(), future, fn, args, kwargs)
+            )
+            jobs = self._take_startable()
+        self._start(jobs)
+        return future
+
+    def has_capacity(self, stage: str) -> bool:
+        """
+        新たに投入したジョブがすぐに実行を開始できるかを判定する
+        """
+        with self._lock:
+            stats = self._stats[stage]
+            if stats["queued"] + self._active[stage] >= stats["max_workers"]:
+                return False
+            if self._max_running is None:
+                return True
+            pending = sum(len(jobs) for jobs in self._pending.values())
+            return self._active_total + pending < self._max_running
+
+    def _can_start(self, stage: str) -> bool:
+        return self._active[stage] < self._stats[stage]["max_workers"]
+
+    def _take_startable(self) -> list:
+        """
+        実行枠の空きに応じて待ち行列からジョブを取り出す（self._lockを保持して呼び出す）
+        """
+        jobs = []
+        while self._max_running is None or self._active_total < self._max_running:
+            candidates = [
+                lane
+                for lane, pending in self._pending.items()
+                if any(self._can_start(job[0]) for job in pending)
+            ]
+            if not candidates:
+                break
+            pending = self._pending[self._lanes.pick(candidates)]
+            # レーン内は投入順（同時実行数に空きの無いステージのジョブは飛ばす）
+            job = next(job for job in pending if self._can_start(job[0]))
+            pending.remove(job)
+            stage, _, future = job[:3]
+            # 待ち行列の数は取り出した時点で減らす（非同期ステージの開始はイベントループ上で後から行われるため、
+            # 開始時に減らすと投入が集中した場合に実行枠が空いていても待ち行列の上限で拒否してしまう）
+            self._stats[stage]["queued"] -= 1
+            if not future.set_running_or_notify_cancel():
+                continue
+            self._stats[stage]["running"] += 1
+            self._active[stage] += 1
+            self._active_total += 1
+            jobs.append(job)
+        return jobs
+
+    def _start(self, jobs):
+        for stage, enqueued_at, future, fn, args, kwargs in jobs:
+            if stage in self._async_stages:
+                asyncio.run_coroutine_threadsafe(
+                    self._run_async(stage, enqueued_at, future, fn, args, kwargs),
+                    self._event_loop.loop,
+                )
+            else:
+                self._pools[stage].submit(
+                    self._run, stage, enqueued_at, future, fn, args, kwargs
+                )
+
+    def _run(self, stage, enqueued_at, future, fn, args, kwargs):
+        started_at = self._on_started(stage, enqueued_at)
+        error = None
+        try:
+            result = fn(*args, **kwargs)
+            if inspect.isawaitable(result):
+                result = asyncio.run(result)
+        except Exception as e:
+            error = e
+        self._on_completed(stage, enqueued_at, started_at, error is not None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    async def _run_async(self, stage, enqueued_at, future, fn, args, kwargs):
+        started_at = self._on_started(stage, enqueued_at)
+        error = None
+        try:
+            result = fn(*args, **kwargs)
+            if inspect.isawaitable(result):
+                task = asyncio.ensure_future(result)
+                with self._lock:
+                    self._tasks[future] = task
+                try:
+                    result = await task
+                finally:
+                    with self._lock:
+                        self._tasks.pop(future, None)
+        except asyncio.CancelledError:
+            error = StageCancelledError(f"ステージ{stage}の実行を取り消しました")
+        except Exception as e:
+            error = e
+        self._on_completed(stage, enqueued_at, started_at, error is not None)
+        # 完了時のコールバック（GCSへの状態書き込み等）でイベントループを止めない
+        if error is not None:
+            await asyncio.to_thread(future.set_exception, error)
+        else:
+            await asyncio.to_thread(future.set_result, result)
+
+    def cancel(self, future: Future) -> bool:
+        """
+        投入済みのジョブを取り消す
+        実行開始前のジョブは待ち行列から取り除き、イベントループ上で実行中のジョブは
+        タスクを取り消して応答待ち（LLMの呼び出し等）を中断する
+        （ワーカープールで実行中のジョブは中断できないため、処理側で取り消しを確認する）
+        Returns:
+            bool: 取り消した場合True
+        """
+        job = None
+        with self._lock:
+            for pending in self._pending.values():
+                job = next((job for job in pending if job[2] is future), None)
+                if job is not None:
+                    pending.remove(job)
+                    self._stats[job[0]]["queued"] -= 1
+                    break
+            task = self._tasks.get(future) if job is None else None
+        if job is not None:
+            future.set_exception(
+                StageCancelledError(f"ステージ{job[0]}の実行を取り消しました")
+            )
+            return True
+        if task is not None:
+            self._event_loop.loop.call_soon_threadsafe(task.cancel)
+            return True
+        return False
+
+    def _on_started(self, stage, enqueued_at) -> float:
+        started_at = time.monotonic()
+        with self._lock:
+            self._stats[stage]["total_wait_sec"] += started_at - enqueued_at
+        return started_at
+
+    def _on_completed(self, stage, enqueued_at, started_at, failed: bool):
+        run_sec = time.monotonic() - started_at
+        with self._lock:
+            stats = self._stats[stage]
+            stats["running"] -= 1
+            stats["completed"] += 1
+            stats["total_run_sec"] += run_sec
+            if failed:
+                stats["failed"] += 1
+            self._active[stage] -= 1
+            self._active_total -= 1
+            jobs = self._take_startable()
+        self._start(jobs)
+        logging.info(
+            f"[executor] stage={stage} lane={stats['lane']} "
+            f"wait={started_at - enqueued_at:.2f}s run={run_sec:.2f}s"
+        )
+
+    def stats(self) -> dict:
+        """
+        ステージごとの待ち行列・実行状況と平均待ち時間・平均実行時間を返す
+        """
+        result = {}
+        with self._lock:
+            for stage, stats in self._stats.items():
+                snapshot = dict(stats)
+                started = stats["completed"] + stats["running"]
+                snapshot["avg_wait_sec"] = (
+                    stats["total_wait_sec"] / started if started else 0.0
+                )
+                snapshot["avg_run_sec"] = (
+                    stats["total_run_sec"] / stats["completed"]
+                    if stats["completed"]
+                    else 0.0
+                )
+                result[stage] = snapshot
+        return result
+
+    def _avg_run_sec(self, stage: str) -> float:
+        """
+        ステージの平均実行時間（実績が無い場合は設定値、self._lockを保持して呼び出す）
+        """
+        stats = self._stats[stage]
+        if stats["completed"]:
+            return stats["total_run_sec"] / stats["completed"]
+        return self._expected_run_sec[stage]
+
+    def estimated_wait(self, stage: str) -> float:
+        """
+        新たに投入したジョブが実行開始されるまでの待ち時間（秒）を見積もる
+        ステージの同時実行数による待ちと、全体の実行枠（max_running）を他のレーンと
+        分け合うことによる待ちのうち長い方を返す
+        """
+        with self._lock:
+            stats = self._stats[stage]
+            workers = stats["max_workers"]
+            if self._max_running is not None:
+                workers = min(workers, self._max_running)
+            ahead = stats["queued"] + self._active[stage]
+            wait = 0.0
+            if ahead >= workers:
+                wait = (ahead - workers + 1) / workers * self._avg_run_sec(stage)
+            if self._max_running is None:
+                return wait
+            # 全体の実行枠: 同じレーンの待ちに加え、それらが取り出されるまでの間に
+            # 重みに応じて他のレーンから取り出されるジョブ数を先行するジョブとして数える
+            lane = self._lanes.lane_of(stage)
+            own = len(self._pending[lane])
+            ahead = self._active_total + own
+            for other, pending in self._pending.items():
+                if other != lane:
+                    share = (
+                        (own + 1) * self._lanes.weight(other) / self._lanes.weight(lane)
+                    )
+                    ahead += min(len(pending), math.ceil(share))
+            if ahead < self._max_running:
+                return wait
+            # 実行枠は実行中・待ち中のジョブのステージ構成に応じた平均実行時間で空いていく
+            counts = {
+                name: self._active[name] + s["queued"]
+                for name, s in self._stats.items()
+                if self._active[name] + s["queued"]
+            }
+            total = sum(counts.values())
+            avg_run = (
+                sum(self._avg_run_sec(name) * n for name, n in counts.items()) / total
+                if total
+                else self._avg_run_sec(stage)
+            )
+        global_wait = (ahead - self._max_running + 1) / self._max_running * avg_run
+        return max(wait, global_wait)
+
+    def shutdown(self, wait=True):
+        # 実行を開始していないジョブは取り消す
+        with self._lock:
+            jobs = [job for pending in self._pending.values() for job in pending]
+            for pending in self._pending.values():
+                pending.clear()
+            for job in jobs:
+                self._stats[job[0]]["queued"] -= 1
+        for job in jobs:
+            job[2].cancel()
+        for pool in self._pools.values():
+            pool.shutdown(wait=wait)
+        if self._event_loop is not None:
+            self._event_loop.stop()
+
+
+def _completed_marker() -> Future:
+    marker = Future()
+    marker.set_result(None)
+    return marker
+
+
+# 完了済みのジョブの代わりに保持するFuture（ジョブの戻り値を保持し続けない）
+_COMPLETED = _completed_marker()
+
+
+class SingleFlightRegistry:
+    """
+    plan_id・ステージ（・入力）単位でジョブを一本化するレジストリ
+    実行中のジョブがある場合は新規に起動せず、既存のFutureを返す
+    完了済みのジョブは結果を保持せず、完了を示すFuture（結果はNone）のみを保持して再実行を抑止する
+    """
+
+    def __init__(
+        self,
+        executor: StageExecutor,
+        listeners=(),
+        max_done_entries: int = 1000,
+        lease=None,
+    ):
+        """
+        Args:
+            executor (StageExecutor): ジョブを投入するエグゼキュータ
+            listeners (optional): ジョブの状態変化の通知先のリスト
+                （stage_queued, stage_started, stage_finishedを持つオブジェクト。
+                stage_finishedはerror・produced・cancelled・timed_outを受け取る）
+            max_done_entries (int): 完了を記録しておくジョブ数の上限
+            lease (optional): インスタンス間で実行権を排他するリースの管理
+                （acquireで取得したトークンをreleaseに渡すオブジェクト。Noneの場合はプロセス内でのみ一本化する）
+        """
+        self._executor = executor
+        self._listeners = list(listeners)
+        self._lease = lease
+        self._max_done_entries = max_done_entries
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        # 実行中のジョブのエグゼキュータ側のFuture（取り消し用）
+        self._inner = {}
+
+    def trigger(
+        self,
+        plan_id: str,
+        stage: str,
+        fn,
+        *args,
+        input_key: str = None,
+        done_check=None,
+        cache_done: bool = True,
+        **kwargs,
+    ) -> Future:
+        """
+        ステージを起動する（実行中・完了済みであれば既存のジョブに合流する）
+        Args:
+            plan_id (str): プランID
+            stage (str): ステージ名
+            fn: 実行する関数
+            input_key (str, optional): 入力の識別子（入力が異なるジョブは別扱いにする）
+            done_check: 成果物が既に存在するかを判定する関数（存在すれば起動しない）
+            cache_done (bool | callable): 完了済みのジョブを保持して再実行を抑止するか
+                （関数の場合はジョブの戻り値を受け取って判定する）
+        Returns:
+            Future: ジョブのFuture（合流した場合は既存のFuture）
+        Raises:
+            StageQueueFullError: 待ち行列が上限に達している場合
+        """
+        key = (plan_id, stage, input_key)
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and not self._is_failed(job):
+                self._jobs.move_to_end(key)
+                logging.info(f"[single_flight] Attached to {stage} for {plan_id}")
+                return job
+            job = Future()
+            self._jobs[key] = job
+        token = None
+        try:
+            if self._lease is not None:
+                token = self._lease.acquire(plan_id, stage)
+                if token is None:
+                    # 他のインスタンスが実行中のため、このインスタンスでは実行しない
+                    logging.info(
+                        f"[single_flight] {stage} for {plan_id} is leased by another instance"
+                    )
+                    job.set_result(None)
+                    self._on_finished(key, job, cache_done=False)
+                    return job
+            # リースの取得後に判定し、他のインスタンスが完了させた成果物を再生成しない
+            if done_check is not None and done_check():
+                logging.info(f"[single_flight] {stage} already done for {plan_id}")
+                self._release(token)
+                job.set_result(None)
+                self._on_finished(key, job, cache_done is not False)
+                self._notify("stage_finished", plan_id, stage)
+                return job
+            self._notify("stage_queued", plan_id, stage)
+            inner = self._executor.submit(
+                stage, self._run_job, plan_id, stage, fn, args, kwargs
+            )
+            with self._lock:
+                self._inner[key] = inner
+        except Exception as e:
+            self._release(token)
+            job.set_exception(e)
+            self._on_finished(key, job, cache_done=False)
+            if isinstance(e, StageQueueFullError):
+                self._notify("stage_finished", plan_id, stage, error=str(e))
+            raise
+        inner.add_done_callback(
+            lambda f: self._copy_result(f, job, key, cache_done, token)
+        )
+        return job
+
+    def _run_job(self, plan_id, stage, fn, args, kwargs):
+        if inspect.iscoroutinefunction(fn):
+            return self._run_job_async(plan_id, stage, fn, args, kwargs)
+        self._notify("stage_started", plan_id, stage)
+        return fn(*args, **kwargs)
+
+    async def _run_job_async(self, plan_id, stage, fn, args, kwargs):
+        # 通知先の書き込み（GCS）でイベントループを止めないよう、スレッドで通知する
+        await asyncio.to_thread(self._notify, "stage_started", plan_id, stage)
+        return await fn(*args, **kwargs)
+
+    def _notify(self, event: str, plan_id: str, stage: str, **kwargs):
+        for listener in self._listeners:
+            try:
+                getattr(listener, event)(plan_id, stage, **kwargs)
+            except Exception as e:
+                logging.warning(f"[single_flight] Failed to notify {event}: {e}")
+
+    @staticmethod
+    def _is_failed(job: Future) -> bool:
+        return job.done() and (job.cancelled() or job.exception() is not None)
+
+    def invalidate(self, plan_id: str, stage: str):
+        """
+        plan_id・ステージのジョブをレジストリから外す（入力が更新された場合に呼び出す）
+        実行中のジョブはそのまま完了するが、次回の起動では新しいジョブを開始する
+        """
+        with self._lock:
+            for key in [k for k in self._jobs if k[:2] == (plan_id, stage)]:
+                del self._jobs[key]
+
+    def cancel(self, plan_id: str) -> list[str]:
+        """
+        plan_idの待機中・実行中のジョブを取り消し、完了済みのジョブもレジストリから外す
+        Returns:
+            list[str]: 取り消したステージ名
+        """
+        with self._lock:
+            keys = [k for k in self._jobs if k[0] == plan_id]
+            inners = [(k, self._inner.get(k)) for k in keys]
+            for key in keys:
+                if self._jobs[key].done():
+                    del self._jobs[key]
+        cancelled = []
+        for key, inner in inners:
+            if inner is not None and self._executor.cancel(inner):
+                logging.info(f"[single_flight] Cancelled {key[1]} for {plan_id}")
+                cancelled.append(key[1])
+        return cancelled
+
+    def active_plans(self) -> set[str]:
+        """
+        待機中・実行中のジョブがあるplan_idを返す
+        """
+        with self._lock:
+            return {key[0] for key in self._inner}
+
+    def _release(self, token):
+        if token is None:
+            return
+        try:
+            self._lease.release(token)
+        except Exception as e:
+            logging.warning(f"[single_flight] Failed to release lease: {e}")
+
+    def _copy_result(self, inner: Future, job: Future, key, cache_done, token):
+        plan_id, stage = key[:2]
+        with self._lock:
+            if self._inner.get(key) is inner:
+                del self._inner[key]
+        self._release(token)
+        if inner.cancelled():
+            job.cancel()
+            self._on_finished(key, job, cache_done=False)
+            self._notify("stage_finished", plan_id, stage, produced=False)
+            return
+        exc = inner.exception()
+        if not job.done():
+            if exc is not None:
+                job.set_exception(exc)
+            else:
+                job.set_result(inner.result())
+        if exc is None and callable(cache_done):
+            cache_done = cache_done(inner.result())
+        self._on_finished(key, job, cache_done and exc is None)
+        if isinstance(exc, StageCancelledError):
+            self._notify("stage_finished", plan_id, stage, cancelled=True)
+        elif isinstance(exc, StageTimeoutError):
+            self._notify(
+                "stage_finished", plan_id, stage, error=str(exc), timed_out=True
+            )
+        elif exc is not None:
+            self._notify("stage_finished", plan_id, stage, error=str(exc))
+        else:
+            self._notify(
+                "stage_finished", plan_id, stage, produced=inner.result() is not False
+            )
+
+    def _on_finished(self, key, job: Future, cache_done: bool):
+        with self._lock:
+            if self._jobs.get(key) is not job:
+                return
+            if not cache_done:
+                del self._jobs[key]
+                return
+            # 合流済みの呼び出し元には結果を渡し終えているため、以降は完了の記録のみ保持する
+            self._jobs[key] = _COMPLETED
+            done_keys = [k for k, f in self._jobs.items() if f.done()]
+            for k in done_keys[: max(0, len(done_keys) - self._max_done_entries)]:
+                del self._jobs[k]
+
+
+def run_when_all_succeeded(futures: list, fn, *args, **kwargs):
+    """
+    全てのFutureが正常終了した時点でfnを呼び出す（いずれかが失敗した場合は呼び出さない）
+    Args:
+        futures (list[Future]): 待ち合わせるFuture
+        fn: 全て正常終了した後に呼び出す関数
+    """
+    lock = threading.Lock()
+    remaining = [len(futures)]
+
+    def on_done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+        if all(not f.cancelled() and f.exception() is None for f in futures):
+            fn(*args, **kwargs)
+
+    for future in futures:
+        future.add_done_callback(on_done)
+
+
+class AdmissionController:
+    """
+    パイプラインの待ち状況から、新たな処理を受け付けるかを判定する
+    """
+
+    def __init__(self, executor, max_estimated_wait_sec: float):
+        """
+        Args:
+            executor: 待ち時間を見積もるオブジェクト（estimated_waitを持つ。
+                StageExecutor、queueモードではjob_queue.QueueWaitEstimator）
+            max_estimated_wait_sec (float): 受け付ける見積もり待ち時間の上限（秒）
+        """
+        self._executor = executor
+        self._max_estimated_wait_sec = max_estimated_wait_sec
+
+    def retry_after(self, stages) -> int:
+        """
+        受け付け可能であれば0、待ち時間が上限を超える場合は再試行までの秒数を返す
+        Args:
+            stages (list[str]): 処理で起動するステージ名
+        """
+        wait = max(self._executor.estimated_wait(stage) for stage in stages)
+        if wait <= self._max_estimated_wait_sec:
+            return 0
+        return max(1, math.ceil(wait - self._max_estimated_wait_sec))
+
+
+def _limit_process_memory(memory_limit_mb: int):
+    # プロセスプールの各プロセスの初期化処理（ヒープ等の確保量に上限を設ける）
+    # ハードリミットは変更せず、子プロセスの起動時にはunlimited_process_memoryで解除できるようにする
+    if memory_limit_mb:
+        _, hard = resource.getrlimit(resource.RLIMIT_DATA)
+        limit = memory_limit_mb * 1024 * 1024
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, hard))
+
+
+@contextlib.contextmanager
+def unlimited_process_memory():
+    """
+    RenderProcessPoolで設定したメモリ上限を一時的に解除する
+    上限は起動した子プロセスに引き継がれるため、上限の対象外とする子プロセス
+    （kaleidoが起動するChromium。上限の下では起動に失敗する）を起動し得る処理をこの中で実行する
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_DATA)
+    resource.setrlimit(resource.RLIMIT_DATA, (hard, hard))
+    try:
+        yield
+    finally:
+        resource.setrlimit(resource.RLIMIT_DATA, (soft, hard))
+
+
+class RenderProcessPool:
+    """
+    CPU負荷の高い処理（PDF・画像の生成）を別プロセスで実行するプール
+    GILを共有しないため、実行中もWebリクエストの処理が遅延しない
+    引数・戻り値はファイルパス等の小さな値とし、データはファイル経由で受け渡す
+    メモリ上限は実行するPythonの処理のみに設け、そこから起動する子プロセスには
+    unlimited_process_memoryの中で起動させて引き継がない
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 1,
+        memory_limit_mb: int = 0,
+        max_tasks_per_child: int = None,
+    ):
+        """
+        Args:
+            max_workers (int): プロセス数
+            memory_limit_mb (int): 1プロセスあたりのメモリ上限（MB、0の場合は無制限）
+            max_tasks_per_child (int, optional): プロセスを再生成するまでの処理数
+                （メモリの断片化・リークを持ち越さない）
+        """
+        self._max_workers = max_workers
+        self._memory_limit_mb = memory_limit_mb
+        self._max_tasks_per_child = max_tasks_per_child
+        self._lock = threading.Lock()
+        self._pool = self._new_pool()
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        # 親プロセスのスレッド・ロックを引き継がないよう、spawnでプロセスを起動する
+        return ProcessPoolExecutor(
+            max_workers=self._max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_limit_process_memory,
+            initargs=(self._memory_limit_mb,),
+            max_tasks_per_child=self._max_tasks_per_child,
+        )
+
+    def run(self, fn, *args):
+        """
+        別プロセスでfnを実行し、結果を返す（完了まで呼び出し元のスレッドは待機する）
+        Args:
+            fn: モジュールのトップレベルに定義された関数
+        """
+        with self._lock:
+            pool = self._pool
+        try:
+            return pool.submit(fn, *args).result()
+        except BrokenProcessPool:
+            # メモリ不足等でプロセスが強制終了された場合は、プールを作り直して次回に備える
+            logging.error("[render_pool] Worker process died, recreating pool")
+            with self._lock:
+                if self._pool is pool:
+                    self._pool = self._new_pool()
+            raise
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._pool.shutdown(wait=wait)
@@ -0,0 +1,507 @@
+import asyncio
+import logging
+import os
+from ai_modules.parts_detection import detect_parts_from_bytes_async
+from ai_modules.parts_loc_estimate import detect_parts_location_from_bytes_async
+from ai_modules.parts_making import generate_parts_making_async
+from ai_modules.create_assembly_steps import generate_assembly_manual_async
+from utils import (
+    get_storage,
+    load_json_from_gcs,
+    load_plan_image,
+    upload_json_to_gcs,
+    gcs_blob_matches_fingerprint,
+    input_fingerprint,
+    GCS_BUCKET_NAME,
+    load_llm_settings,
+    load_pipeline_settings,
+)
+from create_manual_pdf import make_manual_pdf, get_manual_pdf_state
+from job_journal import create_job_journal
+from plan_status import PlanStatusStore
+from retry_policy import storage_retry
+from stage_lease import StageLeaseManager
+from pipeline import (
+    Deadline,
+    RenderProcessPool,
+    StageCancelledError,
+    StageExecutor,
+    StageQueueFullError,
+    SingleFlightRegistry,
+    run_when_all_succeeded,
+)
+
+# パイプラインの各ステージの実行処理
+# inlineモードではWebサーバのプロセス内で、queueモードではワーカー（worker.py）で実行する
+
+# バックグラウンド処理はステージごとのワーカープールで実行する
+pipeline_settings = load_pipeline_settings()
+# ユーザーが画面で待っているステージ（interactiveレーン）を後回しにできるステージより優先して実行する
+stage_executor = StageExecutor(
+    pipeline_settings["stages"], pipeline_settings.get("scheduler")
+)
+# PDF生成（画像描画・レイアウト）はGILを共有しないよう別プロセスで実行する
+pdf_render_pool = RenderProcessPool(**pipeline_settings["render_pool"])
+# plan_idごとのステージ状態（/readyおよび/statusの判定に利用する）
+status_store = PlanStatusStore(GCS_BUCKET_NAME)
+# ワーカーの再起動で失われたジョブを再投入するためのジャーナル
+job_journal = create_job_journal(GCS_BUCKET_NAME)
+# inline: Webサーバのプロセス内でステージを実行する
+# queue: Webサーバはジョブキューへの投入のみ行い、ワーカーがステージを実行する
+PIPELINE_MODE = os.environ.get("PIPELINE_MODE", pipeline_settings.get("mode", "inline"))
+# queueモードでは複数のワーカーが同一plan_id・ステージを重複実行しないよう、GCS上のリースで排他する
+stage_leases = (
+    StageLeaseManager(GCS_BUCKET_NAME, **pipeline_settings["lease"])
+    if PIPELINE_MODE == "queue"
+    else None
+)
+# 同一plan_id・同一ステージの重複起動を抑止する
+stage_registry = SingleFlightRegistry(
+    stage_executor, listeners=[status_store, job_journal], lease=stage_leases
+)
+# LLMを呼び出すステージの期限（llm_settings.jsonのtimeout_sec）
+# 期限を超えたステージは応答を待たずに打ち切り、状態を"timeout"とする
+STAGE_LLM_FUNCS = {
+    "parts_list": "parts_detection",
+    "parts3d": "parts_loc_estimate",
+    "parts_manual": "parts_making",
+    "assembly_manual": "create_assembly_steps",
+}
+STAGE_TIMEOUT_SEC = {
+    stage: load_llm_settings()["func_settings"][func].get("timeout_sec")
+    for stage, func in STAGE_LLM_FUNCS.items()
+}
+# 起動時に再投入するジョブの最大試行回数（クラッシュを繰り返すジョブを打ち切る）
+MAX_RESUME_ATTEMPTS = pipeline_settings.get("max_resume_attempts", 3)
+# eagerモード: 前段のステージ完了時に後段のステージを即座に起動し、GET APIは結果の参照のみ行う
+EAGER_PIPELINE = os.environ.get(
+    "PIPELINE_EAGER", str(pipeline_settings.get("eager", False))
+).lower() in ("1", "true")
+
+
+def ensure_not_cancelled(plan_id):
+    """
+    planが取り消されている場合にStageCancelledErrorを送出する
+    （後段のステージの起動前・成果物の保存前に確認し、取り消し後の処理を打ち切る）
+    """
+    if status_store.is_cancelled(plan_id):
+        raise StageCancelledError(f"plan_id={plan_id}は取り消されています")
+
+
+def save_stage_artifact(bucket_name, plan_id, filename, data, fingerprint=None):
+    """ステージの成果物をGCSに保存する（非同期ステージからはスレッドで呼び出す）"""
+    ensure_not_cancelled(plan_id)
+    store = get_storage(bucket_name)
+    storage_retry.call(
+        upload_json_to_gcs, store, f"{plan_id}/{filename}", data, fingerprint
+    )
+    stage = filename.rsplit(".", 1)[0]
+    logging.info(f"[{stage}] Uploaded to gs://{bucket_name}/{plan_id}/{filename}")
+
+
+# 21_部品検出
+# LLMを呼び出すステージはイベントループ上で実行し、GCSへの書き込みなど
+# ブロッキングする処理はasyncio.to_threadでスレッドに逃がす
+async def detect_and_save_parts_list(
+    image_bytes, mime_type, plan_id, bucket_name, fingerprint=None
+):
+    try:
+        logging.info(f"[parts_list] Detection start for plan_id={plan_id}")
+        deadline = Deadline("parts_list", STAGE_TIMEOUT_SEC["parts_list"])
+        parts_list = await deadline.run(
+            detect_parts_from_bytes_async(
+                image_bytes, mime_type, timeout=deadline.remaining()
+            )
+        )
+        # GCSに保存
+        await asyncio.to_thread(
+            save_stage_artifact,
+            bucket_name,
+            plan_id,
+            "parts_list.json",
+            parts_list,
+            fingerprint,
+        )
+    except Exception as e:
+        logging.error(f"[parts_list detection error] {e}")
+        raise
+    if EAGER_PIPELINE:
+        try:
+            await asyncio.to_thread(
+                trigger_parts3d,
+                image_bytes,
+                mime_type,
+                parts_list,
+                plan_id,
+                bucket_name,
+            )
+        except StageQueueFullError as e:
+            logging.warning(f"[parts_list] {e}")
+        except StageCancelledError as e:
+            logging.info(f"[parts_list] {e}")
+    return parts_list
+
+
+# 22_部品3Dモデル作成
+async def estimate_and_save_parts3d(
+    image_bytes, mime_type, parts_list, plan_id, bucket_name, fingerprint=None
+):
+    try:
+        logging.info(f"[parts3d] Estimation start for plan_id={plan_id}")
+        deadline = Deadline("parts3d", STAGE_TIMEOUT_SEC["parts3d"])
+        parts3d = await deadline.run(
+            detect_parts_location_from_bytes_async(
+                image_bytes, mime_type, parts_list, timeout=deadline.remaining()
+            )
+        )
+        # GCSに保存（3D情報）
+        await asyncio.to_thread(
+            save_stage_artifact,
+            bucket_name,
+            plan_id,
+            "parts3d.json",
+            parts3d,
+            fingerprint,
+        )
+        invalidate_manual_pdf(plan_id)
+    except Exception as e:
+        logging.error(f"[parts3d estimation error] {e}")
+        raise
+    # 組立手順は同一入力のジョブに合流するため、3Dモデル情報取得APIと重複しない
+    await asyncio.to_thread(
+        trigger_after_parts3d,
+        parts_list,
+        parts3d,
+        image_bytes,
+        mime_type,
+        plan_id,
+        bucket_name,
+    )
+    return parts3d
+
+
+def trigger_after_parts3d(
+    parts_list, parts3d, image_bytes, mime_type, plan_id, bucket_name
+):
+    """部品3Dモデル作成の完了後に後段のステージを起動する"""
+    try:
+        assembly_job = trigger_assembly_manual(
+            parts3d, image_bytes, mime_type, plan_id, bucket_name
+        )
+        if EAGER_PIPELINE:
+            parts_manual_job = trigger_parts_manual(
+                parts_list, parts3d, plan_id, bucket_name
+            )
+            # 部品作成手順・組立手順の両方が完了した時点でPDFを生成する
+            run_when_all_succeeded(
+                [parts_manual_job, assembly_job], submit_manual_pdf, plan_id
+            )
+    except StageQueueFullError as e:
+        logging.warning(f"[parts3d] {e}")
+    except StageCancelledError as e:
+        # 取り消されたplanの後段のステージは起動しない
+        logging.info(f"[parts3d] {e}")
+
+
+# 23_部品作成手順生成
+async def create_and_save_parts_manual(
+    parts_list, parts3d, plan_id, bucket_name, fingerprint=None
+):
+    """parts3dから部品作成手順を生成し、Cloud Storageに保存する"""
+    try:
+        logging.info(f"[parts_manual] Generating for plan_id={plan_id}")
+        deadline = Deadline("parts_manual", STAGE_TIMEOUT_SEC["parts_manual"])
+        parts_manual = await deadline.run(
+            generate_parts_making_async(
+                parts_list, parts3d, timeout=deadline.remaining()
+            )
+        )
+        await asyncio.to_thread(
+            save_stage_artifact,
+            bucket_name,
+            plan_id,
+            "parts_manual.json",
+            parts_manual,
+            fingerprint,
+        )
+        invalidate_manual_pdf(plan_id)
+        return parts_manual
+    except Exception as e:
+        logging.error(f"[parts_manual error] {e}")
+        raise
+
+
+# 24_組立手順生成
+async def create_and_save_assembly_manual(
+    parts3d, image_bytes, mime_type, plan_id, bucket_name, fingerprint=None
+):
+    """
+    parts3d, 画像データ, mime_typeから組立手順を生成し、Cloud Storageに保存する
+    """
+
+    try:
+        logging.info(f"[assembly_manual] Generating for plan_id={plan_id}")
+        deadline = Deadline("assembly_manual", STAGE_TIMEOUT_SEC["assembly_manual"])
+        assembly_manual = await deadline.run(
+            generate_assembly_manual_async(
+                image_bytes, mime_type, parts3d, timeout=deadline.remaining()
+            )
+        )
+        await asyncio.to_thread(
+            save_stage_artifact,
+            bucket_name,
+            plan_id,
+            "assembly_manual.json",
+            assembly_manual,
+            fingerprint,
+        )
+        invalidate_manual_pdf(plan_id)
+        return assembly_manual
+    except Exception as e:
+        logging.error(f"[assembly_manual error] {e}")
+        raise
+
+
+def try_create_manual_pdf(plan_id):
+    """
+    parts3d.json・parts_manual.json・assembly_manual.jsonが揃っている場合のみPDF生成
+    既存のPDFが入力より新しい場合は生成を省略する
+    Returns:
+        bool: PDFが最新の状態になった場合True（入力が揃っていない場合False）
+    """
+    store = get_storage()
+    state = get_manual_pdf_state(store, plan_id)
+    if state == "missing_inputs":
+        return False
+    if state == "up_to_date":
+        logging.info(f"[manual_pdf] PDF is up to date for {plan_id}, skip build")
+        return True
+    ensure_not_cancelled(plan_id)
+    try:
+        make_manual_pdf(plan_id, GCS_BUCKET_NAME, render_pool=pdf_render_pool)
+        logging.info(f"[manual_pdf] PDF生成処理を実行しました: {plan_id}")
+        return True
+    except Exception as e:
+        logging.error(f"[manual_pdf] PDF生成処理でエラー: {e}")
+        raise
+
+
+def artifact_current_check(store, plan_id, filename, fingerprint):
+    """
+    同一入力から生成された成果物がGCSに既に存在するかを判定する関数を返す
+    （SingleFlightRegistry用）
+    """
+    return lambda: gcs_blob_matches_fingerprint(
+        store, f"{plan_id}/{filename}", fingerprint
+    )
+
+
+def trigger_parts_list(image_bytes, mime_type, plan_id, bucket_name):
+    """部品検出を起動する（同一入力のジョブがあれば合流する）"""
+    ensure_not_cancelled(plan_id)
+    fingerprint = input_fingerprint(image_bytes)
+    store = get_storage(bucket_name)
+    return stage_registry.trigger(
+        plan_id,
+        "parts_list",
+        detect_and_save_parts_list,
+        image_bytes,
+        mime_type,
+        plan_id,
+        bucket_name,
+        fingerprint,
+        input_key=fingerprint,
+        done_check=artifact_current_check(
+            store, plan_id, "parts_list.json", fingerprint
+        ),
+    )
+
+
+def trigger_parts3d(image_bytes, mime_type, parts_list, plan_id, bucket_name):
+    """部品3Dモデル作成を起動する（同一入力のジョブがあれば合流する）"""
+    ensure_not_cancelled(plan_id)
+    fingerprint = input_fingerprint(image_bytes, parts_list)
+    store = get_storage(bucket_name)
+    return stage_registry.trigger(
+        plan_id,
+        "parts3d",
+        estimate_and_save_parts3d,
+        image_bytes,
+        mime_type,
+        parts_list,
+        plan_id,
+        bucket_name,
+        fingerprint,
+        input_key=fingerprint,
+        done_check=artifact_current_check(store, plan_id, "parts3d.json", fingerprint),
+    )
+
+
+def trigger_parts_manual(parts_list, parts3d, plan_id, bucket_name):
+    """部品作成手順生成を起動する（同一入力のジョブがあれば合流する）"""
+    ensure_not_cancelled(plan_id)
+    fingerprint = input_fingerprint(parts_list, parts3d)
+    store = get_storage(bucket_name)
+    return stage_registry.trigger(
+        plan_id,
+        "parts_manual",
+        create_and_save_parts_manual,
+        parts_list,
+        parts3d,
+        plan_id,
+        bucket_name,
+        fingerprint,
+        input_key=fingerprint,
+        done_check=artifact_current_check(
+            store, plan_id, "parts_manual.json", fingerprint
+        ),
+    )
+
+
+def trigger_assembly_manual(parts3d, image_bytes, mime_type, plan_id, bucket_name):
+    """組立手順生成を起動する（同一入力のジョブがあれば合流する）"""
+    ensure_not_cancelled(plan_id)
+    fingerprint = input_fingerprint(parts3d, image_bytes)
+    store = get_storage(bucket_name)
+    return stage_registry.trigger(
+        plan_id,
+        "assembly_manual",
+        create_and_save_assembly_manual,
+        parts3d,
+        image_bytes,
+        mime_type,
+        plan_id,
+        bucket_name,
+        fingerprint,
+        input_key=fingerprint,
+        done_check=artifact_current_check(
+            store, plan_id, "assembly_manual.json", fingerprint
+        ),
+    )
+
+
+def invalidate_manual_pdf(plan_id):
+    """
+    PDFの入力が更新された際に、生成済みPDFのジョブを破棄して再生成を許可する
+    """
+    stage_registry.invalidate(plan_id, "manual_pdf")
+
+
+def submit_manual_pdf(plan_id):
+    """
+    PDF生成をキューに投入する（PDFは任意のため、混雑時はログのみ出力して諦める）
+    同一plan_idの生成が待機中・実行中であれば合流し、PDFが最新になった後は
+    入力が再生成されるまで再投入しない
+    """
+    try:
+        ensure_not_cancelled(plan_id)
+        # 入力が揃う前に終了したジョブは保持せず、次回の呼び出しで再判定する
+        return stage_registry.trigger(
+            plan_id,
+            "manual_pdf",
+            try_create_manual_pdf,
+            plan_id,
+            cache_done=lambda built: built is True,
+        )
+    except StageQueueFullError as e:
+        logging.warning(f"[manual_pdf] {e}")
+        return None
+    except StageCancelledError as e:
+        logging.info(f"[manual_pdf] {e}")
+        return None
+
+
+def trigger_stage_from_gcs(plan_id, stage):
+    """
+    GCS上の入力からステージを起動する（ジャーナルからの再投入・ジョブキューのジョブで利用する）
+    同一入力の成果物が既に存在する場合は、SingleFlightRegistryにより再実行されない
+    Returns:
+        Future | None: 起動したジョブのFuture（入力が見つからない場合None）
+    Raises:
+        StageCancelledError: planが取り消されている場合
+    """
+    ensure_not_cancelled(plan_id)
+    if stage == "manual_pdf":
+        return submit_manual_pdf(plan_id)
+    store = get_storage()
+    image = load_plan_image(store, plan_id)
+    parts_list = load_json_from_gcs(store, f"{plan_id}/parts_list.json")
+    parts3d = load_json_from_gcs(store, f"{plan_id}/parts3d.json")
+    if stage == "parts_list" and image is not None:
+        return trigger_parts_list(*image, plan_id, GCS_BUCKET_NAME)
+    if stage == "parts3d" and image is not None and parts_list is not None:
+        return trigger_parts3d(*image, parts_list, plan_id, GCS_BUCKET_NAME)
+    if stage == "parts_manual" and parts_list is not None and parts3d is not None:
+        return trigger_parts_manual(parts_list, parts3d, plan_id, GCS_BUCKET_NAME)
+    if stage == "assembly_manual" and image is not None and parts3d is not None:
+        return trigger_assembly_manual(parts3d, *image, plan_id, GCS_BUCKET_NAME)
+    return None
+
+
+def resume_unfinished_jobs():
+    """
+    ジャーナルを読み込み、前回のワーカーで完了しなかったステージを再投入する
+    （起動時に呼び出す。queueモードのワーカーは停止したインスタンスのジョブを拾うため定期的に呼び出す）
+    """
+    try:
+        entries = job_journal.unfinished()
+    except Exception as e:
+        logging.error(f"[resume] Failed to read job journal: {e}")
+        return
+    manual_jobs = {}
+    for entry in entries:
+        plan_id, stage = entry["plan_id"], entry["stage"]
+        # リースが有効なジョブは実行中のため、保持者の停止（リースの期限切れ）を待つ
+        if stage_leases is not None and stage_leases.is_leased(plan_id, stage):
+            continue
+        attempts = job_journal.mark_resumed(entry)
+        if attempts > MAX_RESUME_ATTEMPTS:
+            logging.error(f"[resume] Give up {stage} for {plan_id}: too many attempts")
+            job_journal.discard(plan_id, stage)
+            status_store.update(plan_id, stage, "error", "再実行回数の上限に達しました")
+            continue
+        try:
+            job = trigger_stage_from_gcs(plan_id, stage)
+        except StageCancelledError as e:
+            logging.info(f"[resume] {e}")
+            job_journal.discard(plan_id, stage)
+            continue
+        except Exception as e:
+            logging.error(f"[resume] Failed to resume {stage} for {plan_id}: {e}")
+            continue
+        if job is None:
+            logging.warning(f"[resume] Inputs of {stage} not found for {plan_id}")
+            job_journal.discard(plan_id, stage)
+            continue
+        logging.info(f"[resume] Resumed {stage} for {plan_id} (attempt {attempts})")
+        if stage in ("parts_manual", "assembly_manual"):
+            manual_jobs.setdefault(plan_id, []).append(job)
+    # eagerモードでは再投入した手順生成の完了後にPDFを生成する
+    if EAGER_PIPELINE:
+        for plan_id, jobs in manual_jobs.items():
+            run_when_all_succeeded(jobs, submit_manual_pdf, plan_id)
+
+
+def cancel_plan(plan_id):
+    """
+    planを取り消し、このインスタンスで待機中・実行中のステージを中断する
+    LLMの応答待ちのステージはタスクを取り消して呼び出しを打ち切り、
+    以降の成果物の保存・後段のステージの起動は行わない
+    Returns:
+        list[str]: 中断したステージ名
+    """
+    status_store.cancel(plan_id)
+    return stage_registry.cancel(plan_id)
+
+
+def cancel_requested_plans():
+    """
+    他のインスタンス（queueモードのWebサーバ）で取り消されたplanのうち、
+    このインスタンスでステージを実行中のものを中断する（ワーカーが定期的に呼び出す）
+    """
+    for plan_id in stage_registry.active_plans():
+        try:
+            if status_store.is_cancelled(plan_id):
+                cancel_plan(plan_id)
+        except Exception as e:
+            logging.warning(f"[cancel] Failed to cancel {plan_id}: {e}")
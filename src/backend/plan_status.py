@@ -0,0 +1,410 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from utils import (
+    get_storage,
+    load_artifact_bytes,
+    load_json_with_generation,
+    upload_json_if_generation_match,
+    upload_json_to_gcs,
+    GCS_BUCKET_NAME,
+)
+
+# ステージと成果物ファイルの対応
+STAGE_ARTIFACTS = {
+    "parts_list": "parts_list.json",
+    "parts3d": "parts3d.json",
+    "parts_manual": "parts_manual.json",
+    "assembly_manual": "assembly_manual.json",
+    "manual_pdf": "design_document.pdf",
+}
+STATUS_FILENAME = "status.json"
+# planの取り消しを記録するファイル（ワーカーを含む全インスタンスが参照する）
+CANCELLED_FILENAME = "cancelled.json"
+# status.jsonの更新が他のインスタンスと競合した場合に読み直して再試行する回数
+STATUS_WRITE_ATTEMPTS = 5
+# これ以上状態が変化しない（完了・失敗・期限切れ・取り消し済みの）ステージの状態
+TERMINAL_STATES = ("done", "error", "timeout", "cancelled")
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def with_ready_flags(record: dict) -> dict:
+    """
+    状態レコードにステージごとの取得可否（ready）を付与して返す
+    """
+    record["ready"] = {
+        stage: status.get("state") == "done"
+        for stage, status in record["stages"].items()
+    }
+    return record
+
+
+def is_pipeline_finished(record: dict) -> bool:
+    """
+    全ステージが完了または失敗しているかを判定する
+    """
+    return all(
+        record["stages"].get(stage, {}).get("state") in TERMINAL_STATES
+        for stage in STAGE_ARTIFACTS
+    )
+
+
+class PlanStatusStore:
+    """
+    plan_idごとのステージ状態（状態・時刻・エラー情報）を保持するストア
+    メモリ上に保持し、更新のたびにGCSの {plan_id}/status.json へ書き込む
+    status.jsonは複数のインスタンス（ワーカー）が更新するため、読み込んだ世代番号を指定して
+    更新したステージの状態のみを反映し（read-merge-write）、競合した場合は読み直して再試行する
+    """
+
+    def __init__(
+        self,
+        bucket_name: str = None,
+        max_plans: int = 1000,
+        shared: bool = False,
+        poll_interval_sec: float = 1.0,
+        cancel_check_ttl_sec: float = 5.0,
+    ):
+        """
+        Args:
+            bucket_name (str, optional): 状態を書き込むGCSバケット名
+            max_plans (int): メモリ上に保持するplan数の上限
+            shared (bool): 他のプロセス（ワーカー）が更新する状態を参照するか
+                （Trueの場合はメモリ上に保持せず、常にGCSのstatus.jsonを読み込む）
+            poll_interval_sec (float): shared時に状態の変化を待機する際のポーリング間隔
+            cancel_check_ttl_sec (float): 取り消されていないことを確認した結果を再利用する期間（秒）
+                （他のインスタンスでの取り消しは最大この期間だけ遅れて反映される）
+        """
+        self._bucket_name = bucket_name or GCS_BUCKET_NAME
+        self._max_plans = max_plans
+        self._shared = shared
+        self._poll_interval_sec = poll_interval_sec
+        self._lock = threading.Lock()
+        # 状態の更新を待機しているリクエスト（long-poll・SSE）への通知用
+        self._changed = threading.Condition(self._lock)
+        self._records = OrderedDict()
+        self._write_locks = {}
+        # 取り消し済みのplan_id（取り消しは元に戻らないため、確認済みのものを保持する）
+        self._cancelled = set()
+        # 取り消されていないことを確認したplan_id -> 確認結果の期限（time.monotonic）
+        self._cancel_check_ttl_sec = cancel_check_ttl_sec
+        self._not_cancelled = {}
+
+    def get(self, plan_id: str):
+        """
+        plan_idの状態を返す（メモリ→GCSのstatus.json→GCS上の成果物の順に参照する）
+        Returns:
+            dict | None: 状態レコード（planが存在しない場合None）
+        """
+        if self._shared:
+            return self._load_from_gcs(plan_id)
+        with self._lock:
+            record = self._records.get(plan_id)
+            if record is not None:
+                self._records.move_to_end(plan_id)
+                return json.loads(json.dumps(record))
+        record = self._load_from_gcs(plan_id)
+        if record is None:
+            return None
+        with self._lock:
+            # 読み込み中に更新された場合はメモリ上の状態を優先する
+            record = self._records.setdefault(plan_id, record)
+            self._evict()
+            return json.loads(json.dumps(record))
+
+    def create(self, plan_id: str):
+        """
+        新規planの状態レコードを作成する（全ステージ未実行）
+        """
+        with self._lock:
+            record = self._new_record(plan_id)
+            for stage in STAGE_ARTIFACTS:
+                record["stages"][stage] = {"state": "pending", "error": None}
+            self._records[plan_id] = record
+            self._evict()
+
+    def wait_for_change(self, plan_id: str, since_version: int, timeout: float):
+        """
+        状態レコードのversionがsince_versionより大きくなるまで待機する
+        Args:
+            plan_id (str): プランID
+            since_version (int): クライアントが取得済みのversion
+            timeout (float): 最大待機秒数
+        Returns:
+            dict | None: 状態レコード（タイムアウト時は現在の状態、planが存在しない場合None）
+        """
+        if self.get(plan_id) is None:
+            return None
+        deadline = time.monotonic() + timeout
+        if self._shared:
+            return self._poll_for_change(plan_id, since_version, deadline)
+        with self._changed:
+            while True:
+                record = self._records.get(plan_id)
+                if record is None:
+                    break
+                remaining = deadline - time.monotonic()
+                if record["version"] > since_version or remaining <= 0:
+                    return json.loads(json.dumps(record))
+                self._changed.wait(remaining)
+        # 待機中にメモリから追い出された場合はGCSから読み直す
+        return self.get(plan_id)
+
+    def _poll_for_change(self, plan_id: str, since_version: int, deadline: float):
+        while True:
+            record = self.get(plan_id)
+            remaining = deadline - time.monotonic()
+            if record is None or record["version"] > since_version or remaining <= 0:
+                return record
+            time.sleep(min(self._poll_interval_sec, remaining))
+
+    def is_done(self, plan_id: str, stage: str) -> bool:
+        record = self.get(plan_id)
+        if record is None:
+            return False
+        return record["stages"].get(stage, {}).get("state") == "done"
+
+    def update(self, plan_id: str, stage: str, state: str, error: str = None):
+        """
+        ステージの状態を更新し、GCSに書き込む
+        Args:
+            plan_id (str): プランID
+            stage (str): ステージ名
+            state (str): "pending", "queued", "running", "done", "error", "timeout",
+                "cancelled"のいずれか
+            error (str, optional): エラー内容
+        """
+        if plan_id not in self._records:
+            self.get(plan_id)
+        now = _now()
+        with self._lock:
+            record = self._records.get(plan_id)
+            if record is None:
+                record = self._new_record(plan_id)
+                self._records[plan_id] = record
+                self._evict()
+            stage_status = record["stages"].setdefault(stage, {})
+            stage_status["state"] = state
+            if state == "queued":
+                stage_status["queued_at"] = now
+                stage_status.pop("started_at", None)
+                stage_status.pop("finished_at", None)
+            elif state == "running":
+                stage_status["started_at"] = now
+            elif state in TERMINAL_STATES:
+                stage_status["finished_at"] = now
+            stage_status["error"] = error
+            record["updated_at"] = now
+            record["version"] += 1
+            snapshot = json.loads(json.dumps(record))
+            write_lock = self._write_locks.setdefault(plan_id, threading.Lock())
+            self._changed.notify_all()
+        self._write_through(plan_id, snapshot, write_lock, stage=stage)
+
+    # SingleFlightRegistryからの通知
+    def stage_queued(self, plan_id: str, stage: str):
+        self.update(plan_id, stage, "queued")
+
+    def stage_started(self, plan_id: str, stage: str):
+        self.update(plan_id, stage, "running")
+
+    def stage_finished(
+        self,
+        plan_id: str,
+        stage: str,
+        error: str = None,
+        produced: bool = True,
+        cancelled: bool = False,
+        timed_out: bool = False,
+    ):
+        if cancelled:
+            self.update(plan_id, stage, "cancelled")
+        elif timed_out:
+            self.update(plan_id, stage, "timeout", error)
+        elif error is not None:
+            self.update(plan_id, stage, "error", error)
+        else:
+            self.update(plan_id, stage, "done" if produced else "pending")
+
+    def cancel(self, plan_id: str):
+        """
+        planを取り消し済みとして記録する（GCSの {plan_id}/cancelled.json に書き込む）
+        未完了のステージは"cancelled"とし、状態レコードにcancelled_atを付与する
+        （shared時もstatus.jsonに反映し、状態の参照時にcancelled.jsonを確認しなくてよいようにする）
+        """
+        now = _now()
+        with self._lock:
+            recorded = plan_id in self._cancelled
+        if not recorded:
+            upload_json_to_gcs(
+                get_storage(self._bucket_name),
+                f"{plan_id}/{CANCELLED_FILENAME}",
+                {"plan_id": plan_id, "cancelled_at": now},
+            )
+            with self._lock:
+                self._cancelled.add(plan_id)
+                self._not_cancelled.pop(plan_id, None)
+        if self._shared:
+            record = self._load_from_gcs(plan_id)
+            if record is None or "cancelled_at" in record:
+                return
+            self._mark_cancelled(record, now)
+            record["updated_at"] = now
+            record["version"] += 1
+            self._write_through(plan_id, record, threading.Lock())
+            return
+        if plan_id not in self._records:
+            self.get(plan_id)
+        with self._lock:
+            record = self._records.get(plan_id)
+            if record is None or "cancelled_at" in record:
+                return
+            self._mark_cancelled(record, now)
+            record["updated_at"] = now
+            record["version"] += 1
+            snapshot = json.loads(json.dumps(record))
+            write_lock = self._write_locks.setdefault(plan_id, threading.Lock())
+            self._changed.notify_all()
+        self._write_through(plan_id, snapshot, write_lock)
+
+    def is_cancelled(self, plan_id: str) -> bool:
+        """
+        planが取り消されているかを判定する（他のインスタンスでの取り消しも含む）
+        メモリ上の状態レコード・直近の確認結果で判定できない場合のみcancelled.jsonを確認する
+        """
+        now = time.monotonic()
+        with self._lock:
+            if plan_id in self._cancelled:
+                return True
+            record = self._records.get(plan_id)
+            if record is not None and "cancelled_at" in record:
+                self._cancelled.add(plan_id)
+                return True
+            if self._not_cancelled.get(plan_id, 0) > now:
+                return False
+        store = get_storage(self._bucket_name)
+        cancelled = store.exists(f"{plan_id}/{CANCELLED_FILENAME}")
+        with self._lock:
+            if cancelled:
+                self._cancelled.add(plan_id)
+                self._not_cancelled.pop(plan_id, None)
+            else:
+                if len(self._not_cancelled) >= self._max_plans:
+                    self._not_cancelled = {
+                        key: expires_at
+                        for key, expires_at in self._not_cancelled.items()
+                        if expires_at > now
+                    }
+                self._not_cancelled[plan_id] = now + self._cancel_check_ttl_sec
+        return cancelled
+
+    @staticmethod
+    def _mark_cancelled(record: dict, cancelled_at: str):
+        record["cancelled_at"] = cancelled_at
+        for stage_status in record["stages"].values():
+            if stage_status.get("state") not in TERMINAL_STATES:
+                stage_status["state"] = "cancelled"
+                stage_status["finished_at"] = cancelled_at
+                stage_status["error"] = None
+
+    @staticmethod
+    def _new_record(plan_id: str) -> dict:
+        return {"plan_id": plan_id, "updated_at": _now(), "version": 0, "stages": {}}
+
+    def _evict(self):
+        while len(self._records) > self._max_plans:
+            plan_id, _ = self._records.popitem(last=False)
+            self._write_locks.pop(plan_id, None)
+
+    def _write_through(self, plan_id: str, snapshot: dict, write_lock, stage=None):
+        """
+        status.jsonに更新を反映する
+        他のインスタンスが書き込んだ状態を読み込み、stageの状態（stage未指定の場合は取り消し）のみを
+        メモリ上の最新の内容で上書きして、読み込んだ世代番号を指定して書き込む
+        versionは読み込んだ値とメモリ上の値のいずれよりも大きくし、参照側で逆行しないようにする
+        """
+        store = get_storage(self._bucket_name)
+        path = f"{plan_id}/{STATUS_FILENAME}"
+        with write_lock:
+            for _ in range(STATUS_WRITE_ATTEMPTS):
+                try:
+                    stored, generation = load_json_with_generation(store, path)
+                except Exception as e:
+                    logging.warning(
+                        f"[plan_status] Failed to read status for {plan_id}: {e}"
+                    )
+                    return
+                with self._lock:
+                    # 後から更新された内容があれば古いsnapshotではなくそちらを書き込む
+                    latest = self._records.get(plan_id) or snapshot
+                    merged = self._merge(stored, latest, stage)
+                try:
+                    written = upload_json_if_generation_match(
+                        store, path, merged, generation
+                    )
+                except Exception as e:
+                    logging.warning(
+                        f"[plan_status] Failed to write status for {plan_id}: {e}"
+                    )
+                    return
+                if written is not None:
+                    self._apply_merged(plan_id, merged)
+                    return
+            logging.warning(
+                f"[plan_status] Gave up writing status for {plan_id} "
+                f"after {STATUS_WRITE_ATTEMPTS} conflicts"
+            )
+
+    def _merge(self, stored, latest: dict, stage) -> dict:
+        """
+        保存済みの状態レコードに、このインスタンスで更新したステージの状態・取り消しを反映する
+        """
+        if stored is None:
+            return json.loads(json.dumps(latest))
+        merged = stored
+        if stage is not None and stage in latest["stages"]:
+            merged["stages"][stage] = dict(latest["stages"][stage])
+        if "cancelled_at" in latest and "cancelled_at" not in merged:
+            self._mark_cancelled(merged, latest["cancelled_at"])
+        merged["updated_at"] = max(merged["updated_at"], latest["updated_at"])
+        merged["version"] = max(merged["version"] + 1, latest["version"])
+        return merged
+
+    def _apply_merged(self, plan_id: str, merged: dict):
+        """
+        書き込んだ状態レコードをメモリ上の状態とする（他のインスタンスが更新したステージを取り込む）
+        """
+        with self._lock:
+            record = self._records.get(plan_id)
+            # 書き込み中にこのインスタンスで更新された場合は、その更新の書き込み時に取り込む
+            if record is None or record["version"] > merged["version"]:
+                return
+            if record["version"] < merged["version"]:
+                self._records[plan_id] = json.loads(json.dumps(merged))
+                self._changed.notify_all()
+
+    def _load_from_gcs(self, plan_id: str):
+        """
+        GCSからstatus.jsonを読み込む（前回読み込んだ世代から変更されていなければダウンロードしない）
+        status.jsonが無い（導入前に作成された）planは、成果物の有無から状態を復元する
+        """
+        store = get_storage(self._bucket_name)
+        data = load_artifact_bytes(store, f"{plan_id}/{STATUS_FILENAME}")
+        if data is not None:
+            return json.loads(data)
+        names = {info.name.split("/", 1)[1] for info in store.list(f"{plan_id}/")}
+        if not names:
+            return None
+        record = self._new_record(plan_id)
+        for stage, filename in STAGE_ARTIFACTS.items():
+            record["stages"][stage] = {
+                "state": "done" if filename in names else "pending",
+                "error": None,
+            }
+        return record
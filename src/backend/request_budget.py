@@ -0,0 +1,33 @@
+import threading
+
+# 追加のリクエスト（再試行・ヘッジ）の上限
+# 通常のリクエスト数に比例した数までに抑え、障害・遅延時に呼び出し先への負荷・費用を増幅させない
+
+
+class RequestBudget:
+    """
+    追加のリクエストの上限（トークンバケット）
+    通常のリクエスト1件ごとにratio分のトークンを加え（最大burst）、追加のリクエスト1件ごとに1トークンを消費する
+    """
+
+    def __init__(self, ratio: float, burst: float):
+        """
+        Args:
+            ratio (float): 通常のリクエスト数に対する追加のリクエスト数の上限の比率
+            burst (float): 一時的に許容する追加のリクエスト数
+        """
+        self._ratio = ratio
+        self._burst = burst
+        self._tokens = burst
+        self._lock = threading.Lock()
+
+    def on_request(self):
+        with self._lock:
+            self._tokens = min(self._burst, self._tokens + self._ratio)
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
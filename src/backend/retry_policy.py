@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+import requests
+from request_budget import RequestBudget
+from utils import load_llm_settings
+
+try:
+    # google-genaiの通信ライブラリ（google-genaiと共にインストールされる）
+    import httpx
+except ImportError:
+    httpx = None
+
+# LLM（Vertex AI）・GCSの呼び出しの再試行
+# 一時的なエラー（429・503等）で失敗した呼び出しのみを、指数バックオフ（ジッタ付き）で再試行する
+# 再試行の回数は全体の呼び出し数に対する比率（リトライバジェット）で制限し、障害時に負荷を増幅させない
+
+# 再試行するHTTPステータスコード（google.genai.errors.APIError・google.api_core.exceptionsのcode）
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+# 再試行する通信エラー（ステータスコードを持たない例外）
+RETRYABLE_EXCEPTIONS = (
+    ConnectionError,
+    TimeoutError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+) + ((httpx.TransportError,) if httpx is not None else ())
+
+
+def is_retryable(exc: Exception) -> bool:
+    """
+    一時的なエラー（再試行で成功し得るエラー）かを判定する
+    """
+    code = getattr(exc, "code", None)
+    if isinstance(code, int):
+        return code in RETRYABLE_STATUS_CODES
+    return isinstance(exc, RETRYABLE_EXCEPTIONS)
+
+
+class RetryPolicy:
+    """
+    呼び出しを一時的なエラーの場合のみ再試行する
+    待ち時間は initial_backoff_sec * multiplier^(試行回数-1)（上限max_backoff_sec）を上限とした一様乱数とする
+    """
+
+    def __init__(
+        self,
+        name: str,
+        budget: RequestBudget,
+        max_attempts: int = 3,
+        initial_backoff_sec: float = 1.0,
+        max_backoff_sec: float = 20.0,
+        multiplier: float = 2.0,
+    ):
+        """
+        Args:
+            name (str): 呼び出しの名前（ログ・統計の出力に用いる）
+            budget (RequestBudget): 再試行の上限（呼び出し1件ごとにトークンを加え、再試行1回ごとに消費する）
+            max_attempts (int): 最大試行回数（初回を含む）
+            initial_backoff_sec (float): 初回の再試行までの待ち時間の上限
+            max_backoff_sec (float): 再試行までの待ち時間の上限
+            multiplier (float): 再試行ごとの待ち時間の上限の倍率
+        """
+        self.name = name
+        self._budget = budget
+        self._max_attempts = max_attempts
+        self._initial_backoff_sec = initial_backoff_sec
+        self._max_backoff_sec = max_backoff_sec
+        self._multiplier = multiplier
+        self._lock = threading.Lock()
+        self._stats = {
+            "calls": 0,
+            "retries": 0,
+            "recovered": 0,
+            "budget_exhausted": 0,
+            "failed": 0,
+        }
+
+    def backoff(self, attempt: int) -> float:
+        """
+        attempt回目の試行が失敗した後の待ち時間（秒）を返す
+        """
+        cap = min(
+            self._max_backoff_sec,
+            self._initial_backoff_sec * self._multiplier ** (attempt - 1),
+        )
+        return random.uniform(0, cap)
+
+    def call(self, fn, *args, **kwargs):
+        """
+        fnを呼び出し、一時的なエラーの場合は待ち時間を置いて再試行する
+        """
+        self._on_call()
+        attempt = 1
+        while True:
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                delay = self._on_failure(attempt, e)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._on_success(attempt)
+            return result
+
+    async def call_async(self, make_request):
+        """
+        callの非同期版
+        Args:
+            make_request: 呼び出すたびに新しいコルーチンを返す関数
+        """
+        self._on_call()
+        attempt = 1
+        while True:
+            try:
+                result = await make_request()
+            except Exception as e:
+                delay = self._on_failure(attempt, e)
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self._on_success(attempt)
+            return result
+
+    def _on_call(self):
+        self._budget.on_request()
+        self._count("calls")
+
+    def _on_success(self, attempt: int):
+        if attempt > 1:
+            self._count("recovered")
+
+    def _on_failure(self, attempt: int, exc: Exception) -> float:
+        """
+        失敗した試行を記録し、再試行までの待ち時間を返す（再試行しない場合は例外を送出する）
+        """
+        if not is_retryable(exc) or attempt >= self._max_attempts:
+            self._count("failed")
+            raise exc
+        if not self._budget.try_acquire():
+            self._count("budget_exhausted")
+            self._count("failed")
+            raise exc
+        self._count("retries")
+        delay = self.backoff(attempt)
+        logging.warning(
+            f"[retry] {self.name}: attempt {attempt} failed ({exc}), "
+            f"retrying in {delay:.1f}s"
+        )
+        return delay
+
+    def _count(self, key: str):
+        with self._lock:
+            self._stats[key] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+
+RETRY_SETTINGS = load_llm_settings().get("retry", {})
+# 全ての呼び出しで共有する再試行の上限
+_budget_settings = RETRY_SETTINGS.get("budget", {})
+retry_budget = RequestBudget(
+    _budget_settings.get("max_retry_ratio", 0.2), _budget_settings.get("burst", 10)
+)
+_policies = {}
+
+
+def create_retry_policy(name: str, policy_settings: dict = None) -> RetryPolicy:
+    """
+    呼び出しの名前ごとのRetryPolicyを生成する
+    （llm_settings.jsonのretry.defaultに、func_settingsのretryを上書きした設定を用いる）
+    """
+    conf = {**RETRY_SETTINGS.get("default", {}), **(policy_settings or {})}
+    policy = RetryPolicy(name, retry_budget, **conf)
+    _policies[name] = policy
+    return policy
+
+
+def retry_stats() -> dict:
+    """
+    呼び出しの名前ごとの再試行の統計（再試行回数・再試行で成功した回数等）を返す
+    """
+    return {name: policy.stats() for name, policy in _policies.items()}
+
+
+# GCSへの書き込み（条件なしのアップロードはライブラリの既定では再試行されない）
+storage_retry = create_retry_policy("storage", RETRY_SETTINGS.get("storage"))
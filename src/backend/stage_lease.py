@@ -0,0 +1,178 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from utils import (
+    get_storage,
+    load_json_with_generation,
+    upload_json_if_generation_match,
+    delete_blob_if_generation_match,
+    GCS_BUCKET_NAME,
+)
+
+# リースの保存先（GCSのプレフィックス）
+LEASE_PREFIX = "_lease"
+
+
+class StageLeaseManager:
+    """
+    plan_id・ステージ単位の実行権（リース）を管理する
+    GCSの _lease/{plan_id}/{stage}.json を世代番号による compare-and-swap で更新し、
+    複数のインスタンスが同一ステージを重複して実行しないようにする
+    リースは有効期限付きで、保持中はハートビートで延長する
+    （保持者が停止した場合は期限切れ後に他のインスタンスが取得できる）
+    取得ごとにトークンを発行し、解放はトークンで行う（同じインスタンスが取得し直した後に、
+    先に取得したジョブが解放しても新しいリースを削除しない）
+    """
+
+    def __init__(
+        self,
+        bucket_name: str = None,
+        ttl_sec: float = 60,
+        heartbeat_sec: float = 20,
+        holder: str = None,
+    ):
+        """
+        Args:
+            bucket_name (str, optional): リースを保存するGCSバケット名
+            ttl_sec (float): リースの有効期間（秒）
+            heartbeat_sec (float): 保持中のリースを延長する間隔（秒）
+            holder (str, optional): 保持者の識別子（省略時はホスト名・プロセスIDから生成）
+        """
+        self._bucket_name = bucket_name or GCS_BUCKET_NAME
+        self._ttl_sec = ttl_sec
+        self._heartbeat_sec = heartbeat_sec
+        self.holder = (
+            holder or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        )
+        self._lock = threading.Lock()
+        # 保持中のリース: トークン -> (plan_id, stage, GCS上の世代番号)
+        self._held = {}
+        self._stop = threading.Event()
+        self._heartbeat_thread = None
+
+    def acquire(self, plan_id: str, stage: str):
+        """
+        リースを取得する（他のインスタンスが有効なリースを保持している場合は取得しない）
+        自身が保持しているリースは取得し直し、先に取得したトークンは無効にする
+        Returns:
+            str | None: 解放時に指定するトークン（取得できなかった場合None）
+        """
+        store = self._store()
+        path = self._path(plan_id, stage)
+        record, generation = load_json_with_generation(store, path)
+        if self._held_by_other(record):
+            return None
+        new_generation = upload_json_if_generation_match(
+            store, path, self._record(plan_id, stage), generation
+        )
+        if new_generation is None:
+            # 同時に取得した他のインスタンスが先に更新した
+            return None
+        token = uuid.uuid4().hex
+        with self._lock:
+            for old in [
+                t for t, held in self._held.items() if held[:2] == (plan_id, stage)
+            ]:
+                del self._held[old]
+            self._held[token] = (plan_id, stage, new_generation)
+        self._ensure_heartbeat()
+        return token
+
+    def release(self, token: str):
+        """
+        トークンに対応するリースを解放する（取得し直された・失ったリースは解放しない）
+        """
+        with self._lock:
+            held = self._held.pop(token, None)
+        if held is None:
+            return
+        plan_id, stage, generation = held
+        delete_blob_if_generation_match(
+            self._store(), self._path(plan_id, stage), generation
+        )
+
+    def is_leased(self, plan_id: str, stage: str) -> bool:
+        """
+        いずれかのインスタンス（自身を含む）が有効なリースを保持しているかを判定する
+        """
+        with self._lock:
+            if any(held[:2] == (plan_id, stage) for held in self._held.values()):
+                return True
+        record, _ = load_json_with_generation(self._store(), self._path(plan_id, stage))
+        return record is not None and record["expires_at"] > time.time()
+
+    def renew_all(self):
+        """
+        保持中のリースの有効期限を延長する（延長できなかったリースは失ったものとして扱う）
+        """
+        store = self._store()
+        with self._lock:
+            held = list(self._held.items())
+        for token, (plan_id, stage, generation) in held:
+            new_generation = upload_json_if_generation_match(
+                store,
+                self._path(plan_id, stage),
+                self._record(plan_id, stage),
+                generation,
+            )
+            with self._lock:
+                # 延長中に解放・取得し直されたリースは更新しない
+                if self._held.get(token) != (plan_id, stage, generation):
+                    continue
+                if new_generation is None:
+                    logging.warning(f"[lease] Lost lease of {stage} for {plan_id}")
+                    del self._held[token]
+                else:
+                    self._held[token] = (plan_id, stage, new_generation)
+
+    def stop(self):
+        """
+        ハートビートを停止し、保持中のリースを全て解放する
+        """
+        self._stop.set()
+        with self._lock:
+            tokens = list(self._held)
+        for token in tokens:
+            self.release(token)
+
+    def _held_by_other(self, record) -> bool:
+        return (
+            record is not None
+            and record["holder"] != self.holder
+            and record["expires_at"] > time.time()
+        )
+
+    def _record(self, plan_id: str, stage: str) -> dict:
+        # 有効期限はインスタンス間で比較するため、UNIX時刻（秒）で記録する
+        return {
+            "plan_id": plan_id,
+            "stage": stage,
+            "holder": self.holder,
+            "expires_at": time.time() + self._ttl_sec,
+        }
+
+    def _ensure_heartbeat(self):
+        with self._lock:
+            if self._heartbeat_thread is not None:
+                return
+            self._heartbeat_thread = threading.Thread(
+                target=self._heartbeat_loop, name="stage-lease-heartbeat", daemon=True
+            )
+            self._heartbeat_thread.start()
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self._heartbeat_sec):
+            try:
+                self.renew_all()
+            except Exception as e:
+                logging.warning(f"[lease] Failed to renew leases: {e}")
+
+    def _store(self):
+        return get_storage(self._bucket_name)
+
+    @staticmethod
+    def _path(plan_id: str, stage: str) -> str:
+        return f"{LEASE_PREFIX}/{plan_id}/{stage}.json"
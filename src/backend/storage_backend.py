@@ -0,0 +1,507 @@
+import contextlib
+import fcntl
+import json
+import mimetypes
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+import google.auth
+from google.auth.credentials import AnonymousCredentials, Signing
+from google.auth.transport.requests import AuthorizedSession, Request
+from google.cloud import storage
+from google.api_core.exceptions import NotFound, NotModified, PreconditionFailed
+from requests.adapters import HTTPAdapter
+
+# 成果物・状態等のオブジェクトの保存先
+# 既定はGCS、環境変数STORAGE_DIRを指定した場合はローカルディレクトリ（{STORAGE_DIR}/{バケット名}）とする
+
+# 指定した場合はGCSではなくローカルディレクトリを保存先とする（単一ノード・ベンチマーク用）
+STORAGE_DIR = os.environ.get("STORAGE_DIR")
+# GCSクライアントのHTTP接続プールのサイズ（同時にGCSへアクセスするスレッド数以上とする）
+GCS_POOL_SIZE = int(os.environ.get("GCS_POOL_SIZE", "64"))
+# 大きなオブジェクトを逐次読み込む際の1回あたりの読み込みサイズ
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# プロセス内で共有するGCSクライアント（get_gcs_clientで初回に生成する）
+_gcs_client = None
+_gcs_lock = threading.Lock()
+
+
+def get_gcs_client():
+    """
+    プロセス内で共有するGCSクライアントを返す
+    認証情報の取得・HTTPセッション（TLS接続）の確立を呼び出しごとに繰り返さないよう、初回のみ生成する
+    """
+    global _gcs_client
+    if _gcs_client is None:
+        with _gcs_lock:
+            if _gcs_client is None:
+                if os.environ.get("STORAGE_EMULATOR_HOST"):
+                    # エミュレータ（ベンチマーク用）は認証を行わない
+                    credentials, project = AnonymousCredentials(), "<none>"
+                else:
+                    credentials, project = google.auth.default(
+                        scopes=storage.Client.SCOPE
+                    )
+                # 既定の接続プール（10接続）ではスレッド数が多い場合に接続を張り直すため、
+                # 接続プールを拡張したセッションをクライアントに渡す
+                session = AuthorizedSession(credentials)
+                session.mount(
+                    "https://",
+                    HTTPAdapter(
+                        pool_connections=GCS_POOL_SIZE, pool_maxsize=GCS_POOL_SIZE
+                    ),
+                )
+                _gcs_client = storage.Client(
+                    project=project, credentials=credentials, _http=session
+                )
+    return _gcs_client
+
+
+class ObjectInfo:
+    """
+    保存先のオブジェクトの属性
+    """
+
+    def __init__(
+        self,
+        name: str,
+        generation: int,
+        size: int,
+        updated: datetime,
+        content_type: str = None,
+        metadata: dict = None,
+    ):
+        """
+        Args:
+            name (str): オブジェクトのパス
+            generation (int): 世代番号（書き込みごとに増加する）
+            size (int): サイズ（バイト）
+            updated (datetime): 最終更新日時（UTC）
+            content_type (str, optional): MIMEタイプ
+            metadata (dict, optional): 書き込み時に指定したメタデータ
+        """
+        self.name = name
+        self.generation = generation
+        self.size = size
+        self.updated = updated
+        self.content_type = content_type
+        self.metadata = metadata or {}
+
+
+class StorageBackend:
+    """
+    オブジェクトの保存先（基底クラス）
+    世代番号を指定した書き込み・削除（compare-and-swap）により、複数のインスタンスからの更新を調停する
+    if_generation_matchに0を指定した場合は、存在しない場合のみ書き込む
+    """
+
+    def put(
+        self,
+        path: str,
+        data: bytes,
+        content_type: str = None,
+        metadata: dict = None,
+        if_generation_match: int = None,
+    ):
+        """
+        オブジェクトを書き込む
+        Returns:
+            int | None: 書き込み後の世代番号（if_generation_matchと一致しない場合None）
+        """
+        raise NotImplementedError
+
+    def get(self, path: str, if_generation_match: int = None):
+        """
+        オブジェクトを読み込む
+        Returns:
+            bytes | None: 内容（存在しない・if_generation_matchと一致しない場合None）
+        """
+        raise NotImplementedError
+
+    def read(self, path: str, if_generation_not_match: int = None):
+        """
+        オブジェクトの内容と属性を1回の呼び出しで読み込む（存在確認を別に行わない）
+        属性は世代番号・サイズ・MIMEタイプのみとし、更新日時・メタデータ（metadata）は含まない
+        （GCSのクライアントはダウンロードの応答ヘッダから世代番号・MIMEタイプ等のみを設定し、
+        メタデータの取得には属性取得のリクエストが別に必要なため。必要な場合はstatを用いる）
+        Args:
+            if_generation_not_match (int, optional): 保持している内容の世代番号（一致する場合は内容を返さない）
+        Returns:
+            tuple: 内容と属性（ObjectInfo）
+                存在しない場合(None, None)、世代番号がif_generation_not_matchと一致する場合(None, 世代番号のみの属性)
+        """
+        raise NotImplementedError
+
+    def exists(self, path: str) -> bool:
+        raise NotImplementedError
+
+    def stat(self, path: str):
+        """
+        Returns:
+            ObjectInfo | None: オブジェクトの属性（存在しない場合None）
+        """
+        raise NotImplementedError
+
+    def list(self, prefix: str) -> list:
+        """
+        Returns:
+            list[ObjectInfo]: パスがprefixで始まるオブジェクトの属性
+        """
+        raise NotImplementedError
+
+    def delete(self, path: str, if_generation_match: int = None) -> bool:
+        """
+        オブジェクトを削除する
+        Returns:
+            bool: 削除した場合True（存在しない・if_generation_matchと一致しない場合False）
+        """
+        raise NotImplementedError
+
+    def open(self, path: str):
+        """
+        オブジェクトを逐次読み込むファイルオブジェクトを返す（内容全体をメモリに読み込まない）
+        Returns:
+            file object | None: バイナリ読み込み用のファイルオブジェクト（存在しない場合None）
+        """
+        raise NotImplementedError
+
+    def url(self, path: str) -> str:
+        """
+        オブジェクトのURLを返す
+        """
+        raise NotImplementedError
+
+    def signed_url(self, path: str, expires_sec: int, download_name: str = None):
+        """
+        認証なしで期限付きでダウンロードできるURLを返す
+        Args:
+            expires_sec (int): URLの有効期間（秒）
+            download_name (str, optional): ダウンロード時のファイル名（Content-Dispositionに指定する）
+        Returns:
+            str | None: 署名付きURL（保存先が対応していない場合None）
+        """
+        return None
+
+
+class GCSStorageBackend(StorageBackend):
+    """
+    GCSバケットを保存先とする（世代番号はGCSのgenerationを用いる）
+    """
+
+    def __init__(self, bucket_name: str):
+        self.bucket_name = bucket_name
+        self._bucket = get_gcs_client().bucket(bucket_name)
+
+    def put(
+        self,
+        path: str,
+        data: bytes,
+        content_type: str = None,
+        metadata: dict = None,
+        if_generation_match: int = None,
+    ):
+        blob = self._bucket.blob(path)
+        if metadata is not None:
+            blob.metadata = metadata
+        try:
+            blob.upload_from_string(
+                data=data,
+                content_type=content_type,
+                if_generation_match=if_generation_match,
+            )
+        except PreconditionFailed:
+            return None
+        return blob.generation
+
+    def get(self, path: str, if_generation_match: int = None):
+        try:
+            return self._bucket.blob(path).download_as_bytes(
+                if_generation_match=if_generation_match
+            )
+        except (NotFound, PreconditionFailed):
+            return None
+
+    def read(self, path: str, if_generation_not_match: int = None):
+        blob = self._bucket.blob(path)
+        try:
+            data = blob.download_as_bytes(
+                if_generation_not_match=if_generation_not_match
+            )
+        except NotFound:
+            return None, None
+        except NotModified:
+            return None, ObjectInfo(
+                name=path, generation=if_generation_not_match, size=None, updated=None
+            )
+        # 世代番号・MIMEタイプはダウンロードの応答ヘッダから設定される
+        return data, ObjectInfo(
+            name=path,
+            generation=blob.generation,
+            size=len(data),
+            updated=None,
+            content_type=blob.content_type,
+        )
+
+    def exists(self, path: str) -> bool:
+        return self._bucket.blob(path).exists()
+
+    def stat(self, path: str):
+        blob = self._bucket.get_blob(path)
+        if blob is None:
+            return None
+        return self._info(blob)
+
+    def list(self, prefix: str) -> list:
+        return [self._info(blob) for blob in self._bucket.list_blobs(prefix=prefix)]
+
+    def delete(self, path: str, if_generation_match: int = None) -> bool:
+        try:
+            self._bucket.blob(path).delete(if_generation_match=if_generation_match)
+        except (NotFound, PreconditionFailed):
+            return False
+        return True
+
+    def open(self, path: str):
+        blob = self._bucket.get_blob(path)
+        if blob is None:
+            return None
+        # 取得した世代を範囲指定で分割して読み込む
+        return blob.open("rb", chunk_size=STREAM_CHUNK_SIZE)
+
+    def url(self, path: str) -> str:
+        return self._bucket.blob(path).public_url
+
+    def signed_url(self, path: str, expires_sec: int, download_name: str = None):
+        kwargs = {}
+        credentials = get_gcs_client()._credentials
+        if not isinstance(credentials, Signing):
+            # 秘密鍵を持たない認証情報（App Engine等の既定のサービスアカウント）はIAM APIで署名する
+            if not credentials.valid:
+                credentials.refresh(Request())
+            kwargs = {
+                "service_account_email": credentials.service_account_email,
+                "access_token": credentials.token,
+            }
+        if download_name is not None:
+            kwargs["response_disposition"] = f'attachment; filename="{download_name}"'
+        return self._bucket.blob(path).generate_signed_url(
+            version="v4",
+            expiration=timedelta(seconds=expires_sec),
+            method="GET",
+            **kwargs,
+        )
+
+    @staticmethod
+    def _info(blob) -> ObjectInfo:
+        return ObjectInfo(
+            name=blob.name,
+            generation=blob.generation,
+            size=blob.size,
+            updated=blob.updated,
+            content_type=blob.content_type,
+            metadata=blob.metadata,
+        )
+
+
+class LocalStorageBackend(StorageBackend):
+    """
+    ローカルディレクトリを保存先とする（単一ノード・ベンチマーク用）
+    オブジェクトは {directory}/{path} に、世代番号等の属性は {directory}/.meta/{path}.json に保存する
+    書き込み・削除と、世代番号を伴う読み込み（get・read）はロックファイルで直列化し、同一ノードの複数プロセスから利用できる
+    """
+
+    META_DIR = ".meta"
+    TMP_DIR = ".tmp"
+    LOCK_FILE = ".lock"
+
+    def __init__(self, directory: str):
+        self._directory = os.path.abspath(directory)
+        for name in (self.META_DIR, self.TMP_DIR):
+            os.makedirs(os.path.join(self._directory, name), exist_ok=True)
+        self._lock = threading.Lock()
+
+    def put(
+        self,
+        path: str,
+        data: bytes,
+        content_type: str = None,
+        metadata: dict = None,
+        if_generation_match: int = None,
+    ):
+        file_path = self._file_path(path)
+        with self._locked():
+            current = self._stat(path, file_path)
+            current_generation = current.generation if current is not None else 0
+            if (
+                if_generation_match is not None
+                and current_generation != if_generation_match
+            ):
+                return None
+            # GCSと同様にマイクロ秒単位の時刻とし、同一オブジェクト内では必ず増加させる
+            generation = max(time.time_ns() // 1000, current_generation + 1)
+            self._write_file(file_path, data)
+            self._write_file(
+                self._meta_path(path),
+                json.dumps(
+                    {
+                        "generation": generation,
+                        "content_type": content_type,
+                        "metadata": metadata,
+                    }
+                ).encode("utf-8"),
+            )
+        return generation
+
+    def get(self, path: str, if_generation_match: int = None):
+        file_path = self._file_path(path)
+        if if_generation_match is None:
+            return self._read_file(file_path)
+        with self._locked():
+            current = self._stat(path, file_path)
+            if current is None or current.generation != if_generation_match:
+                return None
+            return self._read_file(file_path)
+
+    def read(self, path: str, if_generation_not_match: int = None):
+        file_path = self._file_path(path)
+        with self._locked():
+            info = self._stat(path, file_path)
+            if info is None:
+                return None, None
+            if info.generation == if_generation_not_match:
+                return None, ObjectInfo(
+                    name=path, generation=info.generation, size=None, updated=None
+                )
+            data = self._read_file(file_path)
+        # GCSと同じ属性のみを返し、保存先によって戻り値の内容を変えない
+        return data, ObjectInfo(
+            name=path,
+            generation=info.generation,
+            size=len(data),
+            updated=None,
+            content_type=info.content_type,
+        )
+
+    def exists(self, path: str) -> bool:
+        return os.path.isfile(self._file_path(path))
+
+    def stat(self, path: str):
+        return self._stat(path, self._file_path(path))
+
+    def list(self, prefix: str) -> list:
+        # prefixのディレクトリ部分以下のみを走査する
+        start = self._file_path(prefix.rsplit("/", 1)[0]) if "/" in prefix else None
+        infos = []
+        for root, dirs, files in os.walk(start or self._directory):
+            if root == self._directory:
+                dirs[:] = [d for d in dirs if d not in (self.META_DIR, self.TMP_DIR)]
+            for filename in files:
+                file_path = os.path.join(root, filename)
+                name = os.path.relpath(file_path, self._directory).replace(os.sep, "/")
+                if name == self.LOCK_FILE or not name.startswith(prefix):
+                    continue
+                info = self._stat(name, file_path)
+                if info is not None:
+                    infos.append(info)
+        return sorted(infos, key=lambda info: info.name)
+
+    def delete(self, path: str, if_generation_match: int = None) -> bool:
+        file_path = self._file_path(path)
+        with self._locked():
+            current = self._stat(path, file_path)
+            if current is None or (
+                if_generation_match is not None
+                and current.generation != if_generation_match
+            ):
+                return False
+            os.remove(file_path)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._meta_path(path))
+        return True
+
+    def open(self, path: str):
+        try:
+            return open(self._file_path(path), "rb")
+        except FileNotFoundError:
+            return None
+
+    def url(self, path: str) -> str:
+        return f"file://{self._file_path(path)}"
+
+    def _file_path(self, path: str) -> str:
+        file_path = os.path.normpath(os.path.join(self._directory, path))
+        relative = os.path.relpath(file_path, self._directory)
+        if relative.startswith("..") or relative.split(os.sep)[0] in (
+            self.META_DIR,
+            self.TMP_DIR,
+            self.LOCK_FILE,
+        ):
+            raise ValueError(f"Invalid storage path: {path}")
+        return file_path
+
+    def _meta_path(self, path: str) -> str:
+        return os.path.join(self._directory, self.META_DIR, f"{path}.json")
+
+    def _stat(self, path: str, file_path: str):
+        try:
+            st = os.stat(file_path)
+        except FileNotFoundError:
+            return None
+        try:
+            with open(self._meta_path(path), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            # 直接配置されたファイルは更新時刻を世代番号とする
+            meta = {
+                "generation": st.st_mtime_ns // 1000,
+                "content_type": mimetypes.guess_type(path)[0],
+            }
+        return ObjectInfo(
+            name=path,
+            generation=meta["generation"],
+            size=st.st_size,
+            updated=datetime.fromtimestamp(st.st_mtime, timezone.utc),
+            content_type=meta.get("content_type"),
+            metadata=meta.get("metadata"),
+        )
+
+    def _write_file(self, file_path: str, data: bytes):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        tmp_path = os.path.join(
+            self._directory,
+            self.TMP_DIR,
+            f"{os.getpid()}.{threading.get_ident()}.tmp",
+        )
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        # 書き込み済みのファイルで置き換え、途中の状態を読み込ませない
+        os.replace(tmp_path, file_path)
+
+    @staticmethod
+    def _read_file(file_path: str):
+        try:
+            with open(file_path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock:
+            with open(os.path.join(self._directory, self.LOCK_FILE), "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def create_storage_backend(bucket_name: str) -> StorageBackend:
+    """
+    環境変数STORAGE_DIRが指定されていればローカル、それ以外はGCSの保存先を返す
+    """
+    if STORAGE_DIR:
+        return LocalStorageBackend(os.path.join(STORAGE_DIR, bucket_name))
+    return GCSStorageBackend(bucket_name)
@@ -0,0 +1,19 @@
+import os
+import sys
+import pytest
+
+# テストはsrc/backendのモジュールを直接importする（python -m pytest tests をsrc/backendで実行）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def local_storage(tmp_path, monkeypatch):
+    """
+    既定のバケットの保存先をローカルディレクトリ（LocalStorageBackend）に差し替える
+    """
+    import utils
+    from storage_backend import LocalStorageBackend
+
+    store = LocalStorageBackend(str(tmp_path / utils.GCS_BUCKET_NAME))
+    monkeypatch.setitem(utils._storages, utils.GCS_BUCKET_NAME, store)
+    return store
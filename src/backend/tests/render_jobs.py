@@ -0,0 +1,24 @@
+import subprocess
+from pipeline import unlimited_process_memory
+
+# RenderProcessPoolのプロセスで実行する関数（spawnで起動したプロセスからimportできるよう、テストとは別のモジュールに置く）
+
+
+def child_data_limit(lifted: bool) -> str:
+    """
+    子プロセスに引き継がれたRLIMIT_DATAのソフトリミットを返す
+    """
+    command = ["sh", "-c", "ulimit -d"]
+    if not lifted:
+        return subprocess.check_output(command, text=True).strip()
+    with unlimited_process_memory():
+        return subprocess.check_output(command, text=True).strip()
+
+
+def render_png() -> int:
+    import plotly.graph_objects as go
+    import plotly.io as pio
+
+    figure = go.Figure(go.Scatter3d(x=[0, 1], y=[0, 1], z=[0, 1]))
+    with unlimited_process_memory():
+        return len(pio.to_image(figure, format="png"))
@@ -0,0 +1,55 @@
+import artifact_cache as artifact_cache_module
+from artifact_cache import ArtifactCache, ImageCache
+
+
+def test_artifact_cache_keeps_the_latest_generation_per_path():
+    cache = ArtifactCache(max_bytes=100)
+    cache.put("store", "a.json", 1, b"old")
+    cache.put("store", "a.json", 2, b"new")
+    assert cache.lookup("store", "a.json") == (2, b"new")
+    assert cache.lookup("other", "a.json") is None
+    assert cache.stats()["bytes"] == 3
+
+
+def test_artifact_cache_evicts_least_recently_used():
+    cache = ArtifactCache(max_bytes=10)
+    cache.put("store", "a", 1, b"aaaa")
+    cache.put("store", "b", 1, b"bbbb")
+    cache.lookup("store", "a")
+    cache.put("store", "c", 1, b"cccc")
+    assert cache.lookup("store", "b") is None
+    assert cache.lookup("store", "a") is not None
+    stats = cache.stats()
+    assert (stats["entries"], stats["bytes"], stats["evictions"]) == (2, 8, 1)
+
+
+def test_artifact_cache_skips_entries_larger_than_the_limit():
+    cache = ArtifactCache(max_bytes=4)
+    cache.put("store", "a", 1, b"12345")
+    assert cache.lookup("store", "a") is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_image_cache_expires_entries_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(artifact_cache_module.time, "monotonic", lambda: now[0])
+    cache = ImageCache(max_bytes=100, ttl_sec=60)
+    cache.put("plan", b"image", "image/png")
+    now[0] += 59
+    assert cache.get("plan") == (b"image", "image/png")
+    now[0] += 1
+    assert cache.get("plan") is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["expired"]) == (1, 1, 1)
+    assert stats["bytes"] == 0
+
+
+def test_image_cache_evicts_oldest_when_over_the_byte_limit():
+    cache = ImageCache(max_bytes=10, ttl_sec=60)
+    cache.put("plan-1", b"12345", "image/png")
+    cache.put("plan-2", b"12345", "image/png")
+    cache.get("plan-1")
+    cache.put("plan-3", b"12345", "image/png")
+    assert cache.get("plan-2") is None
+    assert cache.get("plan-1") is not None
+    assert cache.stats()["evictions"] == 1
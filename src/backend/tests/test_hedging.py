@@ -0,0 +1,86 @@
+import asyncio
+import time
+from hedging import Hedger
+
+WARMUP_SEC = 0.05
+
+
+def make_hedger(**kwargs) -> Hedger:
+    """
+    応答時間のサンプル1件（WARMUP_SEC）を記録し、ヘッジの待ち時間をWARMUP_SECとしたHedgerを返す
+    """
+    hedger = Hedger("test", enabled=True, min_samples=1, percentile=50, **kwargs)
+
+    async def warmup():
+        await asyncio.sleep(WARMUP_SEC)
+        return "warmup"
+
+    asyncio.run(hedger.run(warmup))
+    assert hedger.hedge_delay() >= WARMUP_SEC
+    return hedger
+
+
+class SlowThenFast:
+    """
+    1回目の呼び出しは応答せず、2回目以降の呼び出しはすぐに応答するリクエスト
+    """
+
+    def __init__(self):
+        self.started = []
+        self.cancelled = []
+
+    def __call__(self):
+        return self._request(len(self.started))
+
+    async def _request(self, index: int):
+        self.started.append(time.monotonic())
+        if index > 0:
+            return f"response-{index}"
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            self.cancelled.append(index)
+            raise
+        return "response-0"
+
+
+def test_hedge_is_sent_after_the_percentile_delay():
+    hedger = make_hedger()
+    request = SlowThenFast()
+    assert asyncio.run(hedger.run(request)) == "response-1"
+    assert len(request.started) == 2
+    # ヘッジは直近の応答時間のパーセンタイルを過ぎてから送る
+    assert request.started[1] - request.started[0] >= WARMUP_SEC
+
+
+def test_first_success_wins_and_the_other_request_is_cancelled():
+    hedger = make_hedger()
+    request = SlowThenFast()
+    assert asyncio.run(hedger.run(request)) == "response-1"
+    assert request.cancelled == [0]
+    stats = hedger.stats()
+    assert (stats["hedged"], stats["hedge_won"], stats["primary_won"]) == (1, 1, 0)
+
+
+def test_hedge_is_skipped_when_the_budget_is_exhausted():
+    hedger = make_hedger(max_extra_ratio=0, burst=0)
+
+    async def slow():
+        await asyncio.sleep(WARMUP_SEC * 3)
+        return "primary"
+
+    calls = []
+
+    def request():
+        calls.append(1)
+        return slow()
+
+    assert asyncio.run(hedger.run(request)) == "primary"
+    assert len(calls) == 1
+    stats = hedger.stats()
+    assert (stats["hedged"], stats["budget_exhausted"]) == (0, 1)
+
+
+def test_no_hedge_until_enough_samples():
+    hedger = Hedger("test", enabled=True, min_samples=2)
+    assert hedger.hedge_delay() is None
@@ -0,0 +1,69 @@
+import threading
+import pytest
+from job_queue import JobQueue, QueueWaitEstimator
+from pipeline import AdmissionController
+
+
+@pytest.fixture
+def queue(local_storage):
+    # 保存先（LocalStorageBackend）の _queue/ をジョブキューとする
+    return JobQueue()
+
+
+def test_enqueue_keeps_one_pending_job_per_plan_and_stage(queue):
+    assert queue.enqueue("plan-1", "parts_list")
+    assert not queue.enqueue("plan-1", "parts_list")
+    assert queue.enqueue("plan-1", "parts3d")
+    assert queue.pending_count("parts_list") == 1
+
+
+def test_claim_returns_jobs_of_the_given_stages(queue):
+    queue.enqueue("plan-1", "parts_list")
+    queue.enqueue("plan-2", "manual_pdf")
+    entry = queue.claim(["parts_list"])
+    assert (entry["plan_id"], entry["stage"]) == ("plan-1", "parts_list")
+    assert queue.claim(["parts_list"]) is None
+    assert queue.claim(["parts_list", "manual_pdf"])["plan_id"] == "plan-2"
+    # 取り出した後は同じジョブを再び投入できる
+    assert queue.enqueue("plan-1", "parts_list")
+
+
+def test_each_job_is_claimed_by_one_worker(queue):
+    for i in range(20):
+        queue.enqueue(f"plan-{i}", "parts_list")
+    claimed = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            entry = queue.claim(["parts_list"])
+            if entry is None:
+                return
+            with lock:
+                claimed.append(entry["plan_id"])
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(claimed) == sorted(f"plan-{i}" for i in range(20))
+
+
+def test_remove_drops_a_pending_job(queue):
+    queue.enqueue("plan-1", "parts_list")
+    assert queue.remove("plan-1", "parts_list")
+    assert not queue.remove("plan-1", "parts_list")
+    assert queue.claim(["parts_list"]) is None
+
+
+def test_wait_is_estimated_from_the_queue_backlog(queue):
+    stages = {"parts_list": {"max_workers": 2, "expected_run_sec": 60}}
+    estimator = QueueWaitEstimator(queue, stages)
+    assert estimator.estimated_wait("parts_list") == 0
+    for i in range(6):
+        queue.enqueue(f"plan-{i}", "parts_list")
+    # 待機中の6件を2件ずつ実行した後に取り出される
+    assert estimator.estimated_wait("parts_list") == 180
+    admission = AdmissionController(estimator, max_estimated_wait_sec=120)
+    assert admission.retry_after(["parts_list"]) == 60
@@ -0,0 +1,269 @@
+import asyncio
+import threading
+import time
+import pytest
+import render_jobs
+from pipeline import (
+    AdmissionController,
+    Deadline,
+    RenderProcessPool,
+    SingleFlightRegistry,
+    StageExecutor,
+    StageQueueFullError,
+    StageTimeoutError,
+)
+
+STAGES = {
+    "parts_list": {"runner": "async", "max_workers": 4, "max_queue": 2},
+    "manual_pdf": {"max_workers": 1, "max_queue": 2},
+}
+LANES = {
+    "interactive": {"weight": 4, "stages": ["parts_list"]},
+    "background": {"weight": 1, "stages": ["manual_pdf"]},
+}
+
+
+@pytest.fixture
+def executor():
+    executor = StageExecutor(STAGES, {"max_running": 8, "lanes": LANES})
+    yield executor
+
+    async def drain():
+        # 完了通知（Futureへの結果の設定）を待っているタスクを終わらせてからイベントループを止める
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run_coroutine_threadsafe(drain(), executor._event_loop.loop).result(2)
+    executor.shutdown()
+
+
+def wait_until(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_burst_of_async_submits_is_not_rejected_while_slots_are_free(executor):
+    # イベントループを止め、投入したジョブの開始処理（_on_started）が走らない状態で投入する
+    loop_blocked = threading.Event()
+    executor._event_loop.loop.call_soon_threadsafe(loop_blocked.wait)
+    release = asyncio.Event()
+
+    async def job():
+        await release.wait()
+
+    try:
+        futures = [executor.submit("parts_list", job) for _ in range(4)]
+        stats = executor.stats()["parts_list"]
+        assert stats["queued"] == 0
+        assert stats["running"] == 4
+        # 実行枠が埋まった後は待ち行列の上限（2）まで受け付ける
+        futures += [executor.submit("parts_list", job) for _ in range(2)]
+        with pytest.raises(StageQueueFullError):
+            executor.submit("parts_list", job)
+    finally:
+        loop_blocked.set()
+    executor._event_loop.loop.call_soon_threadsafe(release.set)
+    for future in futures:
+        future.result(timeout=2)
+    wait_until(lambda: executor.stats()["parts_list"]["completed"] == 6)
+    stats = executor.stats()["parts_list"]
+    assert (stats["queued"], stats["running"]) == (0, 0)
+
+
+@pytest.fixture
+def blocking_executor():
+    # ワーカープールで実行するステージのみ（ジョブはreleaseされるまで実行中のままになる）
+    stages = {
+        "parts_list": {"max_workers": 4, "max_queue": 10, "expected_run_sec": 60},
+        "manual_pdf": {"max_workers": 4, "max_queue": 10, "expected_run_sec": 30},
+    }
+    executor = StageExecutor(stages, {"max_running": 2, "lanes": LANES})
+    release = threading.Event()
+    yield executor, release.wait
+    release.set()
+    executor.shutdown()
+
+
+def test_estimated_wait_counts_jobs_of_the_same_stage():
+    executor = StageExecutor({"manual_pdf": {"max_workers": 1, "expected_run_sec": 30}})
+    release = threading.Event()
+    try:
+        assert executor.estimated_wait("manual_pdf") == 0.0
+        for _ in range(3):
+            executor.submit("manual_pdf", release.wait)
+        wait_until(lambda: executor.stats()["manual_pdf"]["running"] == 1)
+        # 実行中1件・待ち2件の後に投入したジョブは3件分の実行時間を待つ
+        assert executor.estimated_wait("manual_pdf") == pytest.approx(90.0)
+    finally:
+        release.set()
+        executor.shutdown()
+
+
+def test_estimated_wait_counts_jobs_of_other_lanes_sharing_max_running(
+    blocking_executor,
+):
+    executor, job = blocking_executor
+    for _ in range(4):
+        executor.submit("parts_list", job)
+    wait_until(lambda: executor.stats()["parts_list"]["running"] == 2)
+    stats = executor.stats()["manual_pdf"]
+    assert (stats["queued"], stats["running"]) == (0, 0)
+    # manual_pdfの同時実行数には空きがあるが、全体の実行枠（2）は他のレーンで埋まっており、
+    # 重みの大きいレーンの待ち2件が先に実行される
+    assert executor.estimated_wait("manual_pdf") == pytest.approx((4 - 2 + 1) / 2 * 60)
+
+
+def test_admission_rejects_with_retry_after_when_the_pipeline_is_full():
+    stages = {
+        "parts_list": {"max_workers": 1, "expected_run_sec": 60},
+        "manual_pdf": {"max_workers": 1, "expected_run_sec": 30},
+    }
+    executor = StageExecutor(stages)
+    admission = AdmissionController(executor, max_estimated_wait_sec=60)
+    release = threading.Event()
+    try:
+        assert admission.retry_after(["parts_list", "manual_pdf"]) == 0
+        futures = [executor.submit("manual_pdf", release.wait) for _ in range(3)]
+        wait_until(lambda: executor.stats()["manual_pdf"]["running"] == 1)
+        # 見積もり待ち時間（3件分の90秒）が上限の60秒を下回るまでの秒数を返す
+        assert admission.retry_after(["parts_list"]) == 0
+        assert admission.retry_after(["parts_list", "manual_pdf"]) == 30
+        release.set()
+        for future in futures:
+            future.result(timeout=2)
+        assert admission.retry_after(["parts_list", "manual_pdf"]) == 0
+    finally:
+        release.set()
+        executor.shutdown()
+
+
+def test_lanes_are_picked_by_weight():
+    stages = {"parts_list": {"max_workers": 4}, "manual_pdf": {"max_workers": 4}}
+    executor = StageExecutor(stages, {"max_running": 1, "lanes": LANES})
+    release = threading.Event()
+    started = []
+    try:
+        blocker = executor.submit("manual_pdf", release.wait)
+        futures = []
+        for _ in range(5):
+            futures.append(executor.submit("manual_pdf", started.append, "manual_pdf"))
+            futures.append(executor.submit("parts_list", started.append, "parts_list"))
+        release.set()
+        blocker.result(timeout=2)
+        for future in futures:
+            future.result(timeout=2)
+    finally:
+        executor.shutdown()
+    # 重み4:1のレーンに待ちがあれば、5件中4件は重みの大きいレーンから取り出す
+    assert started[:5].count("parts_list") == 4
+    assert started[5:] == ["parts_list"] + ["manual_pdf"] * 4
+
+
+def test_single_flight_attaches_to_the_running_job():
+    executor = StageExecutor({"parts_list": {"max_workers": 2}})
+    registry = SingleFlightRegistry(executor)
+    release = threading.Event()
+    calls = []
+
+    def job():
+        calls.append(1)
+        release.wait()
+        return "result"
+
+    try:
+        first = registry.trigger("plan", "parts_list", job)
+        second = registry.trigger("plan", "parts_list", job)
+        assert second is first
+        release.set()
+        assert first.result(timeout=2) == "result"
+        # 完了済みのジョブは結果を保持せず、完了の記録のみで再実行を抑止する
+        wait_until(
+            lambda: registry.trigger("plan", "parts_list", job).result(timeout=2)
+            is None
+        )
+        assert len(calls) == 1
+    finally:
+        release.set()
+        executor.shutdown()
+
+
+def test_single_flight_runs_again_after_failure():
+    executor = StageExecutor({"parts_list": {"max_workers": 1}})
+    registry = SingleFlightRegistry(executor)
+
+    def failing():
+        raise RuntimeError("failed")
+
+    try:
+        failed = registry.trigger("plan", "parts_list", failing)
+        with pytest.raises(RuntimeError):
+            failed.result(timeout=2)
+        retried = registry.trigger("plan", "parts_list", lambda: "result")
+        assert retried is not failed
+        assert retried.result(timeout=2) == "result"
+    finally:
+        executor.shutdown()
+
+
+def test_single_flight_releases_its_own_lease(local_storage):
+    from stage_lease import StageLeaseManager
+
+    executor = StageExecutor({"parts_list": {"max_workers": 2}})
+    leases = StageLeaseManager(heartbeat_sec=3600, holder="a")
+    registry = SingleFlightRegistry(executor, lease=leases)
+    release = threading.Event()
+    try:
+        first = registry.trigger("plan", "parts_list", release.wait, input_key="v1")
+        # 入力が更新されたジョブは同じインスタンスでリースを取得し直して実行する
+        second = registry.trigger("plan", "parts_list", lambda: "v2", input_key="v2")
+        assert second.result(timeout=2) == "v2"
+        release.set()
+        first.result(timeout=2)
+        wait_until(lambda: not leases.is_leased("plan", "parts_list"))
+    finally:
+        release.set()
+        executor.shutdown()
+
+
+def test_stage_past_its_deadline_times_out_and_releases_its_entry(
+    executor, local_storage
+):
+    from plan_status import PlanStatusStore
+    from stage_lease import StageLeaseManager
+
+    status = PlanStatusStore()
+    leases = StageLeaseManager(heartbeat_sec=3600, holder="a")
+    registry = SingleFlightRegistry(executor, listeners=[status], lease=leases)
+
+    async def slow_stage():
+        deadline = Deadline("parts_list", 0.05)
+        return await deadline.run(asyncio.sleep(10))
+
+    job = registry.trigger("plan", "parts_list", slow_stage)
+    with pytest.raises(StageTimeoutError):
+        job.result(timeout=2)
+    wait_until(lambda: status.get("plan")["stages"]["parts_list"]["state"] == "timeout")
+    assert not leases.is_leased("plan", "parts_list")
+    # 期限切れのジョブには合流せず、次の起動で再実行する
+    retried = registry.trigger("plan", "parts_list", lambda: "result")
+    assert retried is not job
+    assert retried.result(timeout=2) == "result"
+
+
+@pytest.fixture
+def render_pool():
+    pool = RenderProcessPool(max_workers=1, memory_limit_mb=128)
+    yield pool
+    pool.shutdown()
+
+
+def test_render_pool_does_not_pass_its_memory_limit_to_child_processes(render_pool):
+    assert render_pool.run(render_jobs.child_data_limit, False) == str(128 * 1024)
+    assert render_pool.run(render_jobs.child_data_limit, True) == "unlimited"
+
+
+def test_kaleido_starts_under_the_render_pool_memory_limit(render_pool):
+    pytest.importorskip("kaleido")
+    assert render_pool.run(render_jobs.render_png) > 0
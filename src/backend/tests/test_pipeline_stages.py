@@ -0,0 +1,103 @@
+import json
+import time
+import uuid
+import pytest
+import pipeline_stages
+from utils import GCS_BUCKET_NAME
+
+PARTS_LIST = [{"name": "板", "count": 2}]
+PARTS3D = [{"name": "板", "position": [0, 0, 0]}]
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def llm(monkeypatch):
+    """
+    LLMを呼び出す処理を、呼び出しを記録して固定の結果を返す処理に差し替える
+    """
+    calls = []
+
+    def fake(name, result):
+        async def call(*args, timeout=None):
+            calls.append(name)
+            return result
+
+        monkeypatch.setattr(pipeline_stages, name, call)
+
+    fake("detect_parts_location_from_bytes_async", PARTS3D)
+    fake("generate_parts_making_async", {"steps": ["切る"]})
+    fake("generate_assembly_manual_async", {"steps": ["組み立てる"]})
+    return calls
+
+
+@pytest.fixture
+def plan_id():
+    # ステージのレジストリ・状態はモジュールで共有されるため、テストごとに別のplanとする
+    return str(uuid.uuid4())
+
+
+def stage_state(plan_id, stage):
+    record = pipeline_stages.status_store.get(plan_id) or {"stages": {}}
+    return record["stages"].get(stage, {}).get("state")
+
+
+def test_finished_stage_eagerly_triggers_its_dependents(
+    local_storage, llm, plan_id, monkeypatch
+):
+    monkeypatch.setattr(pipeline_stages, "EAGER_PIPELINE", True)
+    built = []
+    monkeypatch.setattr(
+        pipeline_stages,
+        "make_manual_pdf",
+        lambda plan_id, bucket_name, render_pool=None: built.append(plan_id),
+    )
+
+    job = pipeline_stages.trigger_parts3d(
+        b"image", "image/png", PARTS_LIST, plan_id, GCS_BUCKET_NAME
+    )
+    assert job.result(timeout=5) == PARTS3D
+    # 部品3Dモデルの完了時に部品作成手順・組立手順を起動し、両方の完了後にPDFを生成する
+    wait_until(lambda: built == [plan_id])
+    assert sorted(llm) == [
+        "detect_parts_location_from_bytes_async",
+        "generate_assembly_manual_async",
+        "generate_parts_making_async",
+    ]
+    for stage in ("parts3d", "parts_manual", "assembly_manual"):
+        assert local_storage.exists(f"{plan_id}/{stage}.json")
+        wait_until(lambda: stage_state(plan_id, stage) == "done")
+
+
+def test_journaled_jobs_are_resubmitted_on_startup(local_storage, llm, plan_id):
+    local_storage.put(f"{plan_id}/image.png", b"image", content_type="image/png")
+    local_storage.put(
+        f"{plan_id}/parts_list.json",
+        json.dumps(PARTS_LIST).encode(),
+        content_type="application/json",
+    )
+    # 前回のプロセスが部品3Dモデル作成の実行中に停止した
+    pipeline_stages.job_journal.stage_started(plan_id, "parts3d")
+    assert [
+        entry["stage"]
+        for entry in pipeline_stages.job_journal.unfinished()
+        if entry["plan_id"] == plan_id
+    ] == ["parts3d"]
+
+    pipeline_stages.resume_unfinished_jobs()
+
+    wait_until(lambda: stage_state(plan_id, "parts3d") == "done")
+    assert json.loads(local_storage.get(f"{plan_id}/parts3d.json")) == PARTS3D
+    assert "detect_parts_location_from_bytes_async" in llm
+    # 完了したジョブはジャーナルから削除される
+    wait_until(
+        lambda: not any(
+            entry["plan_id"] == plan_id
+            for entry in pipeline_stages.job_journal.unfinished()
+        )
+    )
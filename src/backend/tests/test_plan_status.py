@@ -0,0 +1,139 @@
+import json
+from plan_status import PlanStatusStore, STATUS_FILENAME
+
+PLAN_ID = "00000000-0000-4000-8000-000000000000"
+
+
+def stored_status(store):
+    return json.loads(store.get(f"{PLAN_ID}/{STATUS_FILENAME}"))
+
+
+def test_updates_from_different_instances_are_merged(local_storage):
+    # 2つのワーカーがそれぞれのステージの状態を更新する
+    worker_a = PlanStatusStore()
+    worker_b = PlanStatusStore()
+    worker_a.update(PLAN_ID, "parts_list", "running")
+    worker_b.update(PLAN_ID, "parts3d", "running")
+    worker_a.update(PLAN_ID, "parts_list", "done")
+
+    record = stored_status(local_storage)
+    assert record["stages"]["parts_list"]["state"] == "done"
+    assert record["stages"]["parts3d"]["state"] == "running"
+    assert record["version"] == 3
+    # 書き込んだ内容（他のワーカーの更新を含む）がメモリ上の状態になる
+    assert worker_a.get(PLAN_ID)["stages"]["parts3d"]["state"] == "running"
+
+
+def test_version_never_goes_backwards(local_storage):
+    worker_a = PlanStatusStore()
+    worker_b = PlanStatusStore()
+    versions = []
+    for _ in range(3):
+        worker_a.update(PLAN_ID, "parts_list", "running")
+        versions.append(stored_status(local_storage)["version"])
+    worker_b.update(PLAN_ID, "parts3d", "running")
+    versions.append(stored_status(local_storage)["version"])
+    assert versions == sorted(set(versions))
+
+
+def test_cancellation_is_merged(local_storage):
+    worker_a = PlanStatusStore()
+    worker_b = PlanStatusStore()
+    worker_a.update(PLAN_ID, "parts_list", "done")
+    worker_b.update(PLAN_ID, "parts3d", "running")
+    worker_a.cancel(PLAN_ID)
+
+    record = stored_status(local_storage)
+    assert "cancelled_at" in record
+    assert record["stages"]["parts_list"]["state"] == "done"
+    assert record["stages"]["parts3d"]["state"] == "cancelled"
+    assert PlanStatusStore(shared=True).is_cancelled(PLAN_ID)
+
+
+def test_write_is_retried_when_another_instance_wrote_in_between(
+    local_storage, monkeypatch
+):
+    import plan_status
+
+    worker_a = PlanStatusStore()
+    worker_b = PlanStatusStore()
+    worker_a.update(PLAN_ID, "parts_list", "running")
+    upload = plan_status.upload_json_if_generation_match
+    calls = []
+
+    def racing_upload(store, path, data, generation):
+        # worker_aが読み込んでから書き込むまでの間にworker_bが書き込む
+        if not calls:
+            calls.append(generation)
+            worker_b.update(PLAN_ID, "parts3d", "running")
+        return upload(store, path, data, generation)
+
+    monkeypatch.setattr(plan_status, "upload_json_if_generation_match", racing_upload)
+    worker_a.update(PLAN_ID, "parts_list", "done")
+
+    record = stored_status(local_storage)
+    assert record["stages"]["parts_list"]["state"] == "done"
+    assert record["stages"]["parts3d"]["state"] == "running"
+
+
+def test_cancel_from_the_web_server_is_recorded_in_status(local_storage):
+    worker = PlanStatusStore()
+    web = PlanStatusStore(shared=True)
+    worker.update(PLAN_ID, "parts_list", "done")
+    worker.update(PLAN_ID, "parts3d", "running")
+    web.cancel(PLAN_ID)
+    # ワーカーが実行中のステージを中断した後も取り消しは保持される
+    worker.update(PLAN_ID, "parts3d", "cancelled")
+
+    record = web.get(PLAN_ID)
+    assert "cancelled_at" in record
+    assert record["stages"]["parts_list"]["state"] == "done"
+    assert record["stages"]["parts3d"]["state"] == "cancelled"
+    assert worker.is_cancelled(PLAN_ID)
+
+
+def test_shared_reads_revalidate_the_cached_status(local_storage, monkeypatch):
+    from utils import artifact_cache
+
+    PlanStatusStore().update(PLAN_ID, "parts_list", "running")
+    web = PlanStatusStore(shared=True)
+    # 状態の参照では取り消しの有無を別に確認しない
+    monkeypatch.setattr(local_storage, "exists", None)
+    hits = artifact_cache.stats()["hits"]
+    assert web.get(PLAN_ID)["stages"]["parts_list"]["state"] == "running"
+    assert web.get(PLAN_ID)["stages"]["parts_list"]["state"] == "running"
+    assert artifact_cache.stats()["hits"] == hits + 1
+
+
+def test_is_cancelled_reuses_recent_checks(local_storage, monkeypatch):
+    store = PlanStatusStore(cancel_check_ttl_sec=60)
+    calls = []
+    exists = local_storage.exists
+    monkeypatch.setattr(
+        local_storage, "exists", lambda path: calls.append(path) or exists(path)
+    )
+    assert not store.is_cancelled(PLAN_ID)
+    assert not store.is_cancelled(PLAN_ID)
+    assert len(calls) == 1
+    # このインスタンスでの取り消しは直ちに反映される
+    store.update(PLAN_ID, "parts_list", "running")
+    store.cancel(PLAN_ID)
+    assert store.is_cancelled(PLAN_ID)
+    assert len(calls) == 1
+
+
+def test_is_cancelled_answers_from_the_in_memory_record(local_storage, monkeypatch):
+    store = PlanStatusStore()
+    store.update(PLAN_ID, "parts_list", "running")
+    store.cancel(PLAN_ID)
+    reloaded = PlanStatusStore()
+    reloaded.get(PLAN_ID)
+    monkeypatch.setattr(local_storage, "exists", None)
+    assert reloaded.is_cancelled(PLAN_ID)
+
+
+def test_cancel_on_another_instance_is_seen_after_the_ttl(local_storage):
+    worker = PlanStatusStore(cancel_check_ttl_sec=0)
+    assert not worker.is_cancelled(PLAN_ID)
+    PlanStatusStore(shared=True).cancel(PLAN_ID)
+    assert worker.is_cancelled(PLAN_ID)
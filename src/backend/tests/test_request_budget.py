@@ -0,0 +1,19 @@
+from request_budget import RequestBudget
+
+
+def test_budget_allows_burst_then_refills_by_ratio():
+    budget = RequestBudget(ratio=0.5, burst=2)
+    assert budget.try_acquire() and budget.try_acquire()
+    assert not budget.try_acquire()
+    # 通常のリクエスト2件で追加のリクエスト1件分のトークンが貯まる
+    budget.on_request()
+    assert not budget.try_acquire()
+    budget.on_request()
+    assert budget.try_acquire()
+
+
+def test_budget_does_not_exceed_burst():
+    budget = RequestBudget(ratio=1, burst=2)
+    for _ in range(10):
+        budget.on_request()
+    assert [budget.try_acquire() for _ in range(3)] == [True, True, False]
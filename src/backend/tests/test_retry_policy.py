@@ -0,0 +1,139 @@
+import asyncio
+import pytest
+import requests
+import retry_policy
+from hedging import Hedger
+from request_budget import RequestBudget
+from retry_policy import RetryPolicy, is_retryable
+
+
+class APIError(Exception):
+    """
+    ステータスコードを持つ例外（google.genai.errors.APIError等）
+    """
+
+    def __init__(self, code: int):
+        super().__init__(f"status {code}")
+        self.code = code
+
+
+class FailingCall:
+    """
+    指定回数だけ例外を送出し、その後は"ok"を返す呼び出し
+    """
+
+    def __init__(self, exc: Exception, failures: int):
+        self.exc = exc
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.exc
+        return "ok"
+
+
+def make_policy(budget=None, **kwargs) -> RetryPolicy:
+    kwargs.setdefault("initial_backoff_sec", 0)
+    return RetryPolicy("test", budget or RequestBudget(1, 10), **kwargs)
+
+
+@pytest.mark.parametrize("code", [408, 429, 500, 502, 503, 504])
+def test_transient_status_codes_are_retryable(code):
+    assert is_retryable(APIError(code))
+
+
+@pytest.mark.parametrize("code", [400, 401, 403, 404, 409])
+def test_client_errors_are_not_retryable(code):
+    assert not is_retryable(APIError(code))
+
+
+@pytest.mark.parametrize(
+    "exc, retryable",
+    [
+        (ConnectionError(), True),
+        (TimeoutError(), True),
+        (requests.exceptions.ConnectionError(), True),
+        (requests.exceptions.ReadTimeout(), True),
+        (ValueError(), False),
+        (KeyError(), False),
+    ],
+)
+def test_retryable_exceptions(exc, retryable):
+    assert is_retryable(exc) is retryable
+
+
+def test_retries_until_the_call_succeeds():
+    policy = make_policy(max_attempts=3)
+    call = FailingCall(APIError(503), failures=2)
+    assert policy.call(call) == "ok"
+    assert call.calls == 3
+    stats = policy.stats()
+    assert (stats["retries"], stats["recovered"], stats["failed"]) == (2, 1, 0)
+
+
+def test_gives_up_after_max_attempts():
+    policy = make_policy(max_attempts=3)
+    call = FailingCall(APIError(503), failures=10)
+    with pytest.raises(APIError):
+        policy.call(call)
+    assert call.calls == 3
+    assert policy.stats()["failed"] == 1
+
+
+def test_does_not_retry_non_retryable_errors():
+    policy = make_policy(max_attempts=3)
+    call = FailingCall(ValueError("bad request"), failures=1)
+    with pytest.raises(ValueError):
+        policy.call(call)
+    assert call.calls == 1
+    assert policy.stats()["retries"] == 0
+
+
+def test_does_not_retry_when_the_budget_is_exhausted():
+    policy = make_policy(budget=RequestBudget(0, 0), max_attempts=3)
+    call = FailingCall(APIError(503), failures=1)
+    with pytest.raises(APIError):
+        policy.call(call)
+    assert call.calls == 1
+    assert policy.stats()["budget_exhausted"] == 1
+
+
+def test_backoff_grows_exponentially_up_to_the_limit(monkeypatch):
+    policy = make_policy(initial_backoff_sec=1, multiplier=2, max_backoff_sec=5)
+    # 待ち時間は上限までの一様乱数のため、上限を返すようにして確認する
+    monkeypatch.setattr(retry_policy.random, "uniform", lambda low, high: high)
+    assert [policy.backoff(attempt) for attempt in range(1, 6)] == [1, 2, 4, 5, 5]
+    monkeypatch.undo()
+    assert all(0 <= policy.backoff(4) <= 5 for _ in range(100))
+
+
+def test_call_async_retries_transient_errors():
+    policy = make_policy(max_attempts=2)
+    call = FailingCall(APIError(429), failures=1)
+
+    async def request():
+        return call()
+
+    assert asyncio.run(policy.call_async(request)) == "ok"
+    assert call.calls == 2
+
+
+def test_retries_and_hedges_share_one_budget():
+    budget = RequestBudget(0, 1)
+    policy = make_policy(budget=budget, max_attempts=3)
+    hedger = Hedger("test", enabled=True, min_samples=0, percentile=0, budget=budget)
+
+    async def respond(delay):
+        await asyncio.sleep(delay)
+        return "ok"
+
+    # すぐに返る応答の時間を記録した後、応答の遅い呼び出しでヘッジが上限のトークンを消費する
+    asyncio.run(policy.call_async(lambda: hedger.run(lambda: respond(0))))
+    asyncio.run(policy.call_async(lambda: hedger.run(lambda: respond(0.05))))
+    assert hedger.stats()["hedged"] == 1
+    call = FailingCall(APIError(503), failures=1)
+    with pytest.raises(APIError):
+        policy.call(call)
+    assert policy.stats()["budget_exhausted"] == 1
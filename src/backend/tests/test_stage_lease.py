@@ -0,0 +1,59 @@
+import json
+from stage_lease import StageLeaseManager
+
+PLAN_ID = "00000000-0000-4000-8000-000000000000"
+
+
+def lease_manager(holder):
+    return StageLeaseManager(ttl_sec=60, heartbeat_sec=3600, holder=holder)
+
+
+def stored_lease(store):
+    data = store.get(f"_lease/{PLAN_ID}/parts_list.json")
+    return json.loads(data) if data is not None else None
+
+
+def test_lease_is_exclusive_between_instances(local_storage):
+    instance_a = lease_manager("a")
+    instance_b = lease_manager("b")
+    token = instance_a.acquire(PLAN_ID, "parts_list")
+    assert token is not None
+    assert instance_b.acquire(PLAN_ID, "parts_list") is None
+    assert instance_b.is_leased(PLAN_ID, "parts_list")
+
+    instance_a.release(token)
+    assert stored_lease(local_storage) is None
+    assert instance_b.acquire(PLAN_ID, "parts_list") is not None
+
+
+def test_expired_lease_can_be_taken_over(local_storage):
+    instance_a = StageLeaseManager(ttl_sec=-1, heartbeat_sec=3600, holder="a")
+    instance_b = lease_manager("b")
+    token = instance_a.acquire(PLAN_ID, "parts_list")
+    assert instance_b.acquire(PLAN_ID, "parts_list") is not None
+    # 期限切れ後に他のインスタンスが取得したリースは延長・解放しない
+    instance_a.renew_all()
+    instance_a.release(token)
+    assert stored_lease(local_storage)["holder"] == "b"
+
+
+def test_release_with_superseded_token_keeps_the_newer_lease(local_storage):
+    instance = lease_manager("a")
+    first = instance.acquire(PLAN_ID, "parts_list")
+    second = instance.acquire(PLAN_ID, "parts_list")
+    assert first != second
+    # 先に取得したジョブの解放で、取得し直したリースを削除しない
+    instance.release(first)
+    assert stored_lease(local_storage) is not None
+    instance.release(second)
+    assert stored_lease(local_storage) is None
+
+
+def test_renew_all_extends_held_leases(local_storage):
+    instance = lease_manager("a")
+    instance.acquire(PLAN_ID, "parts_list")
+    expires_at = stored_lease(local_storage)["expires_at"]
+    instance.renew_all()
+    assert stored_lease(local_storage)["expires_at"] > expires_at
+    instance.stop()
+    assert stored_lease(local_storage) is None
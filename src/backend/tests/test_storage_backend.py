@@ -0,0 +1,32 @@
+from storage_backend import LocalStorageBackend
+
+
+def test_put_is_conditional_on_generation(tmp_path):
+    store = LocalStorageBackend(str(tmp_path))
+    generation = store.put("a.json", b"1", if_generation_match=0)
+    assert generation is not None
+    assert store.put("a.json", b"2", if_generation_match=0) is None
+    assert store.put("a.json", b"2", if_generation_match=generation) > generation
+    assert not store.delete("a.json", if_generation_match=generation)
+    assert store.get("a.json") == b"2"
+
+
+def test_read_returns_generation_size_and_content_type_only(tmp_path):
+    store = LocalStorageBackend(str(tmp_path))
+    generation = store.put(
+        "a.json", b"{}", content_type="application/json", metadata={"k": "v"}
+    )
+    data, info = store.read("a.json")
+    assert data == b"{}"
+    assert (info.generation, info.size, info.content_type) == (
+        generation,
+        2,
+        "application/json",
+    )
+    # 更新日時・メタデータはstatで取得する（GCSのダウンロード応答からは得られないため）
+    assert info.updated is None and info.metadata == {}
+    assert store.stat("a.json").metadata == {"k": "v"}
+
+    data, info = store.read("a.json", if_generation_not_match=generation)
+    assert data is None and info.generation == generation
+    assert store.read("missing.json") == (None, None)
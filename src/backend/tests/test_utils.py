@@ -0,0 +1,52 @@
+import io
+import pytest
+from PIL import Image
+from utils import build_image_metadata
+
+
+def encode(image_format, size=(4, 3), **kwargs):
+    buffer = io.BytesIO()
+    Image.new("RGB", size).save(buffer, format=image_format, **kwargs)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize(
+    "image_format,mime_type",
+    [("JPEG", "image/jpeg"), ("PNG", "image/png"), ("MPO", "image/jpeg")],
+)
+def test_build_image_metadata_accepts_jpeg_and_png(image_format, mime_type):
+    data = encode(image_format)
+    metadata = build_image_metadata(data, "plan/image.jpg")
+    assert metadata["mime_type"] == mime_type
+    assert (metadata["width"], metadata["height"]) == (4, 3)
+    assert metadata["size"] == len(data)
+
+
+@pytest.mark.parametrize("image_format", ["GIF", "BMP", "WEBP"])
+def test_build_image_metadata_rejects_other_formats(image_format):
+    with pytest.raises(ValueError):
+        build_image_metadata(encode(image_format), "plan/image.png")
+
+
+def test_build_image_metadata_rejects_unreadable_data():
+    with pytest.raises(ValueError):
+        build_image_metadata(b"not an image", "plan/image.png")
+
+
+def test_build_image_metadata_rejects_decompression_bombs(monkeypatch):
+    # 上限の2倍を超える画素数はDecompressionBombErrorとなる
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 4)
+    with pytest.raises(ValueError):
+        build_image_metadata(encode("PNG", size=(3, 3)), "plan/image.png")
+
+
+def test_input_fingerprint_depends_on_every_input():
+    from utils import input_fingerprint
+
+    base = input_fingerprint(b"image", {"a": 1, "b": 2})
+    # JSONのキーの順序には依存しない
+    assert input_fingerprint(b"image", {"b": 2, "a": 1}) == base
+    assert input_fingerprint(b"image2", {"a": 1, "b": 2}) != base
+    assert input_fingerprint(b"image", {"a": 1, "b": 3}) != base
+    # 入力の区切りを含めて算出する
+    assert input_fingerprint(b"ab", b"c") != input_fingerprint(b"a", b"bc")
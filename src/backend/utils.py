@@ -1,17 +1,38 @@
 import uuid
+import io
 import json
 from flask import jsonify, request
-from google.cloud import storage
+from google import genai
+from PIL import Image
 import functools
+import hashlib
 import os
 import logging
+import threading
 from typing import Optional
+from storage_backend import create_storage_backend
+from artifact_cache import ArtifactCache, ImageCache
 
 ALLOWED_EXTENSIONS = set(
     os.environ.get("ALLOWED_EXTENSIONS", "jpg,jpeg,png").split(",")
 )
 GCS_BUCKET_NAME = os.environ.get("GCS_BUCKET_NAME", "plan-craft-test-bucket")
 BEARER_TOKEN = os.environ.get("BEARER_TOKEN", "changeme-token")
+# 成果物の生成元入力を識別するためのGCSメタデータキー
+INPUT_FINGERPRINT_KEY = "input_fingerprint"
+# アップロード時に記録する画像のメタデータ（保存先パス・MIMEタイプ・サイズ・ハッシュ）
+IMAGE_METADATA_FILENAME = "image.json"
+# 受け付ける画像形式とMIMEタイプ（MPOは複数画像を含むJPEGのため、JPEGとして扱う）
+IMAGE_FORMAT_MIME_TYPES = {
+    "JPEG": "image/jpeg",
+    "MPO": "image/jpeg",
+    "PNG": "image/png",
+}
+# 成果物（JSON）のプロセス内キャッシュの上限（MB）
+ARTIFACT_CACHE_MAX_MB = int(os.environ.get("ARTIFACT_CACHE_MAX_MB", "64"))
+# アップロードされた画像のプロセス内キャッシュの上限（MB）・保持期間（秒）
+IMAGE_CACHE_MAX_MB = int(os.environ.get("IMAGE_CACHE_MAX_MB", "128"))
+IMAGE_CACHE_TTL_SEC = float(os.environ.get("IMAGE_CACHE_TTL_SEC", "1800"))
 
 logger = logging.getLogger("llm_logger")
 if not logger.hasHandlers():
@@ -22,24 +43,216 @@ if not logger.hasHandlers():
     logger.setLevel(logging.INFO)
 
 
-def get_gcs_client_and_bucket(bucket_name=None):
+# プロセス内で共有する保存先（バケット名ごとに初回に生成する）
+_storages = {}
+_storage_lock = threading.Lock()
+# プロセス内で共有するVertex AIのクライアント（get_genai_clientで初回に生成する）
+_genai_client = None
+_genai_lock = threading.Lock()
+# 成果物の内容のキャッシュ（保存先・パス・世代番号が一致する場合のみ再利用する）
+artifact_cache = ArtifactCache(ARTIFACT_CACHE_MAX_MB * 1024 * 1024)
+# アップロードされた画像のキャッシュ（アップロード時に格納し、後続のステージが最初に参照する）
+image_cache = ImageCache(IMAGE_CACHE_MAX_MB * 1024 * 1024, IMAGE_CACHE_TTL_SEC)
+
+
+def get_genai_client():
+    """
+    プロセス内で共有するVertex AI（genai）のクライアントを返す
+    認証情報の取得・HTTP接続の確立を呼び出しごとに繰り返さないよう、初回のみ生成する
+    （非同期版のclient.aioはステージを実行するイベントループ上で共有する）
+    """
+    global _genai_client
+    if _genai_client is None:
+        with _genai_lock:
+            if _genai_client is None:
+                _genai_client = genai.Client(
+                    vertexai=True,
+                    project="plan-craft",
+                    location="global",
+                )
+    return _genai_client
+
+
+def get_storage(bucket_name=None):
+    """
+    バケット名に対応する保存先（StorageBackend）を返す
+    環境変数STORAGE_DIRが指定されている場合はローカルディレクトリを保存先とする
+    """
     if bucket_name is None:
         bucket_name = GCS_BUCKET_NAME
-    client = storage.Client()
-    bucket = client.bucket(bucket_name)
-    return client, bucket
+    store = _storages.get(bucket_name)
+    if store is None:
+        with _storage_lock:
+            store = _storages.get(bucket_name)
+            if store is None:
+                store = _storages[bucket_name] = create_storage_backend(bucket_name)
+    return store
 
 
-def gcs_blob_exists(bucket, blob_path):
-    blob = bucket.blob(blob_path)
-    return blob.exists()
+def load_artifact_bytes(store, blob_path):
+    """
+    成果物の内容を取得する（世代番号が同じ内容をキャッシュ済みの場合はダウンロードしない）
+    キャッシュの有無に関わらず、保存先への呼び出しは1回のみとする
+    Returns:
+        bytes | None: 内容（存在しない場合None）
+    """
+    cached = artifact_cache.lookup(store, blob_path)
+    data, info = store.read(
+        blob_path, if_generation_not_match=cached[0] if cached else None
+    )
+    if info is None:
+        return None
+    if data is None:
+        # キャッシュした世代から変更されていない
+        artifact_cache.mark_hit()
+        return cached[1]
+    artifact_cache.put(store, blob_path, info.generation, data)
+    return data
 
 
-def load_json_from_gcs(bucket, blob_path):
-    blob = bucket.blob(blob_path)
-    if not blob.exists():
+def load_json_from_gcs(store, blob_path):
+    data = load_artifact_bytes(store, blob_path)
+    if data is None:
         return None
-    return json.loads(blob.download_as_text())
+    return json.loads(data)
+
+
+def build_image_metadata(image_bytes, blob_path):
+    """
+    アップロードされた画像のメタデータを作成する（画像はヘッダのみ読み込む）
+    Returns:
+        dict: 保存先パス・MIMEタイプ・幅・高さ・バイト数・SHA-256
+    Raises:
+        ValueError: 画像として読み込めない・JPEG/PNG以外・画素数が上限を超える場合
+    """
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            width, height = image.size
+            image_format = image.format
+    except Image.DecompressionBombError as e:
+        raise ValueError(f"Image too large {blob_path}: {e}")
+    except OSError as e:
+        raise ValueError(f"Unreadable image {blob_path}: {e}")
+    mime_type = IMAGE_FORMAT_MIME_TYPES.get(image_format)
+    if mime_type is None:
+        raise ValueError(f"Unsupported image format {image_format} {blob_path}")
+    return {
+        "path": blob_path,
+        "mime_type": mime_type,
+        "width": width,
+        "height": height,
+        "size": len(image_bytes),
+        "sha256": hashlib.sha256(image_bytes).hexdigest(),
+    }
+
+
+def load_plan_image(store, plan_id):
+    """
+    アップロードされた画像を取得する（キャッシュに無い場合のみ保存先から取得する）
+    アップロード時に記録したメタデータから保存先パスを解決する
+    （メタデータの導入前にアップロードされたplanのみ、拡張子ごとに確認する）
+    Returns:
+        tuple[bytes, str] | None: 画像データとMIMEタイプ（存在しない場合None）
+    """
+    image = image_cache.get(plan_id)
+    if image is not None:
+        return image
+    metadata = load_json_from_gcs(store, f"{plan_id}/{IMAGE_METADATA_FILENAME}")
+    if metadata is not None:
+        data = store.get(metadata["path"])
+        image = (data, metadata["mime_type"]) if data is not None else None
+    else:
+        for ext in ["jpg", "jpeg", "png"]:
+            data = store.get(f"{plan_id}/image.{ext}")
+            if data is not None:
+                image = data, f"image/{ext}"
+                break
+    if image is not None:
+        image_cache.put(plan_id, *image)
+    return image
+
+
+def upload_json_to_gcs(store, blob_path, data, fingerprint=None):
+    """
+    JSONデータを保存する
+    Args:
+        store (StorageBackend): 保存先
+        blob_path (str): 保存先パス
+        data: JSON化可能なデータ
+        fingerprint (str, optional): 生成元入力のフィンガープリント（メタデータに記録）
+    """
+    store.put(
+        blob_path,
+        json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8"),
+        content_type="application/json",
+        metadata=(
+            {INPUT_FINGERPRINT_KEY: fingerprint} if fingerprint is not None else None
+        ),
+    )
+
+
+def load_json_with_generation(store, blob_path):
+    """
+    JSONデータと世代番号を取得する（upload_json_if_generation_matchと組み合わせて利用する）
+    Returns:
+        tuple: データと世代番号（存在しない場合(None, 0)）
+    """
+    data, info = store.read(blob_path)
+    if info is None:
+        return None, 0
+    return json.loads(data), info.generation
+
+
+def upload_json_if_generation_match(store, blob_path, data, generation):
+    """
+    保存先の世代番号がgenerationと一致する場合のみJSONデータを保存する（compare-and-swap）
+    generationに0を指定した場合は、存在しない場合のみ作成する
+    Returns:
+        int | None: 保存後の世代番号（他の更新と競合した場合None）
+    """
+    return store.put(
+        blob_path,
+        json.dumps(data, ensure_ascii=False).encode("utf-8"),
+        content_type="application/json",
+        if_generation_match=generation,
+    )
+
+
+def delete_blob_if_generation_match(store, blob_path, generation) -> bool:
+    """
+    保存先の世代番号がgenerationと一致する場合のみ削除する
+    Returns:
+        bool: 削除した場合True（他の更新と競合した・既に削除済みの場合False）
+    """
+    return store.delete(blob_path, if_generation_match=generation)
+
+
+def gcs_blob_matches_fingerprint(store, blob_path, fingerprint):
+    """
+    同一入力から生成された成果物が保存先に存在するかを判定する
+    フィンガープリントが記録されていない（導入前に生成された）成果物は最新とみなす
+    """
+    info = store.stat(blob_path)
+    if info is None:
+        return False
+    stored = info.metadata.get(INPUT_FINGERPRINT_KEY)
+    return stored is None or stored == fingerprint
+
+
+def input_fingerprint(*inputs) -> str:
+    """
+    ステージの入力（bytesまたはJSON化可能なデータ）からフィンガープリントを算出する
+    """
+    digest = hashlib.sha256()
+    for item in inputs:
+        if isinstance(item, (bytes, bytearray)):
+            digest.update(item)
+        else:
+            digest.update(
+                json.dumps(item, ensure_ascii=False, sort_keys=True).encode("utf-8")
+            )
+        digest.update(b"\0")
+    return digest.hexdigest()
 
 
 def validate_uuid(plan_id):
@@ -97,13 +310,9 @@ def allowed_file(filename):
 
 
 def upload_to_gcs(file_stream, filename, content_type, bucket_name=None):
-    if bucket_name is None:
-        bucket_name = GCS_BUCKET_NAME
-    client = storage.Client()
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(filename)
-    blob.upload_from_file(file_stream, content_type=content_type)
-    return blob.public_url
+    store = get_storage(bucket_name)
+    store.put(filename, file_stream.read(), content_type=content_type)
+    return store.url(filename)
 
 
 def require_bearer_token(func):
@@ -131,6 +340,17 @@ def load_llm_settings():
         return json.load(f)
 
 
+def load_pipeline_settings():
+    """
+    パイプライン（ステージ実行）設定ファイルを読み込んで返す
+    """
+    settings_path = os.path.join(
+        os.path.dirname(__file__), "settings/pipeline_settings.json"
+    )
+    with open(settings_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
 def print_llm_usage_and_cost(
     prompt_tokens: Optional[int],
     output_tokens: Optional[int],
@@ -0,0 +1,164 @@
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from job_queue import create_job_queue
+from hedging import hedge_stats
+from retry_policy import retry_stats
+from pipeline import StageCancelledError, StageQueueFullError, WeightedLanes
+from pipeline_stages import (
+    pipeline_settings,
+    stage_executor,
+    stage_leases,
+    pdf_render_pool,
+    trigger_stage_from_gcs,
+    resume_unfinished_jobs,
+    cancel_requested_plans,
+)
+from utils import artifact_cache, image_cache, GCS_BUCKET_NAME
+import google.cloud.logging
+from google.cloud.logging.handlers import CloudLoggingHandler
+
+# パイプラインのステージを実行するワーカー（queueモード）
+# Webサーバが投入したジョブをジョブキューから取り出し、GCS上の入力からステージを実行する
+# 起動: python worker.py
+
+WORKER_SETTINGS = pipeline_settings.get("worker", {})
+# ジョブキューが空の場合に次に確認するまでの秒数
+POLL_INTERVAL_SEC = WORKER_SETTINGS.get("poll_interval_sec", 2)
+# 停止したワーカーのジョブ（リースが期限切れのジャーナル）を確認する間隔
+JOURNAL_SCAN_SEC = WORKER_SETTINGS.get("journal_scan_sec", 60)
+# 実行中のplanが取り消されていないかを確認する間隔
+CANCEL_SCAN_SEC = WORKER_SETTINGS.get("cancel_scan_sec", 10)
+
+
+# ジョブキューから取り出すステージの優先度（StageExecutorと同じレーン・重み）
+STAGE_LANES = WeightedLanes(
+    pipeline_settings.get("scheduler", {}).get("lanes"), pipeline_settings["stages"]
+)
+
+
+def available_stages() -> list[str]:
+    """
+    実行枠に空きがあるステージを返す
+    空きが無いステージのジョブはキューに残し、他のワーカーが取り出せるようにする
+    """
+    return [
+        stage
+        for stage in pipeline_settings["stages"]
+        if stage_executor.has_capacity(stage)
+    ]
+
+
+def claim_next(job_queue) -> dict:
+    """
+    実行枠に空きがあるステージのジョブを、重みに応じて選んだレーンから順に取り出す
+    （アップロード直後の部品リスト検出がPDF作成の後ろで待たないようにする）
+    """
+    stages = available_stages()
+    lanes = {STAGE_LANES.lane_of(stage) for stage in stages}
+    for lane in STAGE_LANES.order(lanes):
+        entry = job_queue.claim(
+            [stage for stage in stages if STAGE_LANES.lane_of(stage) == lane]
+        )
+        if entry is not None:
+            return entry
+    return None
+
+
+def run_worker(job_queue, stop_event: threading.Event):
+    """
+    停止要求があるまでジョブキューからジョブを取り出して実行する
+    """
+    next_scan = time.monotonic() + JOURNAL_SCAN_SEC
+    next_cancel_scan = time.monotonic() + CANCEL_SCAN_SEC
+    while not stop_event.is_set():
+        if time.monotonic() >= next_scan:
+            resume_unfinished_jobs()
+            next_scan = time.monotonic() + JOURNAL_SCAN_SEC
+        if time.monotonic() >= next_cancel_scan:
+            cancel_requested_plans()
+            next_cancel_scan = time.monotonic() + CANCEL_SCAN_SEC
+        entry = claim_next(job_queue)
+        if entry is None:
+            stop_event.wait(POLL_INTERVAL_SEC)
+            continue
+        plan_id, stage = entry["plan_id"], entry["stage"]
+        try:
+            job = trigger_stage_from_gcs(plan_id, stage)
+        except StageQueueFullError as e:
+            # 取り出した後に枠が埋まった場合はキューに戻す
+            logging.warning(f"[worker] {e}")
+            job_queue.enqueue(plan_id, stage)
+            continue
+        except StageCancelledError as e:
+            logging.info(f"[worker] {e}")
+            continue
+        except Exception as e:
+            logging.error(f"[worker] Failed to start {stage} for {plan_id}: {e}")
+            continue
+        if job is None:
+            logging.warning(f"[worker] Inputs of {stage} not found for {plan_id}")
+            continue
+        logging.info(f"[worker] Started {stage} for {plan_id}")
+
+
+class HealthCheckHandler(BaseHTTPRequestHandler):
+    """
+    ヘルスチェック用のハンドラ（ステージの実行状況を返す）
+    """
+
+    def do_GET(self):
+        body = json.dumps(
+            {
+                "stages": stage_executor.stats(),
+                "hedging": hedge_stats(),
+                "retry": retry_stats(),
+                "artifact_cache": artifact_cache.stats(),
+                "image_cache": image_cache.stats(),
+            }
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    client = google.cloud.logging.Client()
+    logging.getLogger().addHandler(CloudLoggingHandler(client))
+    logging.getLogger().setLevel(logging.INFO)
+
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+    signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+
+    # App Engineのヘルスチェックに応答する
+    server = ThreadingHTTPServer(
+        ("", int(os.environ.get("PORT", "8080"))), HealthCheckHandler
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # 前回のワーカーで完了しなかったステージを再投入する
+    resume_unfinished_jobs()
+    logging.info("[worker] Started")
+    run_worker(create_job_queue(GCS_BUCKET_NAME), stop_event)
+
+    # 実行中のジョブはジャーナルに残り、リースの解放後に他のワーカーが再投入する
+    logging.info("[worker] Stopping")
+    server.shutdown()
+    stage_executor.shutdown(wait=False)
+    pdf_render_pool.shutdown(wait=False)
+    if stage_leases is not None:
+        stage_leases.stop()
+
+
+if __name__ == "__main__":
+    main()